@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    handler_profiling.py
+# @Author:      Samuel Hill
+# @Date:        2021-04-01 15:02:18
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-04-01 15:02:18
+
+"""Overhead benchmark for handler profiling. Calls an ask function that does
+a little pure Python work (summing squares) the way Pythonian.call_handler
+does, unprofiled and wrapped by a HandlerProfiler in each mode, and reports
+the time per call and how much profiling added. Nothing is sent, so this is
+the cost profiling adds to the handler itself.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import path as system_path
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML.profiling import HandlerProfiler, DETERMINISTIC, \
+     SAMPLING  # noqa: E402
+
+
+def squares(number: int) -> int:
+    """The ask function, a little work in a few nested calls"""
+    return sum(square(value) for value in range(number))
+
+
+def square(value: int) -> int:
+    """Called once per value so deterministic profiling has calls to time"""
+    return value * value
+
+
+def time_calls(handler, calls: int, size: int) -> float:
+    """Seconds per call of handler(size)"""
+    start = perf_counter()
+    for _ in range(calls):
+        handler(size)
+    return (perf_counter() - start) / calls
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Handler profiling benchmark.')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='handler calls per mode')
+    parser.add_argument('-s', '--size', type=int, default=200,
+                        help='values summed per call')
+    args = parser.parse_args()
+    baseline = time_calls(squares, args.number, args.size)
+    print(f'{args.number} calls per mode, {args.size} values per call')
+    print(f'{"mode":<14} {"us/call":>10} {"overhead":>10}')
+    print(f'{"off":<14} {baseline * 1e6:>10.1f} {"-":>10}')
+    for mode in (SAMPLING, DETERMINISTIC):
+        profiler = HandlerProfiler(mode)
+        elapsed = time_calls(profiler.wrap('squares', squares), args.number,
+                             args.size)
+        profiler.close()
+        print(f'{mode:<14} {elapsed * 1e6:>10.1f} '
+              f'{elapsed / baseline - 1:>10.0%}')
+
+
+if __name__ == '__main__':
+    main()
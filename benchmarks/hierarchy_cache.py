@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    hierarchy_cache.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-26 10:37:18
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-26 10:37:18
+
+"""Subsumption check benchmark for NextKBAgent's HierarchyCache. Builds a
+genls hierarchy shaped like a KB's (a tree with a few collections under more
+than one parent), loads it with and without the reachability index (without,
+queries walk the genls graph) and reports the load time, memory and the
+microseconds per is_genls check and ancestor list for each. Nothing is sent.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from logging import getLogger, ERROR
+from pathlib import Path
+from random import Random
+from sys import path as system_path
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+system_path.insert(0, str(PACKAGE_ROOT / 'examples'))
+
+# pylint: disable=wrong-import-position
+from py_nextkb import HierarchyCache  # noqa: E402
+
+
+def hierarchy(collections: int, fanout: int, seed: int = 0) -> list:
+    """(spec, collection) genls edges of a tree with a second parent for one
+    in five collections"""
+    random = Random(seed)
+    edges = [(f'C{index}', f'C{(index - 1) // fanout}')
+             for index in range(1, collections)]
+    edges.extend((f'C{index}',
+                  f'C{random.randrange(index // fanout ** 2 + 1)}')
+                 for index in range(1, collections, 5))
+    return edges
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Hierarchy cache benchmark.')
+    parser.add_argument('-c', '--collections', type=int, default=50000,
+                        help='collections in the hierarchy')
+    parser.add_argument('-f', '--fanout', type=int, default=8,
+                        help='specializations per collection')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='checks per path')
+    args = parser.parse_args()
+    getLogger('py_nextkb').setLevel(ERROR)  # the walk path warns on load
+    edges = hierarchy(args.collections, args.fanout)
+    leaves = [f'C{args.collections - 1 - index % 1000}'
+              for index in range(args.number)]
+    general = [f'C{index % 50}' for index in range(args.number)]
+    print(f'{args.collections} collections, {args.number} checks per path')
+    print(f'{"path":<8} {"load s":>8} {"MiB":>8} {"us/check":>10} '
+          f'{"us/ancestors":>13}')
+    for name, max_bytes in (('indexed', 2 ** 40), ('walk', 0)):
+        cache = HierarchyCache('BenchmarkMt', lambda token: [], max_bytes)
+        start = perf_counter()
+        cache.load(edges)
+        loaded = perf_counter() - start
+        start = perf_counter()
+        for spec, collection in zip(leaves, general):
+            cache.is_genls(spec, collection)
+        checks = (perf_counter() - start) / args.number
+        start = perf_counter()
+        for spec in leaves[:args.number // 10]:
+            cache.ancestors(spec)
+        ancestors = (perf_counter() - start) / (args.number // 10)
+        memory = cache.memory_bytes() / 2 ** 20
+        print(f'{name:<8} {loaded:>8.2f} {memory:>8.1f} {checks * 1e6:>10.2f}'
+              f' {ancestors * 1e6:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
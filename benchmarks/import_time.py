@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    import_time.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-02 11:12:40
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-02 11:12:40
+
+"""Import time benchmark for the companionsKQML package. Runs a fresh
+interpreter with -X importtime several times, reports the slowest imports and
+fails (exit status 1) if the median cumulative import time of companionsKQML
+goes over budget or if any of the lazily loaded dependencies sneak back into
+the import graph.
+
+Attributes:
+    DEFAULT_BUDGET_MS (float): default regression threshold in milliseconds
+    LAZY_MODULES (list): modules that must not be imported by
+        'import companionsKQML'
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from statistics import median
+from subprocess import run, PIPE
+from sys import executable, exit as sys_exit
+from os import environ, pathsep
+
+DEFAULT_BUDGET_MS = 60.0
+LAZY_MODULES = ['psutil', 'dateutil', 'argparse', 'ipaddress', 'subprocess',
+                'inspect', 'json', 'pathlib']
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_times(module: str) -> dict:
+    """Runs a fresh interpreter importing module with -X importtime
+
+    Args:
+        module (str): module to import
+
+    Returns:
+        dict: module name -> (self us, cumulative us) for every import
+    """
+    env = dict(environ)
+    env['PYTHONPATH'] = pathsep.join(filter(None, [str(PACKAGE_ROOT),
+                                                   env.get('PYTHONPATH')]))
+    result = run([executable, '-X', 'importtime', '-c', f'import {module}'],
+                 stdout=PIPE, stderr=PIPE, env=env, check=True,
+                 universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='companionsKQML import benchmark.')
+    parser.add_argument('-r', '--runs', type=int, default=7,
+                        help='number of fresh interpreters to time')
+    parser.add_argument('-b', '--budget', type=float,
+                        default=DEFAULT_BUDGET_MS,
+                        help='maximum median import time in milliseconds')
+    parser.add_argument('-t', '--top', type=int, default=15,
+                        help='number of slowest imports to list')
+    args = parser.parse_args()
+    runs = [import_times('companionsKQML') for _ in range(args.runs)]
+    totals = [run_times['companionsKQML'][1] / 1000 for run_times in runs]
+    print(f'{"module":<45} {"self ms":>9} {"cumul ms":>9}')
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][0],
+                     reverse=True)
+    for name, (self_us, cumulative_us) in slowest[:args.top]:
+        print(f'{name:<45} {self_us / 1000:>9.2f} '
+              f'{cumulative_us / 1000:>9.2f}')
+    total = median(totals)
+    print(f'\nimport companionsKQML: median {total:.2f} ms over {args.runs} '
+          f'runs (min {min(totals):.2f}, max {max(totals):.2f}), budget '
+          f'{args.budget:.2f} ms')
+    failed = False
+    eager = sorted({name.split('.')[0] for name in runs[-1]} &
+                   set(LAZY_MODULES))
+    if eager:
+        print(f'FAIL: lazily loaded modules imported eagerly: {eager}')
+        failed = True
+    if total > args.budget:
+        print('FAIL: import time over budget')
+        failed = True
+    sys_exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
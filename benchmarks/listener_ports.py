@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    listener_ports.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-29 09:12:40
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-29 09:12:40
+
+"""Listener port allocation benchmark. Binds a listener for each of a fleet
+of agents starting on one host (keeping every socket open, as running agents
+would) the default way, scanning up from 8950, and with EPHEMERAL_PORT, where
+the operating system picks the port, and reports the bind calls and the
+microseconds the last agent to start spent getting its port for each.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from logging import getLogger, ERROR
+from pathlib import Path
+from socket import socket, SOL_SOCKET, SO_REUSEADDR
+from sys import path as system_path
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML.companionsKQMLModule import EPHEMERAL_PORT, \
+     bind_listener  # noqa: E402
+
+
+class CountingSocket(socket):
+    """socket counting its bind calls
+
+    Attributes:
+        binds (int): bind calls made by every CountingSocket
+    """
+
+    binds = 0
+
+    def bind(self, address):  # pylint: disable=arguments-differ
+        CountingSocket.binds += 1
+        super().bind(address)
+
+
+def start_fleet(agents: int, port: int) -> tuple:
+    """Binds a listener per agent, returns the bind calls and the seconds
+    the last one took"""
+    CountingSocket.binds, sockets, last = 0, [], 0.0
+    try:
+        for _ in range(agents):
+            sock = CountingSocket()
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            sockets.append(sock)
+            start = perf_counter()
+            bind_listener(sock, port)
+            last = perf_counter() - start
+            sock.listen(10)
+    finally:
+        for sock in sockets:
+            sock.close()
+    return CountingSocket.binds, last
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Listener port benchmark.')
+    parser.add_argument('-a', '--agents', type=int, nargs='+',
+                        default=[10, 50, 100], help='fleet sizes to start')
+    args = parser.parse_args()
+    getLogger('companionsKQML.companionsKQMLModule').setLevel(ERROR)
+    print(f'{"agents":>6} {"mode":<10} {"binds":>7} {"last us":>9}')
+    for agents in args.agents:
+        for name, port in (('range', 8950), ('ephemeral', EPHEMERAL_PORT)):
+            binds, last = start_fleet(agents, port)
+            print(f'{agents:>6} {name:<10} {binds:>7} {last * 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
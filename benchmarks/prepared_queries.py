@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    prepared_queries.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-24 14:05:33
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-24 14:05:33
+
+"""Client CPU benchmark for NextKBAgent queries. Builds the same retrieve_it
+style ask-all over and over with only the token changing, once the way the
+NextKBAgent API does (wrappers, _kqml_ask_all re-parsing the text with
+performative, then serializing it for send) and once through a query made by
+NextKBAgent.prepare (only the token and reply id spliced into pre-encoded
+bytes), and reports the process CPU time per query for each. Nothing is sent.
+
+Attributes:
+    AGENT (SimpleNamespace): stands in for a NextKBAgent, only its name is
+        used to build queries
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import path as system_path
+from time import process_time
+from types import SimpleNamespace
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+system_path.insert(0, str(PACKAGE_ROOT / 'examples'))
+
+# pylint: disable=wrong-import-position
+from companionsKQML.companionsKQMLModule import EncodedPerformative, \
+     encode_message  # noqa: E402
+from py_nextkb import NextKBAgent, PreparedQuery, \
+     _environment_wrapper, _num_answers_wrapper, \
+     _transitive_wrapper  # noqa: E402
+
+AGENT = SimpleNamespace(name=NextKBAgent.name)
+
+
+def rebuilt(token: str, reply_id: str) -> bytes:
+    """The retrieve_it path, query text rebuilt and parsed every time"""
+    content = _transitive_wrapper(f'(isa {token} ?x)', None)
+    content = _environment_wrapper(content, None)
+    content = _num_answers_wrapper(content, None)
+    content = f'(kbOnly {content})'
+    # pylint: disable=protected-access
+    return encode_message(NextKBAgent._kqml_ask_all(AGENT, reply_id, content,
+                                                    'BiologyMt'))
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Prepared query benchmark.')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='queries built per path')
+    args = parser.parse_args()
+    content = _transitive_wrapper('(isa {token} ?x)', None)
+    content = _environment_wrapper(content, None)
+    content = f'(kbOnly {_num_answers_wrapper(content, None)})'
+    query = PreparedQuery(AGENT, content, 'BiologyMt')
+    paths = {
+        'rebuilt': rebuilt,
+        'prepared': lambda token, reply_id: encode_message(EncodedPerformative(
+            'ask-all', query.encode(reply_id, token=token))),
+    }
+    tokens = [f'Token{index}' for index in range(args.number)]
+    print(f'{args.number} queries per path, process CPU time')
+    print(f'{"path":<10} {"us/query":>10}')
+    for name, build in paths.items():
+        start = process_time()
+        for index, token in enumerate(tokens):
+            build(token, f'py_nextkb_query_id{index}')
+        elapsed = process_time() - start
+        print(f'{name:<10} {elapsed / args.number * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    send_syscalls.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-11 10:41:18
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-11 10:41:18
+
+"""Send path benchmark for CompanionsKQMLModule. Sends batches of inserts to a
+local sink standing in for Companions, once through the buffered path (a
+BufferedWriter over SocketIO, one write and flush per message via
+send_generic) and once through send_batch (every message encoded into one
+buffer and written with a single vectored send), and reports the socket calls
+and time per message for each.
+
+Socket calls are counted by swapping the socket class the module connects
+with for one that counts connect, send*, shutdown and close. Each counted call
+is one system call, except that sendall may loop in C on a short write.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+    SOCKET_CALLS (tuple): socket methods that are counted
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from socket import socket, SHUT_RDWR
+from sys import path as system_path
+from threading import Thread
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML import companionsKQMLModule  # noqa: E402
+from companionsKQML import CompanionsKQMLModule, performative  # noqa: E402
+
+SOCKET_CALLS = ('connect', 'send', 'sendall', 'sendmsg', 'shutdown', 'close')
+CALLS = Counter()
+
+
+class CountingSocket(socket):
+    """socket that counts the calls listed in SOCKET_CALLS"""
+
+
+def _counted(name: str):
+    method = getattr(socket, name)
+
+    def counted(self, *args, **kwargs):
+        CALLS[name] += 1
+        return method(self, *args, **kwargs)
+    return counted
+
+
+for _name in SOCKET_CALLS:
+    setattr(CountingSocket, _name, _counted(_name))
+
+
+def sink() -> int:
+    """Starts a server reading (and discarding) everything sent to it
+
+    Returns:
+        int: port the sink listens on
+    """
+    server = socket()
+    server.bind(('localhost', 0))
+    server.listen(128)
+
+    def drain(connection: socket):
+        with connection:
+            while connection.recv(65536):
+                pass
+
+    def accept():
+        while True:
+            connection, _ = server.accept()
+            Thread(target=drain, args=[connection], daemon=True).start()
+    Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def send_buffered(agent: CompanionsKQMLModule, msgs: list):
+    """The send path before send_batch wrote vectored: one BufferedWriter
+    write and flush per message on a shared connection"""
+    send_socket, out = agent.open_send_connection()
+    for msg in msgs:
+        agent.send_generic(msg, out)
+    send_socket.shutdown(SHUT_RDWR)
+    send_socket.close()
+
+
+def measure(send, agent: CompanionsKQMLModule, msgs: list,
+            repeats: int) -> tuple:
+    """Sends msgs repeats times with send
+
+    Returns:
+        tuple: (Counter of socket calls per message, seconds per message)
+    """
+    CALLS.clear()
+    start = perf_counter()
+    for _ in range(repeats):
+        send(agent, msgs)
+    elapsed = perf_counter() - start
+    total = len(msgs) * repeats
+    return ({name: count / total for name, count in CALLS.items()},
+            elapsed / total)
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='companionsKQML send benchmark.')
+    parser.add_argument('-b', '--batches', type=int, nargs='+',
+                        default=[1, 10, 100, 1000],
+                        help='messages sent per connection')
+    parser.add_argument('-m', '--messages', type=int, default=20000,
+                        help='messages sent per batch size and path')
+    args = parser.parse_args()
+    agent = CompanionsKQMLModule(port=sink())
+    companionsKQMLModule.socket = CountingSocket
+    paths = [('buffered', send_buffered),
+             ('vectored', CompanionsKQMLModule.send_batch)]
+    print(f'{"batch":>6} {"path":<9} {"calls/msg":>10} {"send*/msg":>10} '
+          f'{"us/msg":>8}')
+    try:
+        for batch in args.batches:
+            msgs = [performative(f'(insert :content (isa fact{index} Thing) '
+                                 f':receiver session-reasoner)')
+                    for index in range(batch)]
+            repeats = max(args.messages // batch, 1)
+            for name, send in paths:
+                calls, seconds = measure(send, agent, msgs, repeats)
+                sends = sum(calls.get(call, 0) for call in
+                            ('send', 'sendall', 'sendmsg'))
+                print(f'{batch:>6} {name:<9} {sum(calls.values()):>10.3f} '
+                      f'{sends:>10.3f} {seconds * 1e6:>8.1f}')
+    finally:
+        companionsKQMLModule.socket = socket
+        agent.exit(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    shared_payloads.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-30 16:02:55
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-30 16:02:55
+
+"""Large payload benchmark for achieve_on_agent between co-located agents.
+Passes an array of floats from a sender to a receiver as KQML text (listify,
+serialize, then parse on the receiving side, what achieve_on_agent does
+without shared memory) and through the shared memory side channel (share on
+the sending side, resolve on the receiving side), and reports the
+milliseconds and message bytes each takes. Nothing goes through a
+facilitator, so this is the CPU cost at both ends.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from array import array
+from pathlib import Path
+from sys import path as system_path
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML import listify, performative  # noqa: E402
+from companionsKQML.metrics import MetricsRegistry  # noqa: E402
+from companionsKQML.sharedmem import SharedPayloads  # noqa: E402
+
+HEAD = '(achieve :sender Sender :receiver Receiver :content (task :action '
+
+
+def as_text(values: array) -> int:
+    """The listify path, returns the message size"""
+    text = f'{HEAD}(crunch {listify(values.tolist())})))'
+    received = performative(text).get('content').get('action').data[1]
+    assert len(received.data) == len(values)
+    return len(text)
+
+
+def as_shared(values: array, shared: SharedPayloads) -> int:
+    """The shared memory path, returns the message size"""
+    text = f'{HEAD}(crunch {shared.share(values)})))'
+    received = shared.resolve(
+        performative(text).get('content').get('action').data[1])
+    assert received.nbytes == values.itemsize * len(values)
+    return len(text)
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Shared payload benchmark.')
+    parser.add_argument('-k', '--kilobytes', type=int, nargs='+',
+                        default=[32, 128],
+                        help='payload sizes to pass (parsing the text path '
+                             'grows much faster than the payload)')
+    args = parser.parse_args()
+    shared = SharedPayloads(MetricsRegistry())
+    print(f'{"KiB":>6} {"path":<8} {"ms":>10} {"message bytes":>14}')
+    try:
+        for kilobytes in args.kilobytes:
+            values = array('d', range(kilobytes * 2 ** 10 // 8))
+            for name, run in (('text', as_text),
+                              ('shared', lambda each: as_shared(each,
+                                                                shared))):
+                start = perf_counter()
+                size = run(values)
+                elapsed = perf_counter() - start
+                print(f'{kilobytes:>6} {name:<8} {elapsed * 1e3:>10.2f} '
+                      f'{size:>14,}')
+    finally:
+        shared.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    subscription_stress.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-19 14:26:13
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-19 14:26:13
+
+"""Concurrency stress benchmark for SubscriptionManager. Many updater threads
+hammer update on a set of patterns, another thread keeps adding patterns and
+subscribers, and a poller loops over the snapshot taking new data the way
+Pythonian's poller does. Reports update throughput and fails (exit status 1)
+if any thread raised or if the last update to a pattern was never taken.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import exit as sys_exit, path as system_path
+from threading import Event, Thread
+from time import perf_counter
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML.pythonian import SubscriptionManager  # noqa: E402
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='SubscriptionManager stress test.')
+    parser.add_argument('-t', '--threads', type=int, default=16,
+                        help='concurrent updater threads')
+    parser.add_argument('-u', '--updates', type=int, default=20000,
+                        help='updates per updater thread')
+    parser.add_argument('-p', '--patterns', type=int, default=50,
+                        help='patterns that exist from the start')
+    args = parser.parse_args()
+    manager = SubscriptionManager()
+    for index in range(args.patterns):
+        manager.add_new_subscription(f'(pattern{index} ?x)')
+    errors, taken, stop = [], {}, Event()
+
+    def guarded(function):
+        def run(*run_args):
+            try:
+                function(*run_args)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+        return run
+
+    def update(thread: int):
+        for number in range(args.updates):
+            pattern = f'(pattern{(thread + number) % args.patterns} ?x)'
+            manager.update(pattern, [(thread, number)])
+
+    def churn():
+        number = 0
+        while not stop.is_set():
+            pattern = f'(extra{number} ?x)'
+            manager.add_new_subscription(pattern)
+            manager.subscribe(pattern, f'subscriber{number}')
+            manager.subscribe(f'(pattern{number % args.patterns} ?x)',
+                              f'subscriber{number}')
+            number += 1
+
+    def poll():
+        while True:
+            done = stop.is_set()
+            for pattern, subscription in manager.snapshot():
+                for _ in subscription:  # stands in for pushing to each
+                    pass
+                data = subscription.take_data()
+                if data is not None:
+                    taken[pattern] = data
+            if done:
+                return
+
+    updaters = [Thread(target=guarded(update), args=[thread])
+                for thread in range(args.threads)]
+    others = [Thread(target=guarded(churn)), Thread(target=guarded(poll))]
+    start = perf_counter()
+    for thread in updaters + others:
+        thread.start()
+    for thread in updaters:
+        thread.join()
+    elapsed = perf_counter() - start
+    stop.set()
+    for thread in others:
+        thread.join()
+    total = args.threads * args.updates
+    print(f'{total} updates from {args.threads} threads over '
+          f'{len(manager)} patterns in {elapsed:.2f}s '
+          f'({total / elapsed:,.0f} updates/s)')
+    lost = [pattern for pattern, subscription in manager.items()
+            if pattern.startswith('(pattern')
+            and (subscription.new_data is not None
+                 or taken.get(pattern) is not subscription.old_data)]
+    for error in errors:
+        print(f'FAIL: {type(error).__name__}: {error}')
+    if lost:
+        print(f'FAIL: last update never taken for {len(lost)} pattern(s)')
+    sys_exit(1 if errors or lost else 0)
+
+
+if __name__ == '__main__':
+    main()
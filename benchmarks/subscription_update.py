@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    subscription_update.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-18 11:02:56
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-18 11:02:56
+
+"""Change detection benchmark for Subscription.update. Repeatedly updates a
+subscription with an unchanged copy of a large list of bindings and times the
+three ways of deciding nothing changed: comparing the data (the default),
+comparing versions, and the producer marking the update unchanged.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import path as system_path
+from timeit import repeat
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML.pythonian import Subscription  # noqa: E402
+
+
+def main():
+    """Parses arguments, runs the benchmark and reports"""
+    parser = ArgumentParser(description='Subscription.update benchmark.')
+    parser.add_argument('-s', '--size', type=int, default=100000,
+                        help='number of bindings in the subscription data')
+    parser.add_argument('-n', '--number', type=int, default=200,
+                        help='updates per timing run')
+    args = parser.parse_args()
+    data = [(f'?x{index}', f'Entity{index}') for index in range(args.size)]
+    copy = [(name, value) for name, value in data]  # equal, not identical
+    subscription = Subscription()
+    cases = {
+        'compare data': lambda: subscription.update(copy),
+        'compare version': lambda: subscription.update(copy, version=1),
+        'unchanged': lambda: subscription.update(copy, unchanged=True),
+    }
+    print(f'{args.size} bindings, best of 5 runs of {args.number} updates')
+    print(f'{"check":<16} {"us/update":>12}')
+    for name, update in cases.items():
+        subscription.update(data, version=1)  # last data sent was version 1
+        subscription.retire_data()
+        best = min(repeat(update, number=args.number, repeat=5))
+        print(f'{name:<16} {best / args.number * 1e6:>12.2f}')
+        assert subscription.new_data is None, 'unchanged data was taken'
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ from .pythonian import Pythonian
 from .companionsKQMLModule import CompanionsKQMLModule, \
       ControlledCompanionsKQMLModule, listify, performative, \
       convert_to_boolean, convert_to_int
+from .host import AgentHost
 
 __authors__ = "Samuel Hill, Willie Wilson, and Joe Blass"
 __copyright__ = "Copyright 2020-2021, Samuel Hill and Northwestern University"
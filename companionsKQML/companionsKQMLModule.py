@@ -11,37 +11,66 @@
 agents. Adds a KQML socket server that is kept alive in a thread for
 continuous communication between Companions and your python agents.
 
+Dependencies only needed for discovery, controlled launch, argument parsing or
+status updates (psutil, dateutil, argparse, ipaddress, subprocess, json) are
+imported inside the functions that use them, agents that never touch those
+features don't pay for loading them.
+
 Attributes:
     COMPANIONS_EXES (list): list of common companions executable names
+    EPHEMERAL_PORT (int): listener_port asking for a port picked by the
+        operating system, allocated in a single bind however many agents
+        are starting on the host
+    IOV_MAX (int): most buffers handed to a single sendmsg (the limit on
+        Linux and macOS)
     KQMLType (TypeVar): simplified type for KQML, includes list, tokens, and
         strings
+    LAUNCH_TIMEOUT (int): default number of seconds to wait for a launched
+        Companions exe to publish its port and accept connections
     LOCALHOST (str): 'localhost'
     LOCALHOST_DEFS (list): list of common localhost equivalents
     LOGGER (logging): The logger (from logging) to handle debugging
+    PERFORMATIVE_PRIORITIES (dict): priority class of performatives that
+        aren't asks (the default class), see scheduling.PRIORITY_CLASSES
     PORTNUM (str): 'portnum.dat' - name of file generated by Companions on
         startup of it's own KQML socket server
+    SHUTDOWN_TIMEOUT (float): default number of seconds exit will wait for
+        in-flight messages to finish before abandoning them
+    SPOOL_RETRY (tuple): first and longest seconds between attempts to reach
+        Companions while replaying the spool
 """
 
-from argparse import ArgumentParser, ArgumentTypeError
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from datetime import datetime
-from io import BufferedReader, BufferedWriter
-from ipaddress import ip_address
-from json import loads as load_dict
+from io import BufferedReader, BufferedWriter, BytesIO, StringIO
 from logging import getLogger, DEBUG, INFO, WARNING
-from pathlib import Path
+from os import close as close_fd, read as read_fd, fsencode
+from select import select
+from selectors import DefaultSelector, EVENT_READ
 from socket import socket, SocketIO, gethostname, SOL_SOCKET, SO_REUSEADDR, \
-     SHUT_RDWR
-from subprocess import Popen
-from sys import argv as system_argument_list
-from threading import Thread
-from time import sleep
-from typing import Optional, Any, TypeVar
+     SHUT_RDWR, create_connection, socketpair
+from sys import argv as system_argument_list, platform
+from threading import Thread, Event, Lock
+from time import sleep, monotonic, perf_counter
+from typing import Optional, Any, TypeVar, List, Dict, Iterable, Callable, \
+     TYPE_CHECKING
 # non-system, pip installs
-from dateutil.relativedelta import relativedelta
 from kqml import KQMLModule, KQMLReader, KQMLPerformative, KQMLList, \
-     KQMLDispatcher, KQMLToken, KQMLString
-from psutil import disk_partitions, process_iter
+     KQMLDispatcher, KQMLToken, KQMLString, KQMLObject
+from kqml.kqml_exceptions import StopWaitingSignal
+from .metrics import MetricsRegistry
+from .outbound import OutboundQueue
+from .ratelimit import RateLimiter, Limit
+from .scheduling import PriorityScheduler, DEFAULT_SHARED
+from .tracing import Tracer, TraceHook, current_trace, NULL_TRACE
+
+if TYPE_CHECKING:  # only imported when discovering or launching companions
+    from pathlib import Path
+    from subprocess import Popen
+    from .host import AgentHost  # imports this module
+    from .prefork import PreforkPool  # imports this module
+    from .replay import TrafficRecorder  # imports this module
+    from .spool import OutboundSpool  # imports pathlib
 
 getLogger(KQMLDispatcher.__name__).setLevel(WARNING)
 
@@ -49,7 +78,15 @@ PORTNUM = 'portnum.dat'
 LOCALHOST = 'localhost'
 LOCALHOST_DEFS = [LOCALHOST, '127.0.0.1', '::1']
 LISTENER_PORT_RANGE = 50
+EPHEMERAL_PORT = 0
 COMPANIONS_EXES = ['CompanionsMicroServer64.exe', 'CompanionsServer64.exe']
+LAUNCH_TIMEOUT = 300
+SHUTDOWN_TIMEOUT = 5
+SPOOL_RETRY = (0.05, 2)
+IOV_MAX = 1024
+PERFORMATIVE_PRIORITIES = {'ping': 'control', 'reply': 'control',
+                           'error': 'control', 'sorry': 'control',
+                           'ready': 'control', 'achieve': 'achieve'}
 KQMLType = TypeVar('KQML_TYPE', KQMLList, KQMLToken, KQMLString)
 
 LOGGER = getLogger(__name__)
@@ -67,16 +104,29 @@ class CompanionsKQMLModule(KQMLModule):
     from the running companions agent (facilitator) and this agent.
 
     Attributes:
+        agent_host (AgentHost): host this agent is served by (sharing its
+            listener, executor and scheduler), None when the agent has its own
         debug (bool): helps set the debug level for the loggers accross modules
         dispatcher (KQMLDispatcher): Dispatcher to be used (from KQMLModule),
             calls on appropriate functions based on incoming messages,
             need to keep track of it for proper shutdown
+        dispatcher_class (type): dispatcher created for each accepted
+            connection
+        executor (ThreadPoolExecutor): workers running the dispatchers
+            (reading and parsing messages) for each accepted connection
         host (str): The host of Companions (localhost or an ip address)
+        in_flight (dict): futures of connections still being read and of
+            messages still being handled, mapped to their (dispatcher,
+            connection) pair, drained on exit
         listen_socket (socket): Socket object the listener will control,
-            receives incoming messages from Companions
+            receives incoming messages from Companions (None when hosted)
         listener (Thread): Thread running the socket listening loop, calls the
-            dispatcher as well.
+            dispatcher as well (None when hosted).
         listener_port (int): port number you want to host the listener on
+        metrics (MetricsRegistry): message counts, byte counts, handler and
+            send latencies, and queue depths for this agent
+        max_pending (int): most messages waiting for a handler worker before
+            new ones are turned away, None for no limit
         local_out (BufferedWriter): Connection to the listener socker server
            output, used to send messages on the listener port for Companions
            to pick up on.
@@ -89,10 +139,25 @@ class CompanionsKQMLModule(KQMLModule):
         out (BufferedWriter): Connection to the Companions KQML socket server,
             created from send_socket, used by send
         port (int): port number that Companions is hosted on
+        prefork (PreforkPool): worker processes handling asks and achieves,
+            None when not enabled
+        rate_limiter (RateLimiter): per sender limits on incoming messages,
+            None when not enabled
         ready (bool): Boolean that controls the threads looping, overwrites the
             ready function from KQMLModule
+        recorder (TrafficRecorder): recording of the messages received and
+            sent, None when not recording
+        scheduler (PriorityScheduler): workers running the handlers of read
+            messages, control messages first, then asks, then achieves
+        shutdown_event (Event): set on exit, wakes any thread waiting on it
+            (the listener loop and the Pythonian poller)
+        shutdown_timeout (float): seconds exit waits for in-flight messages
+        spool (OutboundSpool): on disk spool holding messages that could not be
+            sent while Companions was unreachable, None when not enabled
         reply_id_counter (int): From KQMLModule, used in send_with_continuation
             adds reply-with and the appropriate reply id
+        send_queue (OutboundQueue): queue drained by a background writer when
+            asynchronous sending is enabled, None (send blocks) otherwise
         send_socket (socket): Socket that will connect to Companions for
             sending messages. Need to keep track of it to properly close itself
             initializes to None and only has a socket after calling connect
@@ -100,14 +165,20 @@ class CompanionsKQMLModule(KQMLModule):
             updating running status in Companions
         state (str): the state this agent is in, used for updating running
             status in Companions
+        tracer (Tracer): per-message stage tracing, None when disabled
     """
 
     name = 'CompanionsKQMLModule'
 
     # pylint: disable=super-init-not-called
     #   We are rewriting the KQMLModule...
+    # pylint: disable=too-many-arguments
     def __init__(self, host: str = 'localhost', port: int = 9000,
-                 listener_port: int = 8950, debug: bool = False):
+                 listener_port: int = 8950, debug: bool = False,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT,
+                 reserved_workers: dict = None,
+                 shared_workers: int = DEFAULT_SHARED,
+                 agent_host: 'AgentHost' = None):
         """Override of KQMLModule init to add turn it into a KQML socket server
 
         Args:
@@ -115,10 +186,23 @@ class CompanionsKQMLModule(KQMLModule):
             port (int, optional): the port on the host to connect to
             listener_port (int, optional): the port this class will host its
                 KQML socket server from (the connection end that dispatches
-                requests as needed)
+                requests as needed), the first free port from there up is
+                used. EPHEMERAL_PORT (0) lets the operating system pick one,
+                the agent registers whichever port it got
             debug (bool, optional): Whether to set the level of the logger to
                 DEBUG or INFO - silencing debug errors and only showing needed
                 information.
+            shutdown_timeout (float, optional): seconds exit will wait for
+                in-flight messages to be handled (and replied to)
+            reserved_workers (dict, optional): handler workers reserved for
+                each priority class, see scheduling.DEFAULT_RESERVED
+            shared_workers (int, optional): handler workers taking work of
+                any priority class, most urgent first
+            agent_host (AgentHost, optional): host to be served by, the agent
+                then registers the host's listener port and shares its
+                listener, executor and scheduler (listener_port,
+                reserved_workers and shared_workers are ignored), see
+                AgentHost.add_agent
         """
         # OUTPUTS
         assert valid_ip(host), 'Host must be local or a valid ip address'
@@ -128,19 +212,55 @@ class CompanionsKQMLModule(KQMLModule):
         self.port = port
         self.send_socket = None
         self.out = None
+        self.send_queue = None
+        self.spool = None
+        self._spool_wakeup = Event()
+        self._replayer = None
         # INPUTS
-        assert valid_port(listener_port), \
-            'listener_port must be a valid port number (1024-65535)'
-        self.listener_port = listener_port
+        self.agent_host = agent_host
         self.dispatcher = None
-        self.listen_socket = socket()
-        self.listen_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        test_bind_in_range(self.listen_socket, self.listener_port)
-        self.listener_port = self.listen_socket.getsockname()[1]
-        self.listen_socket.listen(10)
+        if agent_host is None:
+            assert listener_port == EPHEMERAL_PORT or \
+                valid_port(listener_port), \
+                'listener_port must be a valid port number (1024-65535) ' \
+                'or EPHEMERAL_PORT'
+            self.listen_socket = socket()
+            self.listen_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.listener_port = bind_listener(self.listen_socket,
+                                               listener_port)
+            self.listen_socket.listen(10)
+            self.listen_socket.setblocking(False)
+            # writing to _wakeup_send breaks the listener out of select on exit
+            self._wakeup_receive, self._wakeup_send = socketpair()
+            self.executor = ThreadPoolExecutor(max_workers=5)
+        else:
+            self.listener_port = agent_host.listener_port
+            self.listen_socket = None
+            self.executor = agent_host.executor
         self.local_out = None
         self.ready = True
-        self.listener = Thread(target=self.listen, args=[])
+        self.shutdown_event = Event()
+        self.shutdown_timeout = shutdown_timeout
+        self.in_flight = {}
+        self._in_flight_lock = Lock()
+        self.metrics = MetricsRegistry()
+        self._running = self.metrics.gauge(
+            'kqml_dispatchers_running', 'connections being dispatched')
+        self._waiting = self.metrics.gauge(
+            'kqml_executor_queue_depth',
+            'accepted connections waiting for a worker')
+        if agent_host is None:
+            self.scheduler = PriorityScheduler(reserved_workers,
+                                               shared_workers, self.metrics)
+            self.listener = Thread(target=self.listen, args=[])
+        else:
+            self.scheduler = agent_host.scheduler
+            self.listener = None
+        self.tracer = None
+        self.recorder = None
+        self.rate_limiter = None
+        self.max_pending = None
+        self.prefork = None
         # FROM KQMLModule
         self.reply_id_counter = 1
         # UPDATES
@@ -154,10 +274,14 @@ class CompanionsKQMLModule(KQMLModule):
         else:
             LOGGER.setLevel(INFO)
         # REGISTER AND START LISTENING
-        LOGGER.info('Starting listener (KQML socket server) on port %s...',
-                    self.listener_port)
-        self.listener.start()
-        self.register()
+        if agent_host is None:
+            LOGGER.info('Starting listener (KQML socket server) on port '
+                        '%s...', self.listener_port)
+            self.listener.start()
+        else:
+            agent_host.attach(self)
+        if agent_host is None or agent_host.register_agents:
+            self.register()
 
     @classmethod
     # pylint: disable=too-many-arguments
@@ -166,7 +290,7 @@ class CompanionsKQMLModule(KQMLModule):
     # 1 extra for controlling the check for companions function...
     def init_check_companions(cls, host: str = None, port: int = None,
                               listener_port: int = None, debug: bool = None,
-                              verify_port: bool = False):
+                              verify_port: bool = False, **init_kwargs):
         """Helper method for constructing an agent, with a special helper
         function if you are running companions on the same machine as this
         agent (judged by connecting to localhost), without overwriting the
@@ -198,16 +322,18 @@ class CompanionsKQMLModule(KQMLModule):
                 either running companions locally or in an exe) against the pid
                 found on the running process where the portnum.dat file was
                 found
+            **init_kwargs: any other keyword arguments for init, e.g. the
+                profile mode and profile_directory of a Pythonian
 
         Returns:
             cls: instantiated cls object
         """
-        kwargs = {}  # repack arguments for a non-default interrupting call
+        kwargs = dict(init_kwargs)  # repack arguments for a non-default call
         if host:  # ignore values of None as they are added by parse cmd line
             kwargs['host'] = host
         if port:
             kwargs['port'] = port
-        if listener_port:
+        if listener_port is not None:
             kwargs['listener_port'] = listener_port
         if debug:
             kwargs['debug'] = debug
@@ -234,6 +360,7 @@ class CompanionsKQMLModule(KQMLModule):
         Args:
             argv (list, optional): argument list (typically from sys.argv)
         """
+        from argparse import ArgumentParser
         if not argv:
             argv = system_argument_list
         _, *args = argv  # ignore name of file...
@@ -242,8 +369,10 @@ class CompanionsKQMLModule(KQMLModule):
                             help='url where companions kqml server is hosted')
         parser.add_argument('-p', '--port', type=valid_port,
                             help='port companions kqml server is open on')
-        parser.add_argument('-l', '--listener_port', type=valid_port,
-                            help='port pythonian kqml server is open on')
+        parser.add_argument('-l', '--listener_port',
+                            type=valid_listener_port,
+                            help='port pythonian kqml server is open on, 0 '
+                                 'for one picked by the operating system')
         parser.add_argument('-d', '--debug', action='store_true',
                             help='whether or not to log debug messages')
         parser.add_argument('-v', '--verify_port', action='store_true',
@@ -253,11 +382,27 @@ class CompanionsKQMLModule(KQMLModule):
                                  'locally or in an exe) against the pid found '
                                  'on the running process where the portnum.dat'
                                  ' file was found')
+        from .profiling import PROFILING_MODES
+        parser.add_argument('--profile', choices=PROFILING_MODES,
+                            help='profile the ask and achieve functions of a '
+                                 'Pythonian agent per predicate from the '
+                                 'start (see Pythonian.enable_profiling)')
+        parser.add_argument('--profile_directory',
+                            help='let Companions start, stop and dump the '
+                                 'profiling of a Pythonian agent, into this '
+                                 'directory (see '
+                                 'Pythonian.enable_remote_profiling)')
         args = parser.parse_args(args)
+        init_kwargs = {}
+        if args.profile is not None:
+            init_kwargs['profile'] = args.profile
+        if args.profile_directory is not None:
+            init_kwargs['profile_directory'] = args.profile_directory
         return cls.init_check_companions(host=args.url, port=args.port,
                                          listener_port=args.listener_port,
                                          debug=args.debug,
-                                         verify_port=args.verify_port)
+                                         verify_port=args.verify_port,
+                                         **init_kwargs)
 
     # OUTPUT FUNCTIONS (OVERRIDES):
 
@@ -266,29 +411,274 @@ class CompanionsKQMLModule(KQMLModule):
         """Rewrite of KQMLModule connect, only handles send_socket and output
         connections"""
         try:
-            self.send_socket = socket()
-            self.send_socket.connect((self.host, self.port))
-            socket_write = SocketIO(self.send_socket, 'w')
-            self.out = BufferedWriter(socket_write)
+            self.send_socket, self.out = self.open_send_connection()
         except OSError as error_msg:
             LOGGER.critical('Connection failed: %s', error_msg)
         # Verify that you can send messages...
         assert self.out is not None, \
             'Connection formed but output (%s) not set.' % (self.out)
 
+    def open_send_connection(self):
+        """Opens a new connection to Companions. Unlike connect this leaves
+        send_socket and out alone, so concurrent senders don't share (and
+        close) each other's connections.
+
+        Returns:
+            Tuple[socket, BufferedWriter]: the connected socket and its output
+
+        Raises:
+            OSError: Companions could not be connected to
+        """
+        send_socket = self.open_send_socket()
+        return send_socket, BufferedWriter(SocketIO(send_socket, 'w'))
+
+    def open_send_socket(self) -> socket:
+        """Opens a new, unbuffered connection to Companions (see send_buffers)
+
+        Returns:
+            socket: the connected socket
+
+        Raises:
+            OSError: Companions could not be connected to
+        """
+        send_socket = socket()
+        try:
+            send_socket.connect((self.host, self.port))
+        except OSError:
+            send_socket.close()
+            raise
+        return send_socket
+
     def send(self, msg: KQMLPerformative):
         """Override of send from KQMLModule, opens and closes socket around
-        send for proper signaling to Companions
+        send for proper signaling to Companions. If asynchronous sending is
+        enabled the message is queued instead and sent by the writer thread.
 
         Args:
             msg (KQMLPerformative): message that you are sending to Companions
         """
-        self.connect()
-        self.send_generic(msg, self.out)
-        self.send_socket.shutdown(SHUT_RDWR)
-        self.send_socket.close()
-        self.send_socket = None
-        self.out = None
+        if self.send_queue is not None:
+            self.send_queue.put(msg)
+            return
+        tracer = self.tracer
+        if tracer is None or current_trace() is not NULL_TRACE:
+            self.send_batch([msg])  # part of handling a message, if any
+            return
+        # sent outside of handling a message (e.g. an insert), own trace
+        with tracer.start(performative=str(msg.head()).lower()).active():
+            self.send_batch([msg])
+
+    def send_batch(self, msgs: List[KQMLPerformative]):
+        """Sends messages one after another on a single connection, which is
+        closed afterwards so Companions knows the messages are over. With the
+        spool enabled, messages that can't be sent (or that would overtake
+        messages already spooled) are appended to the spool instead.
+
+        Args:
+            msgs (List[KQMLPerformative]): messages to send
+
+        Raises:
+            OSError: Companions could not be reached (and there is no spool)
+        """
+        start = perf_counter()
+        with current_trace().span('serialize'):
+            payloads = encode_messages(msgs)
+        recorder = self.recorder
+        if recorder is not None:
+            for payload in payloads:
+                recorder.outgoing(payload)
+        spool = self.spool
+        if spool is not None and spool:  # keep order behind the backlog
+            self._spool_payloads(payloads)
+            return
+        try:
+            self.send_encoded(payloads)
+        except OSError:
+            if spool is None:
+                raise
+            self._spool_payloads(payloads)
+            return
+        elapsed = (perf_counter() - start) / len(msgs)
+        for msg, payload in zip(msgs, payloads):
+            self._count_sent(msg, len(payload), elapsed)
+
+    def send_encoded(self, payloads: List[bytes]):
+        """Writes already encoded messages on a single new connection to
+        Companions (all of them with one vectored write), then closes it.
+
+        Args:
+            payloads (List[bytes]): encoded messages (see encode_message)
+
+        Raises:
+            OSError: Companions could not be connected to, or the connection
+                failed while writing
+        """
+        trace = current_trace()
+        with trace.span('connect'):
+            try:
+                send_socket = self.open_send_socket()
+            except OSError as error_msg:
+                LOGGER.critical('Connection failed: %s', error_msg)
+                raise
+        try:
+            with trace.span('write'):
+                send_buffers(send_socket, payloads)
+            send_socket.shutdown(SHUT_RDWR)
+        finally:
+            send_socket.close()
+
+    def enable_spool(self, directory: str, max_bytes: int = 2 ** 30,
+                     segment_bytes: int = 16 * 2 ** 20,
+                     overflow: str = 'drop_newest',
+                     sync: bool = False) -> 'OutboundSpool':
+        """Keeps messages that can't be sent (Companions is down or
+        restarting) in an on disk spool instead of raising, and replays them
+        in order from a background thread once Companions is reachable again.
+        Anything left in the spool directory by a previous run is replayed
+        too.
+
+        Args:
+            directory (str): directory for the spool's segment files
+            max_bytes (int, optional): most bytes kept on disk
+            segment_bytes (int, optional): size of each segment file
+            overflow (str, optional): what to do when the spool is full, see
+                spool.OVERFLOW_POLICIES
+            sync (bool, optional): fsync every append (survives power loss,
+                at the cost of throughput while spooling)
+
+        Returns:
+            OutboundSpool: the spool in use
+        """
+        if self.spool is None:
+            from .spool import OutboundSpool
+            spool = OutboundSpool(directory, segment_bytes, max_bytes,
+                                  overflow, sync)
+            self.metrics.gauge('kqml_spool_records',
+                               'messages waiting in the spool', spool.__len__)
+            self.metrics.gauge('kqml_spool_bytes',
+                               'bytes of spool segments on disk',
+                               lambda: spool.size)
+            self.spool = spool
+            self._spool_wakeup.set()  # replay whatever was left last time
+            self._replayer = Thread(target=self._replay_spool, args=[spool],
+                                    daemon=True)
+            self._replayer.start()
+        return self.spool
+
+    def disable_spool(self, timeout: float = None):
+        """Stops replaying and closes the spool. Messages still in it stay on
+        disk and are replayed the next time the spool is enabled.
+
+        Args:
+            timeout (float, optional): most seconds to wait for the replay
+                thread to stop
+        """
+        spool, self.spool = self.spool, None
+        if spool is None:
+            return
+        self._spool_wakeup.set()
+        self._replayer.join(timeout)
+        spool.close()
+        if spool:
+            LOGGER.warning('Leaving %s message(s) in the spool at %s',
+                           len(spool), spool.directory)
+
+    def _spool_payloads(self, payloads: List[bytes]):
+        spooled = self.spool.append(payloads)
+        self.metrics.counter('kqml_spooled_total',
+                             'messages spooled while Companions was '
+                             'unreachable').inc(spooled)
+        if spooled < len(payloads):
+            self.metrics.counter('kqml_spool_dropped_total',
+                                 'messages dropped because the spool was full'
+                                 ).inc(len(payloads) - spooled)
+        self._spool_wakeup.set()
+
+    def _replay_spool(self, spool: 'OutboundSpool'):
+        """Sends spooled messages oldest first, one per connection like send,
+        backing off while Companions stays unreachable"""
+        replayed = self.metrics.counter('kqml_spool_replayed_total',
+                                        'spooled messages sent')
+        retry = SPOOL_RETRY[0]
+        while self.spool is spool and not self.shutdown_event.is_set():
+            self._spool_wakeup.clear()
+            payloads = spool.peek(100)
+            if not payloads:
+                self._spool_wakeup.wait()
+                continue
+            sent = 0
+            try:
+                for payload in payloads:
+                    self.send_encoded([payload])
+                    sent += 1
+            except OSError:
+                self.shutdown_event.wait(retry)
+                retry = min(retry * 2, SPOOL_RETRY[1])
+            else:
+                retry = SPOOL_RETRY[0]
+            finally:
+                spool.commit(sent)
+                replayed.inc(sent)
+
+    def enable_async_send(self, max_size: int = 10000, max_batch: int = 1,
+                          policy: str = 'block',
+                          block_timeout: float = None) -> OutboundQueue:
+        """Makes send non-blocking, messages are put on a bounded queue and
+        sent by a background writer thread in the order they were sent.
+
+        Args:
+            max_size (int, optional): most messages waiting to be sent
+            max_batch (int, optional): most messages sent on one connection,
+                only raise this if your facilitator reads several messages
+                per connection
+            policy (str, optional): what to do when the queue is full, see
+                outbound.BACKPRESSURE_POLICIES
+            block_timeout (float, optional): seconds a send waits for room
+                under the 'block' policy before raising SendQueueFull
+
+        Returns:
+            OutboundQueue: the queue in use
+        """
+        if self.send_queue is None:
+            self.send_queue = OutboundQueue(self.send_batch, self.metrics,
+                                            max_size, max_batch, policy,
+                                            block_timeout)
+        return self.send_queue
+
+    def disable_async_send(self, timeout: float = None) -> bool:
+        """Flushes the send queue (for up to timeout seconds), stops the
+        writer, and goes back to sending on the calling thread.
+
+        Args:
+            timeout (float, optional): most seconds to wait for the flush
+
+        Returns:
+            bool: True if every queued message was sent
+        """
+        send_queue, self.send_queue = self.send_queue, None
+        return True if send_queue is None else send_queue.close(timeout)
+
+    def flush_sends(self, timeout: float = None) -> bool:
+        """Waits until every message sent so far has left the send queue
+        (a no-op if asynchronous sending is not enabled).
+
+        Args:
+            timeout (float, optional): most seconds to wait
+
+        Returns:
+            bool: True if everything was flushed, False on timeout
+        """
+        send_queue = self.send_queue
+        return True if send_queue is None else send_queue.flush(timeout)
+
+    def _count_sent(self, msg: KQMLPerformative, sent: int, seconds: float):
+        verb = str(msg.head()).lower()
+        self.metrics.counter('kqml_messages_sent_total', 'messages sent',
+                             performative=verb).inc()
+        self.metrics.counter('kqml_bytes_sent_total', 'bytes sent').inc(sent)
+        self.metrics.histogram('kqml_send_seconds',
+                               'connect, write and close time per message',
+                               performative=verb).observe(seconds)
 
     def send_on_local_port(self, msg: KQMLPerformative):
         """Sends a message on the local_out, i.e. sends a message on the
@@ -298,7 +688,12 @@ class CompanionsKQMLModule(KQMLModule):
         Args:
             msg (KQMLPerformative): message to be sent
         """
-        self.send_generic(msg, self.local_out)
+        start = perf_counter()
+        sent = self.send_generic(msg, self.local_out)
+        self._count_sent(msg, sent, perf_counter() - start)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.outgoing(encode_message(msg))
 
     def reply_on_local_port(self, msg: KQMLPerformative,
                             reply_msg: KQMLPerformative):
@@ -317,7 +712,7 @@ class CompanionsKQMLModule(KQMLModule):
         self.send_on_local_port(reply_msg)
 
     @staticmethod
-    def send_generic(msg: KQMLPerformative, out: BufferedWriter):
+    def send_generic(msg: KQMLPerformative, out: BufferedWriter) -> int:
         """Basic send mechanism copied (more or less) from pykqml. Writes the
         msg as a string to the output buffer then flushes it.
 
@@ -325,14 +720,21 @@ class CompanionsKQMLModule(KQMLModule):
             msg (KQMLPerformative): Message to be sent
             out (BufferedWriter): The output to write to, needed for sending to
                 Companions and sending on our own port.
+
+        Returns:
+            int: number of bytes written
         """
-        LOGGER.debug('Sending: %s', msg)
-        try:
-            msg.write(out)
-        except IOError:
-            LOGGER.error('IOError during message sending')
-        out.write(b'\n')
-        out.flush()
+        trace = current_trace()
+        with trace.span('serialize'):
+            data = encode_message(msg)
+        with trace.span('write'):
+            try:
+                written = out.write(data)
+            except IOError:
+                LOGGER.error('IOError during message sending')
+                written = 0
+            out.flush()
+        return written
 
     # INPUT FUNCTIONS (OVERRIDE AND ADDITION):
 
@@ -346,27 +748,210 @@ class CompanionsKQMLModule(KQMLModule):
         thread the dispatching so the functions that get called are run in a
         separate Thread. We're using ThreadPoolExecutor because sockets use io,
         io is blocking and threads allow you to not block.
+
+        Rather than blocking in accept (which only returns when someone
+        connects) we select on the listen socket and a wakeup socket, exit
+        writes to the wakeup socket so the loop ends immediately.
         """
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        with DefaultSelector() as selector:
+            selector.register(self.listen_socket, EVENT_READ)
+            selector.register(self._wakeup_receive, EVENT_READ)
             while self.ready:
-                connection, _ = self.listen_socket.accept()
-                LOGGER.debug('Received connection: %s', connection)
-                socket_write = SocketIO(connection, 'w')
-                self.local_out = BufferedWriter(socket_write)
-                socket_read = SocketIO(connection, 'r')
-                read_input = KQMLReader(BufferedReader(socket_read))
-                self.dispatcher = KQMLDispatcher(self, read_input, self.name)
-                LOGGER.debug('Starting dispatcher: %s', self.dispatcher)
-                executor.submit(self.dispatcher.start)
-                self.state = 'dispatching'
+                for key, _ in selector.select():
+                    if key.fileobj is self.listen_socket and self.ready:
+                        self.accept_connection()
+
+    def accept_connection(self):
+        """Accepts a pending connection on the listen socket and submits a
+        dispatcher for it to the executor, tracking it as in flight until the
+        connection has been fully handled."""
+        try:
+            connection, _ = self.listen_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return  # the peer gave up before we got to it
+        connection.setblocking(True)
+        LOGGER.debug('Received connection: %s', connection)
+        socket_write = SocketIO(connection, 'w')
+        self.local_out = BufferedWriter(socket_write)
+        socket_read = SocketIO(connection, 'r')
+        read_input = KQMLReader(BufferedReader(socket_read))
+        self.dispatcher = self.dispatcher_class(self, read_input, self.name,
+                                                connection)
+        LOGGER.debug('Starting dispatcher: %s', self.dispatcher)
+        self._waiting.inc()
+        self._track(self.dispatcher, self.executor.submit(
+            self.serve_connection, self.dispatcher, connection))
+        self.state = 'dispatching'
+
+    def serve_connection(self, dispatcher: KQMLDispatcher,
+                         connection: socket):
+        """Runs a dispatcher until the connection is done (eof). The
+        connection is closed once every message read from it has also been
+        handled (see CompanionsKQMLDispatcher.release).
+
+        Args:
+            dispatcher (KQMLDispatcher): dispatcher reading from connection
+            connection (socket): accepted connection from Companions
+        """
+        self._waiting.dec()
+        self._running.inc()
+        try:
+            dispatcher.start()
+        finally:
+            self._running.dec()
+
+    def priority_of(self, msg: KQMLPerformative) -> str:
+        """Priority class a message is handled under, looked up by
+        performative in PERFORMATIVE_PRIORITIES (asks by default). Control
+        messages are handled straight away on the thread that read them.
+
+        Args:
+            msg (KQMLPerformative): message read from Companions
+
+        Returns:
+            str: one of scheduling.PRIORITY_CLASSES
+        """
+        return PERFORMATIVE_PRIORITIES.get(str(msg.head()).lower(), 'ask')
+
+    def enable_prefork(self, factory: Callable[..., 'CompanionsKQMLModule'],
+                       workers: int = None, **kwargs) -> 'PreforkPool':
+        """Hands asks and achieves to worker processes, each running its own
+        copy of this agent built by factory, so CPU heavy handlers use more
+        than one core. This agent keeps the listener and registration and
+        handles every other message itself (see prefork.py), including the
+        subscriptions: update_subscription calls made by the workers'
+        handlers are relayed here, so their data has to be picklable.
+
+        Args:
+            factory (Callable[..., CompanionsKQMLModule]): picklable callable
+                (e.g. this agent's class) building a worker's agent, with its
+                asks and achieves added, from keyword arguments
+            workers (int, optional): worker processes, defaults to the
+                number of cores
+            **kwargs: keyword arguments for factory, host, port, debug and
+                shutdown_timeout default to this agent's; reserved_workers
+                and shared_workers size each worker's scheduler
+
+        Returns:
+            PreforkPool: the workers in use
+        """
+        if self.prefork is None:
+            from os import cpu_count
+            from .prefork import PreforkPool
+            kwargs.setdefault('host', self.host)
+            kwargs.setdefault('port', self.port)
+            kwargs.setdefault('debug', self.debug)
+            kwargs.setdefault('shutdown_timeout', self.shutdown_timeout)
+            kwargs['listener_port'] = self.listener_port
+            self.prefork = PreforkPool(factory, workers or cpu_count() or 1,
+                                       kwargs, self.metrics,
+                                       getattr(self, 'update_subscription',
+                                               None))
+        return self.prefork
+
+    def disable_prefork(self, timeout: float = None):
+        """Goes back to handling asks and achieves in this process, once the
+        workers have handled what they were given (for up to timeout
+        seconds)
+
+        Args:
+            timeout (float, optional): most seconds to wait for the workers
+        """
+        prefork, self.prefork = self.prefork, None
+        if prefork is not None:
+            prefork.close(timeout)
+
+    def enable_rate_limiting(self, default: Limit = None,
+                             senders: Dict[str, Limit] = None,
+                             performatives: Dict[str, Limit] = None,
+                             max_pending: int = None) -> RateLimiter:
+        """Turns away incoming messages (with an error reply) from senders
+        going over their limits, and any message arriving while max_pending
+        messages are already waiting for a worker. Control messages (pings)
+        are never turned away.
+
+        Args:
+            default (Limit, optional): (rate, burst) for every sender without
+                a limit of its own
+            senders (Dict[str, Limit], optional): (rate, burst) by sender
+            performatives (Dict[str, Limit], optional): (rate, burst) by
+                performative, e.g. {'ask-one': (50, 100)}, for each sender
+            max_pending (int, optional): most messages waiting for a worker
+
+        Returns:
+            RateLimiter: the limiter in use
+        """
+        self.rate_limiter = RateLimiter(default, senders, performatives)
+        self.max_pending = max_pending
+        return self.rate_limiter
+
+    def disable_rate_limiting(self):
+        """Stops turning away messages"""
+        self.rate_limiter = None
+        self.max_pending = None
+
+    def admit(self, msg: KQMLPerformative, verb: str) -> bool:
+        """Checks an incoming message against the rate limits and the pending
+        message cap, replying with an error if it is turned away
+
+        Args:
+            msg (KQMLPerformative): message read from Companions
+            verb (str): its performative, lower case
+
+        Returns:
+            bool: True if the message should be handled
+        """
+        limiter = self.rate_limiter
+        if limiter is not None:
+            sender = str(msg.get('sender') or 'unknown')
+            if not limiter.allow(sender, verb):
+                self.metrics.counter('kqml_throttled_total',
+                                     'messages turned away for going over '
+                                     'a rate limit',
+                                     sender=limiter.sender_label(sender),
+                                     performative=verb).inc()
+                self.error_reply(msg, f'rate limit exceeded for {sender}')
+                return False
+        max_pending = self.max_pending
+        if max_pending is not None and len(self.scheduler) >= max_pending:
+            self.metrics.counter('kqml_overload_rejections_total',
+                                 'messages turned away because too many '
+                                 'were waiting', performative=verb).inc()
+            self.error_reply(msg, 'too many pending messages, try later')
+            return False
+        return True
+
+    def schedule(self, dispatcher: KQMLDispatcher, priority: str,
+                 function, *args):
+        """Runs function(*args) on the scheduler under priority, keeping the
+        dispatcher's connection open (and the work in flight) until it's done
+
+        Args:
+            dispatcher (KQMLDispatcher): dispatcher the message was read by
+            priority (str): one of scheduling.PRIORITY_CLASSES
+            function (Callable): handler to run
+            *args: arguments for function
+        """
+        self._track(dispatcher, self.scheduler.submit(priority, function,
+                                                      *args))
+
+    def _track(self, dispatcher: KQMLDispatcher, future):
+        dispatcher.hold()
+        with self._in_flight_lock:
+            self.in_flight[future] = (dispatcher, dispatcher.connection)
+        future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        with self._in_flight_lock:
+            dispatcher, _ = self.in_flight.pop(future)
+        dispatcher.release()
 
     def receive_eof(self):
-        """Override of KQMLModule, shuts down the dispatcher after receiving
-        the end of file (eof) signal. This happens after every message...
+        """Override of KQMLModule, called by the dispatcher after receiving
+        the end of file (eof) signal. This happens after every message, the
+        connection itself is closed by serve_connection.
         """
-        LOGGER.debug('Closing connection on dispatcher: %s', self.dispatcher)
-        self.dispatcher.shutdown()
-        self.dispatcher = None
+        LOGGER.debug('Connection closed on dispatcher: %s', self.dispatcher)
         self.state = 'idle'
 
     # OVERRIDES TO KQMLModule:
@@ -377,25 +962,65 @@ class CompanionsKQMLModule(KQMLModule):
     def connect1(self):
         pass
 
-    def exit(self, n: int = 0):
+    def exit(self, n: int = 0, timeout: float = None):
         """Override of KQMLModule; Closes this agent, shuts down the threaded
-        execution loop (by turning off the ready flag), shuts the dispatcher
-        down (if running), and then joins any running threads...
+        execution loop (by turning off the ready flag and waking the listener),
+        drains connections that are still being handled for up to timeout
+        seconds, then shuts down whatever dispatchers are left and closes the
+        sockets. A hosted agent only stops being routed to and drains its own
+        messages, the host's listener, executor and scheduler keep running.
 
         Args:
             n (int, optional): the value to pass along to sys.exit
+            timeout (float, optional): seconds to wait for in-flight messages
+                to finish, defaults to shutdown_timeout
         """
         LOGGER.info('Shutting down agent: %s', self.name)
-        self.ready = False  # may need to wait for threads to stop...
-        if self.dispatcher is not None:
-            self.dispatcher.shutdown()
-        self.listener.join()
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        self.ready = False
+        self.shutdown_event.set()
+        if self.agent_host is None:
+            self._wakeup_send.send(b'\0')
+            self.listener.join()
+        else:
+            self.agent_host.detach(self)
+        while True:  # handling a message read meanwhile adds more work
+            with self._in_flight_lock:
+                pending = dict(self.in_flight)
+            _, not_done = wait_futures(pending,
+                                       timeout=max(deadline - monotonic(), 0))
+            if not_done or not pending:
+                break
+        if not_done:
+            LOGGER.warning('Abandoning %s in-flight connection(s) after %ss',
+                           len(not_done), timeout)
+        for future in not_done:
+            _, connection = pending[future]
+            if future.cancel():  # never started, its release closes it
+                continue
+            try:  # running, reads now see eof and the last release closes it
+                connection.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+        self.disable_prefork(max(deadline - monotonic(), 0))
+        self.disable_async_send(max(deadline - monotonic(), 0))
+        self.disable_spool(max(deadline - monotonic(), 0))
+        self.disable_recording()
+        if self.agent_host is not None:
+            return
+        self.executor.shutdown(wait=False)
+        self.scheduler.shutdown(wait=False)
+        self.listen_socket.close()
+        self._wakeup_receive.close()
+        self._wakeup_send.close()
 
     # COMPANIONS SPECIFIC OVERRIDES:
 
     def register(self):
         """Override of KQMLModule, registers this agent with Companions"""
-        LOGGER.info('Registering to facilitator at port %s...', self.port)
+        LOGGER.info('Registering to facilitator at port %s (listening on '
+                    'port %s)...', self.port, self.listener_port)
         registration = (
             f'(register :sender {self.name} :receiver facilitator :content '
             f'("socket://{self.host}:{self.listener_port}" nil nil '
@@ -424,11 +1049,93 @@ class CompanionsKQMLModule(KQMLModule):
             self.error_reply(msg, f'unexpected performative: {msg}')
 
     def error_reply(self, msg, comment):
+        self.metrics.counter('kqml_error_replies_total',
+                             'error replies sent').inc()
         reply_msg = KQMLPerformative('error')
         reply_msg.sets('sender', self.name)
         reply_msg.sets('content', comment)
         self.reply(msg, reply_msg)
 
+    def enable_tracing(self, *hooks: TraceHook,
+                       sample_rate: float = 1.0) -> Tracer:
+        """Starts tracing a sample of incoming messages (and messages sent
+        outside of handling one), passing the timed stages to hooks
+
+        Args:
+            *hooks (TraceHook): receivers of the finished traces, e.g.
+                RingBufferRecorder or JsonLinesRecorder
+            sample_rate (float, optional): fraction of messages to trace
+
+        Returns:
+            Tracer: the tracer now in use
+        """
+        self.tracer = Tracer(*hooks, sample_rate=sample_rate)
+        return self.tracer
+
+    def disable_tracing(self):
+        """Stops tracing and closes the hooks of the previous tracer"""
+        tracer, self.tracer = self.tracer, None
+        if tracer is not None:
+            tracer.close()
+
+    def enable_recording(self, path: str,
+                         compress: bool = None) -> 'TrafficRecorder':
+        """Records every message received and sent, with the time, to a
+        file that can be replayed against an agent to load test it (see
+        replay.py)
+
+        Args:
+            path (str): file to record to, replaced if it exists
+            compress (bool, optional): gzip the recording, defaults to True
+                for paths ending in .gz
+
+        Returns:
+            TrafficRecorder: the recorder in use
+        """
+        from .replay import TrafficRecorder
+        self.disable_recording()
+        self.recorder = TrafficRecorder(path, compress, self.metrics)
+        return self.recorder
+
+    def disable_recording(self):
+        """Stops recording and closes the recording"""
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def start_trace(self, **attributes):
+        """Starts a trace if tracing is enabled (and the message sampled)
+
+        Args:
+            **attributes: attributes attached to every span of the trace
+
+        Returns:
+            Trace, UNSAMPLED_TRACE or NULL_TRACE (tracing is off)
+        """
+        tracer = self.tracer
+        return NULL_TRACE if tracer is None else tracer.start(**attributes)
+
+    def export_metrics(self, path: str = None, port: int = None,
+                       interval: float = 10) -> Optional[int]:
+        """Publishes self.metrics in the Prometheus text format until exit,
+        either rewritten to a file every interval seconds, served on a local
+        port, or both.
+
+        Args:
+            path (str, optional): file to keep the metrics text in
+            port (int, optional): localhost port to serve the metrics text on,
+                0 picks a free port
+            interval (float, optional): seconds between file rewrites
+
+        Returns:
+            Optional[int]: the port being served on (if serving)
+        """
+        if path is not None:
+            self.metrics.export_to_file(path, interval, self.shutdown_event)
+        if port is not None:
+            return self.metrics.serve(port, self.shutdown_event)
+        return None
+
     # Everything else (reply, handle_exceptions, send_with_continuation,
     #   subscribe_request, subscribe_tell, and ALL the remaining receive_*
     #    functions) is fine as is...
@@ -445,6 +1152,7 @@ class CompanionsKQMLModule(KQMLModule):
                  where years, months, days, etc are the uptime in number of
                  years, months, days, etc.
         """
+        from dateutil.relativedelta import relativedelta
         time_list = ['years', 'months', 'days', 'hours', 'minutes', 'seconds']
         diff = relativedelta(datetime.now(), self.starttime)
         time_diffs = [getattr(diff, time_period) for time_period in time_list]
@@ -473,6 +1181,104 @@ class CompanionsKQMLModule(KQMLModule):
                 otherwise False
         """
         LOGGER.debug('Responding to query: %s, %s, %s', msg, content, results)
+        with current_trace().span('encode'):
+            reply_msg = self._query_reply(content, results, response_type)
+        self.reply(msg, reply_msg)
+
+    def reply_to_all(self, msgs: List[KQMLPerformative],
+                     reply_msg: KQMLPerformative):
+        """Sends the same reply to several messages, serializing reply_msg
+        once and only adding each message's :receiver and :in-reply-to to it
+        (reply, in contrast, serializes the whole reply for every message)
+
+        Args:
+            msgs (List[KQMLPerformative]): messages to reply to
+            reply_msg (KQMLPerformative): reply, without receiver or
+                in-reply-to
+        """
+        # leave the closing paren open for the receiver and in-reply-to
+        self.reply_encoded(msgs, str(reply_msg.head()),
+                           reply_msg.to_string()[:-1])
+
+    def reply_encoded(self, msgs: List[KQMLPerformative], verb: str,
+                      body: str):
+        """Replies to each message with an already serialized performative
+
+        Args:
+            msgs (List[KQMLPerformative]): messages to reply to
+            verb (str): performative of the reply, e.g. tell
+            body (str): the reply without its closing paren, e.g.
+                '(tell :sender agent :content (a b)'
+        """
+        for msg in msgs:
+            header = ''
+            sender = msg.get('sender')
+            if sender is not None:
+                header += f' :receiver {sender.to_string()}'
+            reply_with = msg.get('reply-with')
+            if reply_with is not None:
+                header += f' :in-reply-to {reply_with.to_string()}'
+            self.send(EncodedPerformative(verb, f'{body}{header})'.encode()))
+
+    def answers_to_query(self, msg: KQMLPerformative,
+                         content: KQMLPerformative, answers: Iterable,
+                         response_type: str):
+        """Replies to an ask-all with a single tell holding every answer.
+        The answers are encoded one at a time as they are taken from the
+        iterable (a generator is never turned into a list).
+
+        Arguments:
+            msg (KQMLPerformative): the message being passed along to reply
+            content (KQMLPerformative): query, starts with a predicate and the
+                remainder is the arguments
+            answers (Iterable): the answers, each one handled like the
+                results of an ask-one in response_to_query
+            response_type (str): the given response type, pattern (default)
+                or bind
+        """
+        text = StringIO()
+        text.write(f'(tell :sender {self.name} :content (')
+        with current_trace().span('encode'):
+            for index, answer in enumerate(answers):
+                if index:
+                    text.write(' ')
+                text.write(self._query_content(content, answer,
+                                               response_type).to_string())
+        text.write(')')
+        self.reply_encoded([msg], 'tell', text.getvalue())
+
+    def stream_answers_to_query(self, msg: KQMLPerformative,
+                                content: KQMLPerformative, answers: Iterable,
+                                response_type: str):
+        """Replies to a stream-all with a tell per answer, sent as soon as
+        the answer is produced, followed by an eos.
+
+        Arguments:
+            msg (KQMLPerformative): the message being passed along to reply
+            content (KQMLPerformative): query, starts with a predicate and the
+                remainder is the arguments
+            answers (Iterable): the answers, each one handled like the
+                results of an ask-one in response_to_query
+            response_type (str): the given response type, pattern (default)
+                or bind
+        """
+        for answer in answers:
+            with current_trace().span('encode'):
+                answer = self._query_content(content, answer, response_type)
+            self.reply_encoded(
+                [msg], 'tell', f'(tell :sender {self.name} :content {answer}')
+        self.reply_encoded([msg], 'eos', f'(eos :sender {self.name}')
+
+    def _query_reply(self, content: KQMLPerformative, results: Any,
+                     response_type: str) -> KQMLPerformative:
+        reply_content = self._query_content(content, results, response_type)
+        # no need to wrap reply_content in parens, KQMLList will do that for us
+        reply_msg = f'(tell :sender {self.name} :content {reply_content})'
+        return performative(reply_msg)
+
+    @staticmethod
+    def _query_content(content: KQMLPerformative, results: Any,
+                       response_type: str) -> KQMLList:
         response_type = response_type is None or response_type == ':pattern'
         reply_content = KQMLList(content.head())
         results_list = results if isinstance(results, list) else [results]
@@ -492,9 +1298,170 @@ class CompanionsKQMLModule(KQMLModule):
             # if not a variable, replace in the pattern. Ignore for bind
             elif response_type:
                 reply_content.append(each)
-        # no need to wrap reply_content in parens, KQMLList will do that for us
-        reply_msg = f'(tell :sender {self.name} :content {reply_content})'
-        self.reply(msg, performative(reply_msg))
+        return reply_content
+
+
+class EncodedPerformative():
+    """An already serialized performative. Goes through send (and the send
+    queue, spool, metrics and tracing) like a KQMLPerformative but is written
+    out as is.
+
+    Attributes:
+        data (bytes): the serialized performative, without the newline
+        verb (str): the performative, e.g. tell
+    """
+
+    __slots__ = ('verb', 'data')
+
+    def __init__(self, verb: str, data: bytes):
+        self.verb = verb
+        self.data = data
+
+    def __str__(self):
+        return self.data.decode()
+
+    def head(self) -> str:
+        """The performative, like KQMLPerformative.head
+
+        Returns:
+            str: the performative
+        """
+        return self.verb
+
+    def write(self, out):
+        """Writes the serialized performative, like KQMLPerformative.write
+
+        Args:
+            out (BinaryIO): output to write to
+        """
+        out.write(self.data)
+
+
+class CompanionsKQMLDispatcher(KQMLDispatcher):
+    """KQMLDispatcher that hands each message it reads to the receiving
+    module's scheduler under the message's priority class (control messages
+    are handled right away), records per performative message counts, bytes
+    received, handler latencies and handler exceptions in the module's
+    metrics, and traces the parse and dispatch of each message when the
+    module has tracing enabled.
+
+    Attributes:
+        connection (socket): connection being read, closed (and the
+            dispatcher shut down) when the last hold on it is released
+    """
+
+    def __init__(self, rec, inp, agent_name, connection: socket = None):
+        super().__init__(rec, inp, agent_name)
+        self.connection = connection
+        self._holds = 0
+        self._holds_lock = Lock()
+
+    def hold(self):
+        """Keeps the connection open until a matching release (held while
+        it is being read and while each message from it is handled)"""
+        with self._holds_lock:
+            self._holds += 1
+
+    def release(self):
+        """Drops a hold, the last one shuts the dispatcher down and closes
+        the connection"""
+        with self._holds_lock:
+            self._holds -= 1
+            if self._holds:
+                return
+        self.shutdown()
+        if self.connection is not None:
+            self.connection.close()
+
+    def start(self):
+        """Same read/dispatch loop as KQMLDispatcher.start, with a trace
+        started (if sampled) for each message read."""
+        try:
+            while True:
+                trace = self.receiver.start_trace()
+                with trace.span('parse'):
+                    msg = self.reader.read_performative()
+                self.dispatch_message(msg, trace)
+        # This signal allows the dispatcher to stop blocking and return without
+        # closing the connection to the socket and exiting
+        except StopWaitingSignal:
+            return
+        except KeyboardInterrupt:
+            LOGGER.info('Keyboard interrupt received')
+            self.receiver.receive_eof()
+        except EOFError:
+            LOGGER.debug('EOF received')
+            self.receiver.receive_eof()
+        except IOError as ex:
+            if not self.shutdown_initiated:
+                self.receiver.handle_exception(ex)
+        except ValueError as ex:
+            LOGGER.exception('Value error during reading: %s', ex)
+
+    def dispatch_message(self, msg: KQMLPerformative, trace=NULL_TRACE):
+        """Counts a message and hands it to the handler for its priority
+        class, on this thread for control messages and on the receiver's
+        scheduler otherwise
+
+        Args:
+            msg (KQMLPerformative): message read from the connection
+            trace (Trace, optional): trace of the message
+        """
+        metrics = self.receiver.metrics
+        verb = str(msg.head()).lower()
+        metrics.counter('kqml_messages_received_total', 'messages received',
+                        performative=verb).inc()
+        data = self.reader.inbuf.encode()
+        metrics.counter('kqml_bytes_received_total',
+                        'bytes received').inc(len(data))
+        recorder = self.receiver.recorder
+        if recorder is not None:
+            recorder.incoming(data)
+        trace.annotate(performative=verb)
+        priority = self.receiver.priority_of(msg)
+        if priority == 'control':
+            self.handle_message(msg, trace)
+            return
+        if not self.receiver.admit(msg, verb):
+            return
+        prefork = self.receiver.prefork
+        if prefork is not None and prefork.forward(msg, verb,
+                                                   self.connection):
+            return
+        try:
+            self.receiver.schedule(self, priority, self.handle_message, msg,
+                                   trace)
+        except RuntimeError:  # the scheduler has shut down (exit)
+            LOGGER.warning('Dropping %s received while shutting down', verb)
+
+    def handle_message(self, msg: KQMLPerformative, trace=NULL_TRACE):
+        """Times the dispatch of a message (the receive_* handler it calls)
+
+        Args:
+            msg (KQMLPerformative): message read from the connection
+            trace (Trace, optional): trace of the message, made current while
+                handling it and finished afterwards
+        """
+        metrics = self.receiver.metrics
+        verb = str(msg.head()).lower()
+        start = perf_counter()
+        try:
+            with trace.active(), trace.span('dispatch'):
+                super().dispatch_message(msg)
+        except Exception:
+            metrics.counter('kqml_handler_exceptions_total',
+                            'uncaught exceptions in receive_* handlers',
+                            performative=verb).inc()
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            metrics.histogram('kqml_handler_seconds',
+                              'time spent in receive_* handlers',
+                              performative=verb).observe(elapsed)
+
+
+# defined after the module, which creates one for each accepted connection
+CompanionsKQMLModule.dispatcher_class = CompanionsKQMLDispatcher
 
 
 ###############################################################################
@@ -511,7 +1478,8 @@ class ControlledCompanionsKQMLModule(CompanionsKQMLModule):
 
     # TODO: need default for exe_path
     def __init__(self, exe_path: str, exe_name: str = COMPANIONS_EXES[0],
-                 verify_port: bool = True, **kwargs):
+                 verify_port: bool = True,
+                 launch_timeout: float = LAUNCH_TIMEOUT, **kwargs):
         """Launches a companions exe and uses that for connecting to Companions
 
         Args:
@@ -520,8 +1488,13 @@ class ControlledCompanionsKQMLModule(CompanionsKQMLModule):
             verify_port (bool, optional): Whether or not to verify that the
                 port associated with your Companion is the one just opened on
                 the exe
+            launch_timeout (float, optional): seconds to wait for the exe to
+                write its portnum.dat and accept connections before giving up
+                (and terminating the exe)
             **kwargs: the remaining kwargs to be passes to CompanionsKQMLModule
         """
+        from pathlib import Path
+        from subprocess import Popen
         exe_path = Path(exe_path)
         portnum_path = exe_path / PORTNUM
         exe_location = exe_path / exe_name
@@ -529,26 +1502,38 @@ class ControlledCompanionsKQMLModule(CompanionsKQMLModule):
             portnum_path.unlink()  # missing_ok key handles nonexistant files
         self.companions_process = Popen(str(exe_location))
         LOGGER.info('Launched companions: %s', self.companions_process)
-        while not portnum_path.exists():
-            sleep(1)
-        kwargs['port'] = get_port(portnum_path, self.companions_process.pid,
-                                  verify_port)
+        deadline = monotonic() + launch_timeout
+        try:
+            port = wait_for_portnum(portnum_path, self.companions_process,
+                                    deadline, verify_port)
+            wait_for_listener(kwargs.get('host', LOCALHOST), port,
+                              self.companions_process, deadline)
+        except (TimeoutError, RuntimeError):
+            self.companions_process.terminate()
+            raise
+        kwargs['port'] = port
         super().__init__(**kwargs)
 
     @classmethod
     def parse_command_line_args(cls, argv: list = None):
+        from argparse import ArgumentParser
         if not argv:
             argv = system_argument_list
         _, *args = argv  # ignore name of file...
         parser = ArgumentParser(description='Run Pythonian agent.')
         parser.add_argument('-p', '--port', type=valid_port,
                             help='port companions kqml server is open on')
-        parser.add_argument('-l', '--listener_port', type=valid_port,
-                            help='port pythonian kqml server is open on')
+        parser.add_argument('-l', '--listener_port',
+                            type=valid_listener_port,
+                            help='port pythonian kqml server is open on, 0 '
+                                 'for one picked by the operating system')
         parser.add_argument('-e', '--exe_path', type=str,
                             help='path to the executable to be launched')
         parser.add_argument('-n', '--exe_name', type=str,
                             help='name of the executable to be launched')
+        parser.add_argument('-t', '--launch_timeout', type=float,
+                            help='seconds to wait for the launched exe to '
+                                 'accept connections')
         parser.add_argument('-d', '--debug', action='store_true',
                             help='whether or not to log debug messages')
         parser.add_argument('-v', '--verify_port', action='store_true',
@@ -562,32 +1547,102 @@ class ControlledCompanionsKQMLModule(CompanionsKQMLModule):
         kwargs = {}
         if args.port:
             kwargs['port'] = args.port
-        if args.listener_port:
+        if args.listener_port is not None:
             kwargs['listener_port'] = args.listener_port
         if args.exe_path:
             kwargs['exe_path'] = args.exe_path
         if args.exe_name:
             kwargs['exe_name'] = args.exe_name
+        if args.launch_timeout:
+            kwargs['launch_timeout'] = args.launch_timeout
         if args.debug:
             kwargs['debug'] = args.debug
         if args.verify_port:
             kwargs['verify_port'] = args.verify_port
         return cls(**kwargs)
 
-    def exit(self, n: int = 0):
+    def exit(self, n: int = 0, timeout: float = None):
         """Override of CompanionsKQMLModule, allows for a Companions process
         to be exited on exit of the rest of the system.
 
         Args:
             n (int, optional): the value to pass along to sys.exit
+            timeout (float, optional): seconds to wait for in-flight messages
         """
-        super().exit(n)
+        super().exit(n, timeout)
         if self.companions_process:
             LOGGER.info('Shutting down companions: %s',
                         self.companions_process)
             self.companions_process.terminate()
 
 
+###############################################################################
+#                              Encoding & writing                             #
+###############################################################################
+
+def encode_message(msg: KQMLPerformative) -> bytes:
+    """Serializes a message the way it goes out on the wire (the performative
+    followed by a newline)
+
+    Args:
+        msg (KQMLPerformative): message to encode
+
+    Returns:
+        bytes: encoded message
+    """
+    LOGGER.debug('Sending: %s', msg)
+    data = BytesIO()
+    msg.write(data)
+    data.write(b'\n')
+    return data.getvalue()
+
+
+def encode_messages(msgs: List[KQMLPerformative]) -> List[memoryview]:
+    """Serializes several messages into one buffer
+
+    Args:
+        msgs (List[KQMLPerformative]): messages to encode
+
+    Returns:
+        List[memoryview]: one view per encoded message, all of them slices of
+            the same contiguous buffer
+    """
+    data, ends = BytesIO(), []
+    for msg in msgs:
+        LOGGER.debug('Sending: %s', msg)
+        msg.write(data)
+        data.write(b'\n')
+        ends.append(data.tell())
+    buffer = memoryview(data.getvalue())
+    return [buffer[start:end] for start, end in zip([0] + ends, ends)]
+
+
+def send_buffers(sock: socket, buffers: List[bytes]) -> int:
+    """Writes buffers to a connected socket with as few system calls as
+    possible - a single vectored sendmsg where the platform has it (looping
+    only on partial sends), one sendall of the joined buffers elsewhere.
+
+    Args:
+        sock (socket): connected socket
+        buffers (List[bytes]): data to write, in order
+
+    Returns:
+        int: number of bytes written
+    """
+    total = sum(len(buffer) for buffer in buffers)
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(buffers[0] if len(buffers) == 1 else b''.join(buffers))
+        return total
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views[:IOV_MAX])
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+    return total
+
+
 ###############################################################################
 #                  KQMLList & KQMLPerformative replacements                   #
 ###############################################################################
@@ -611,7 +1666,7 @@ def listify(possible_list: Any) -> KQMLType:
     value pairs, and then make a KQMLList of that overall list of pairs. If the
     input is a bool we return t for True and nil for False. Lastly, if the
     input was nothing else we return the input as a string turned into a
-    KQMLToken.
+    KQMLToken. Anything that is already KQML is returned as is.
 
     Arguments:
         possible_list (Any): any input that you want to transform to KQML
@@ -620,6 +1675,8 @@ def listify(possible_list: Any) -> KQMLType:
     Returns:
         KQMLType
     """
+    if isinstance(possible_list, KQMLObject):
+        return possible_list
     if isinstance(possible_list, list):
         new_list = [listify(each) for each in possible_list]
         return KQMLList(new_list)
@@ -722,6 +1779,8 @@ def valid_ip(string: str) -> str:
     """
     if string in LOCALHOST_DEFS:
         return string
+    from argparse import ArgumentTypeError
+    from ipaddress import ip_address
     try:
         ip_address(string)
     except ValueError:
@@ -746,13 +1805,32 @@ def valid_port(string: str) -> int:
     try:
         port_num = int(string)
     except ValueError:
-        raise ArgumentTypeError(f'{port_num} is not a valid port number')
-    in_range = 1024 < port_num < 65535
-    if not in_range:
-        raise ArgumentTypeError(f'{port_num} is not a valid port number')
+        port_num = None
+    if port_num is None or not 1024 < port_num < 65535:
+        from argparse import ArgumentTypeError
+        raise ArgumentTypeError(f'{string} is not a valid port number')
     return port_num
 
 
+def valid_listener_port(string: str) -> int:
+    """argparse type checking/conversion function for listener ports, a
+    valid port number (see valid_port) or EPHEMERAL_PORT (0).
+
+    Args:
+        string (str): port number as a string, usually passed in by arguments
+
+    Returns:
+        int: valid listener port number
+
+    Raises:
+        ArgumentTypeError: If the port number is neither 0 nor in the range
+            1024 to 65535
+    """
+    if str(string).strip() == str(EPHEMERAL_PORT):
+        return EPHEMERAL_PORT
+    return valid_port(string)
+
+
 def check_for_companions(verify: bool = False) -> Optional[int]:
     """A helper function that will check for a running companions executable
     OR for the allegro development environment (plus a qrg directory) and
@@ -767,6 +1845,8 @@ def check_for_companions(verify: bool = False) -> Optional[int]:
     Returns:
         Optional[int]: portnum of a running process (if found)
     """
+    from pathlib import Path
+    from psutil import disk_partitions, process_iter
     LOGGER.debug('Checking for companions...')
     potential_port = None
     processes = process_iter(attrs=['pid', 'name', 'exe'])
@@ -807,7 +1887,7 @@ def check_for_companions(verify: bool = False) -> Optional[int]:
     return potential_port
 
 
-def get_port(portnum_path: Path, process_pid: int,
+def get_port(portnum_path: 'Path', process_pid: int,
              verify: bool = False) -> Optional[int]:
     """Gets the port number from the portnum.dat file as a dict. If verify is
     true the port number is only returned if the pid in the portnum file is a
@@ -827,6 +1907,7 @@ def get_port(portnum_path: Path, process_pid: int,
          Optional[int]: port number found in port_dict (or None if not found,
             or not valid)
     """
+    from json import loads as load_dict
     if portnum_path.exists():
         with portnum_path.open() as portnum_file:
             port_dict = load_dict(portnum_file.readline())
@@ -839,13 +1920,165 @@ def get_port(portnum_path: Path, process_pid: int,
     return None
 
 
-def test_bind_in_range(sock: socket, port: int, tries: int = 0):
-    """Wrapper around socket binding that will try to bind to the given port,
-    catching any errors and trying again at one plus that port, up to the
-    number of times defined in the variable LISTENER_PORT_RANGE.
+def wait_for_portnum(portnum_path: 'Path', process: 'Popen', deadline: float,
+                     verify: bool = False) -> int:
+    """Waits until the launched Companions process has published its port in
+    portnum.dat. On Linux the containing directory is watched with inotify so
+    we wake as soon as the file is written, elsewhere (or if inotify is not
+    available) we poll with exponential backoff. Either way the process is
+    checked between waits so a crashed exe fails fast instead of hanging.
+
+    Args:
+        portnum_path (Path): path to the portnum.dat file the exe will write
+        process (Popen): the launched Companions process
+        deadline (float): time.monotonic() value after which we give up
+        verify (bool, optional): whether or not to verify the pid in the
+            portnum.dat file against the pid of the process
+
+    Returns:
+        int: port number found in portnum.dat
+
+    Raises:
+        RuntimeError: the process exited before publishing a port
+        TimeoutError: no port was published before the deadline
+    """
+    watcher = _inotify_watcher(portnum_path.parent)
+    delay = 0.01
+    try:
+        while True:
+            port = _read_port(portnum_path, process.pid, verify)
+            if port:
+                return port
+            if process.poll() is not None:
+                raise RuntimeError(f'Companions exited (code {process.poll()})'
+                                   f' before writing {portnum_path}')
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'No port published to {portnum_path}')
+            # cap each wait so a dead process is still noticed promptly
+            wait = min(remaining, delay if watcher is None else 1)
+            if watcher is None:
+                sleep(wait)
+                delay = min(delay * 2, 1)
+            elif select([watcher], [], [], wait)[0]:
+                read_fd(watcher, 4096)  # drain events, we only need the wake
+    finally:
+        if watcher is not None:
+            close_fd(watcher)
+
+
+def wait_for_listener(host: str, port: int, process: 'Popen', deadline: float):
+    """Probes the facilitator port with exponential backoff until it accepts a
+    connection. Companions writes portnum.dat slightly before its KQML server
+    is accepting, so registering straight away can be refused.
+
+    Args:
+        host (str): host the facilitator is on
+        port (int): port the facilitator is listening on
+        process (Popen): the launched Companions process
+        deadline (float): time.monotonic() value after which we give up
+
+    Raises:
+        RuntimeError: the process exited before accepting connections
+        TimeoutError: the port did not accept a connection before the deadline
+    """
+    delay = 0.01
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f'Companions never accepted on port {port}')
+        try:
+            probe = create_connection((host, port), timeout=min(remaining, 1))
+        except OSError as error_msg:
+            LOGGER.debug('Facilitator not accepting yet: %s', error_msg)
+        else:
+            probe.close()
+            return
+        if process.poll() is not None:
+            raise RuntimeError(f'Companions exited (code {process.poll()}) '
+                               f'before accepting on port {port}')
+        sleep(min(delay, max(deadline - monotonic(), 0)))
+        delay = min(delay * 2, 1)
+
+
+def _read_port(portnum_path: 'Path', process_pid: int,
+               verify: bool) -> Optional[int]:
+    """get_port that treats a partially written portnum.dat as not ready"""
+    try:
+        return get_port(portnum_path, process_pid, verify)
+    except (ValueError, OSError):
+        return None
+
 
-    Helps to eliminate the need for setting listener port for multiple agents,
-    or in situations where one of the ports in the default range is used.
+def _inotify_watcher(directory: 'Path') -> Optional[int]:
+    """Creates a non-blocking inotify file descriptor watching directory for
+    files being written or moved in. Returns None on platforms without inotify
+    (or if it fails), signaling the caller to fall back to polling.
+
+    Args:
+        directory (Path): directory to watch
+
+    Returns:
+        Optional[int]: inotify file descriptor, caller must close it
+    """
+    if not platform.startswith('linux'):
+        return None
+    try:
+        from ctypes import CDLL, get_errno
+        from ctypes.util import find_library
+        libc = CDLL(find_library('c'), use_errno=True)
+        # IN_NONBLOCK | IN_CLOEXEC
+        watcher = libc.inotify_init1(0o4000 | 0o2000000)
+    except (OSError, AttributeError) as error_msg:
+        LOGGER.debug('inotify unavailable, polling instead: %s', error_msg)
+        return None
+    if watcher < 0:
+        return None
+    # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(watcher, fsencode(str(directory)),
+                              0x008 | 0x080 | 0x100) < 0:
+        LOGGER.debug('inotify watch failed (errno %s), polling instead',
+                     get_errno())
+        close_fd(watcher)
+        return None
+    return watcher
+
+
+def bind_listener(sock: socket, port: int = EPHEMERAL_PORT) -> int:
+    """Binds a listener socket, to the first free port from port up (trying
+    up to LISTENER_PORT_RANGE more, stopping at 65535) or, with
+    EPHEMERAL_PORT, to a port picked by the operating system in a single
+    bind. If the whole range is taken the operating system picks one too,
+    rather than failing the agent's start.
+
+    Args:
+        sock (socket): socket to be bound
+        port (int, optional): start of the range of ports to try, or
+            EPHEMERAL_PORT
+
+    Returns:
+        int: the port bound
+    """
+    if port != EPHEMERAL_PORT:
+        last = min(port + LISTENER_PORT_RANGE, 65535)
+        for candidate in range(port, last + 1):
+            try:
+                sock.bind(('', candidate))
+                return sock.getsockname()[1]
+            except OSError as error_msg:
+                LOGGER.debug('Failed to bind to port %s, error: %s, trying '
+                             'again...', candidate, error_msg)
+        LOGGER.warning('No free listener port from %s to %s, using one '
+                       'picked by the operating system', port, last)
+    sock.bind(('', EPHEMERAL_PORT))
+    return sock.getsockname()[1]
+
+
+def test_bind_in_range(sock: socket, port: int, tries: int = 0):
+    """Deprecated, use bind_listener. Kept for code written against earlier
+    versions: binds sock to the first free port from port + tries up, falling
+    back to a port picked by the operating system (see bind_listener) rather
+    than failing an assertion when the range is taken.
 
     Args:
         sock (socket): socket to be bound
@@ -854,19 +2087,9 @@ def test_bind_in_range(sock: socket, port: int, tries: int = 0):
             tries
 
     Returns:
-        None: Always returns None
+        None: Always returns None, test_sock_name(sock) gives the port
     """
-    if tries > LISTENER_PORT_RANGE:
-        orig_port = port - (LISTENER_PORT_RANGE + 1)
-        assert test_sock_name(sock), \
-            'Failed to bind to a port from %s to %s' % (orig_port, port - 1)
-        return
-    try:
-        sock.bind(('', port))
-    except OSError as error_msg:
-        LOGGER.debug('Failed to bind to port %s, error: %s, trying again...',
-                     port, error_msg)
-        test_bind_in_range(sock, port + 1, tries + 1)
+    bind_listener(sock, port + tries)
 
 
 def test_sock_name(sock: socket):
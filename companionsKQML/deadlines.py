@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    deadlines.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-15 09:20:31
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-15 09:20:31
+
+"""Deadlines for Pythonian ask and achieve handlers. call_with_deadline runs a
+handler for at most timeout seconds. A plain function is run on its own
+thread and, if it overruns, left behind with its CancellationToken cancelled
+(the handler finds its token with current_token and should check it between
+steps). A coroutine function is run on a shared event loop thread and its task
+is cancelled outright when it overruns.
+
+A thread left behind keeps running until the handler notices its token, so
+they are counted (abandoned_handlers) and once MAX_ABANDONED are still
+running call_with_deadline refuses to start more plain functions with a
+deadline until some finish.
+
+Attributes:
+    LOGGER (logging): The logger (from logging) to handle debugging
+    MAX_ABANDONED (int): most timed out handler threads left running before
+        new handlers with a deadline are refused
+    NEVER_CANCELLED (CancellationToken): token seen by handlers run without a
+        deadline
+"""
+
+from logging import getLogger
+from threading import Event, Lock, Thread, local
+from typing import Any, Callable, Sequence
+
+MAX_ABANDONED = 32
+
+LOGGER = getLogger(__name__)
+
+
+class HandlerTimeout(Exception):
+    """Raised by call_with_deadline when the handler didn't finish in time"""
+
+
+class HandlerRefused(HandlerTimeout):
+    """Raised by call_with_deadline instead of starting a handler while
+    MAX_ABANDONED timed out handlers are still running"""
+
+
+class HandlerCancelled(Exception):
+    """Raised by CancellationToken.raise_if_cancelled, lets a thread handler
+    bail out once its caller has given up on it"""
+
+
+class CancellationToken():
+    """Cooperative cancellation flag handed to a thread handler"""
+
+    def __init__(self):
+        self._event = Event()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the handler's caller has given up on it"""
+        return self._event.is_set()
+
+    def cancel(self):
+        """Marks the handler as cancelled"""
+        self._event.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Sleeps for up to timeout seconds, waking early on cancellation
+
+        Args:
+            timeout (float, optional): most seconds to sleep
+
+        Returns:
+            bool: True if cancelled
+        """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        """Raises HandlerCancelled if the handler has been cancelled
+
+        Raises:
+            HandlerCancelled: the handler has been cancelled
+        """
+        if self._event.is_set():
+            raise HandlerCancelled('handler was cancelled')
+
+
+NEVER_CANCELLED = CancellationToken()
+_CURRENT = local()
+_ABANDONED = 0
+_ABANDONED_LOCK = Lock()
+
+
+def current_token() -> CancellationToken:
+    """The cancellation token of the handler running on this thread
+
+    Returns:
+        CancellationToken: NEVER_CANCELLED outside of a handler with a deadline
+    """
+    return getattr(_CURRENT, 'token', NEVER_CANCELLED)
+
+
+def abandoned_handlers() -> int:
+    """Number of handler threads that timed out and are still running
+
+    Returns:
+        int: threads left behind by call_with_deadline
+    """
+    return _ABANDONED
+
+
+def call_with_deadline(function: Callable[..., Any], args: Sequence,
+                       timeout: float = None) -> Any:
+    """Calls function(*args), giving up after timeout seconds
+
+    Args:
+        function (Callable[..., Any]): handler, a function or coroutine
+            function
+        args (Sequence): arguments for function
+        timeout (float, optional): most seconds to wait, None waits forever
+
+    Returns:
+        Any: what function returned
+
+    Raises:
+        HandlerRefused: too many timed out handlers are still running, so
+            function wasn't called
+        HandlerTimeout: function didn't finish in time (it has been cancelled)
+        Exception: whatever function raised
+    """
+    global _ABANDONED  # pylint: disable=global-statement
+    from inspect import iscoroutinefunction
+    if iscoroutinefunction(function):
+        return _call_coroutine(function, args, timeout)
+    if timeout is None:
+        return function(*args)
+    name = getattr(function, '__name__', function)
+    if _ABANDONED >= MAX_ABANDONED:
+        LOGGER.warning('Refusing %s, %s timed out handlers are still '
+                       'running', name, _ABANDONED)
+        raise HandlerRefused(f'not started, {_ABANDONED} timed out '
+                             f'handlers are still running')
+    token, done, outcome = CancellationToken(), Event(), {}
+
+    def run():
+        global _ABANDONED  # pylint: disable=global-statement
+        _CURRENT.token = token
+        try:
+            outcome['result'] = function(*args)
+        except Exception as error:  # pylint: disable=broad-except
+            outcome['error'] = error  # re-raised on the caller's thread
+        finally:
+            with _ABANDONED_LOCK:
+                done.set()
+                if token.cancelled:
+                    _ABANDONED -= 1
+            if token.cancelled:
+                LOGGER.info('Abandoned handler %s finished', name)
+    Thread(target=run, daemon=True).start()
+    if not done.wait(timeout):
+        with _ABANDONED_LOCK:
+            abandoned = not done.is_set()  # it may have just finished
+            if abandoned:
+                token.cancel()
+                _ABANDONED += 1
+        if abandoned:
+            raise HandlerTimeout(f'timed out after {timeout}s')
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+_LOOP = None
+_LOOP_LOCK = Lock()
+
+
+def _event_loop():
+    """Event loop running coroutine handlers, started on first use"""
+    global _LOOP  # pylint: disable=global-statement
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            from asyncio import new_event_loop
+            _LOOP = new_event_loop()
+            Thread(target=_LOOP.run_forever, daemon=True).start()
+    return _LOOP
+
+
+def _call_coroutine(function: Callable[..., Any], args: Sequence,
+                    timeout: float = None) -> Any:
+    from asyncio import run_coroutine_threadsafe
+    from concurrent.futures import TimeoutError as FutureTimeout
+    future = run_coroutine_threadsafe(function(*args), _event_loop())
+    try:
+        return future.result(timeout)
+    except FutureTimeout:
+        future.cancel()  # cancels the task on the loop
+        raise HandlerTimeout(f'timed out after {timeout}s') from None
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    host.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-22 10:14:52
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-22 10:14:52
+
+"""AgentHost, serves several agents from one process: one listener socket,
+one executor reading connections, one scheduler running handlers and one
+subscription poller, instead of a set of each per agent. Every hosted agent
+still registers with the facilitator under its own name (all of them with
+the host's listener port) and incoming messages are routed to the agent
+named by their :receiver.
+
+Attributes:
+    LOGGER (logging): The logger (from logging) to handle debugging
+"""
+
+from logging import getLogger
+from threading import Lock, Thread
+from time import monotonic
+from typing import List, Optional, Type
+from kqml import KQMLPerformative, KQMLList
+from .companionsKQMLModule import CompanionsKQMLModule, \
+     CompanionsKQMLDispatcher, remove_packaging
+from .tracing import NULL_TRACE
+
+LOGGER = getLogger(__name__)
+
+
+class RoutedDispatcher(CompanionsKQMLDispatcher):
+    """Dispatches the messages a HostDispatcher routes to one hosted agent.
+    Holds are taken on the HostDispatcher, so the connection stays open until
+    every message read from it has been handled, whichever agent handled it.
+
+    Attributes:
+        parent (HostDispatcher): dispatcher reading the connection
+    """
+
+    def __init__(self, agent: CompanionsKQMLModule, parent: 'HostDispatcher'):
+        super().__init__(agent, parent.reader, agent.name, parent.connection)
+        self.parent = parent
+
+    def hold(self):
+        """Holds the connection being read by the parent"""
+        self.parent.hold()
+
+    def release(self):
+        """Releases a hold on the connection being read by the parent"""
+        self.parent.release()
+
+
+class HostDispatcher(CompanionsKQMLDispatcher):
+    """Reads messages from a connection accepted by an AgentHost and hands
+    each one to the agent named by its :receiver. Messages for an agent that
+    isn't hosted get an error reply from the host.
+
+    Attributes:
+        local_out (BufferedWriter): output of the connection, handed to the
+            receiving agent for replies on the local port (pings)
+        routes (dict): RoutedDispatcher for each agent messages went to
+    """
+
+    def __init__(self, rec, inp, agent_name, connection=None):
+        super().__init__(rec, inp, agent_name, connection)
+        self.local_out = rec.local_out
+        self.routes = {}
+
+    def dispatch_message(self, msg: KQMLPerformative, trace=NULL_TRACE):
+        """Routes a message to the hosted agent it was sent to
+
+        Args:
+            msg (KQMLPerformative): message read from the connection
+            trace (Trace, optional): trace of the message
+        """
+        agent = self.receiver.route(msg)
+        if agent is None:
+            self.receiver.metrics.counter(
+                'kqml_unroutable_total',
+                'messages for an agent that is not hosted').inc()
+            self.receiver.error_reply(
+                msg, f'no agent named {msg.get("receiver")} is hosted here'
+                if msg.get('receiver') is not None else
+                'no :receiver to route the message to')
+            return
+        routed = self.routes.get(agent)
+        if routed is None:
+            routed = self.routes[agent] = RoutedDispatcher(agent, self)
+        agent.local_out = self.local_out
+        trace.annotate(agent=agent.name)
+        routed.dispatch_message(msg, trace)
+
+
+class AgentHost(CompanionsKQMLModule):
+    """Hosts several agents in one process. The host binds the listener and
+    owns the reader executor and handler scheduler (sized for every agent it
+    hosts), agents are created with add_agent and share them. The host is not
+    an agent itself, it never registers with the facilitator.
+
+    Attributes:
+        agents (Dict[str, CompanionsKQMLModule]): hosted agents by lower case
+            name
+        poller (Thread): thread pushing the subscription updates of every
+            hosted agent that has subscriptions (Pythonian agents)
+        polling_interval (float): seconds between subscription polls
+        register_agents (bool): True, hosted agents register themselves
+    """
+
+    name = 'AgentHost'
+    dispatcher_class = HostDispatcher
+    register_agents = True
+
+    def __init__(self, polling_interval: float = 1, **kwargs):
+        """Binds the shared listener and starts the shared workers
+
+        Args:
+            polling_interval (float, optional): seconds between subscription
+                polls of the hosted agents
+            **kwargs: passed to CompanionsKQMLModule, host and port are also
+                the defaults for the hosted agents
+        """
+        self.agents = {}
+        self._agents_lock = Lock()
+        self.polling_interval = polling_interval
+        self.poller = Thread(target=self.poll_agents, args=[])
+        super().__init__(**kwargs)
+        self.poller.start()
+
+    def add_agent(self, cls: Type[CompanionsKQMLModule],
+                  **kwargs) -> CompanionsKQMLModule:
+        """Creates an agent served by this host, it registers under its
+        class's name with the host's listener port
+
+        Args:
+            cls (Type[CompanionsKQMLModule]): agent class, e.g. a Pythonian
+                subclass with its own name
+            **kwargs: passed to cls, host, port and debug default to the
+                host's
+
+        Returns:
+            CompanionsKQMLModule: the running agent
+
+        Raises:
+            ValueError: an agent with the same name is already hosted
+        """
+        if str(cls.name).lower() in self.agents:
+            raise ValueError(f'an agent named {cls.name} is already hosted')
+        kwargs.setdefault('host', self.host)
+        kwargs.setdefault('port', self.port)
+        kwargs.setdefault('debug', self.debug)
+        return cls(agent_host=self, **kwargs)
+
+    def attach(self, agent: CompanionsKQMLModule):
+        """Starts routing messages to agent, called by the agent before it
+        registers
+
+        Args:
+            agent (CompanionsKQMLModule): agent created with this host
+
+        Raises:
+            ValueError: an agent with the same name is already hosted
+        """
+        key = str(agent.name).lower()
+        with self._agents_lock:
+            if key in self.agents:
+                raise ValueError(f'an agent named {agent.name} is already '
+                                 f'hosted')
+            self.agents[key] = agent
+        LOGGER.info('Hosting %s on port %s', agent.name, self.listener_port)
+
+    def detach(self, agent: CompanionsKQMLModule):
+        """Stops routing messages to agent, called by the agent's exit
+
+        Args:
+            agent (CompanionsKQMLModule): hosted agent
+        """
+        key = str(agent.name).lower()
+        with self._agents_lock:
+            if self.agents.get(key) is agent:
+                del self.agents[key]
+
+    def route(self, msg: KQMLPerformative) -> Optional[CompanionsKQMLModule]:
+        """The hosted agent a message was sent to
+
+        Args:
+            msg (KQMLPerformative): message read from Companions
+
+        Returns:
+            Optional[CompanionsKQMLModule]: agent named by the message's
+                :receiver (or its content's, e.g. a subscribe's ask-all),
+                None if there is no such agent
+        """
+        receiver = msg.get('receiver')
+        content = msg.get('content')
+        if receiver is None and isinstance(content, KQMLList):
+            receiver = content.get('receiver')
+        if receiver is None:
+            return None
+        name = remove_packaging(str(receiver)).strip('"').lower()
+        return self.agents.get(name)
+
+    def poll_agents(self):
+        """Pushes the subscription updates of every hosted agent, a single
+        thread in place of a poller per Pythonian agent"""
+        while self.ready:
+            for agent in self.hosted():
+                push = getattr(agent, 'push_subscription_updates', None)
+                if push is None:
+                    continue
+                try:
+                    push()
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception('Pushing subscription updates for %s '
+                                     'failed', agent.name)
+            self.shutdown_event.wait(self.polling_interval)
+
+    def hosted(self) -> List[CompanionsKQMLModule]:
+        """The hosted agents
+
+        Returns:
+            List[CompanionsKQMLModule]: the agents being hosted right now
+        """
+        with self._agents_lock:
+            return list(self.agents.values())
+
+    def register(self):
+        """Override of CompanionsKQMLModule, the host itself isn't an agent
+        (each hosted agent registers itself)"""
+
+    def exit(self, n: int = 0, timeout: float = None):
+        """Exits every hosted agent (each draining its own messages), then
+        shuts down the shared listener and workers
+
+        Args:
+            n (int, optional): the value to pass along to sys.exit
+            timeout (float, optional): seconds to wait for in-flight messages
+                to finish across all agents, defaults to shutdown_timeout
+        """
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        for agent in self.hosted():
+            agent.exit(n, max(deadline - monotonic(), 0))
+        super().exit(n, max(deadline - monotonic(), 0))
+        self.poller.join()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    metrics.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-04 10:02:11
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-04 10:02:11
+
+"""Small, dependency free metrics registry used by CompanionsKQMLModule and
+Pythonian. Keeps counters, gauges and latency histograms (optionally labeled,
+e.g. by performative or predicate) that can be read back as a snapshot dict or
+rendered in the Prometheus text exposition format - written to a file or
+served on a local socket for scraping.
+
+Attributes:
+    LATENCY_BUCKETS (tuple): default histogram bucket upper bounds in seconds
+    LOGGER (logging): The logger (from logging) to handle debugging
+"""
+
+from logging import getLogger
+from os import replace
+from socket import socket, timeout as socket_timeout, SOL_SOCKET, \
+     SO_REUSEADDR
+from threading import Lock, Thread, Event
+from typing import Callable, Dict, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LOGGER = getLogger(__name__)
+
+_SCRAPE_TIMEOUT = 5.0  # seconds a scraper has to send a request and read
+_REQUEST_LIMIT = 65536  # most request bytes read before replying anyway
+
+
+###############################################################################
+#                                Metric types                                 #
+###############################################################################
+
+class Counter():
+    """Monotonically increasing count
+
+    Attributes:
+        value (float): current count
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        """Increases the count
+
+        Args:
+            amount (float, optional): amount to add, defaults to 1
+        """
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    """Value that can go up and down, either set directly or (if a function
+    is given) read from that function whenever it is collected.
+
+    Attributes:
+        function (Callable[[], float]): optional function producing the value
+    """
+
+    def __init__(self, function: Callable[[], float] = None):
+        super().__init__()
+        self.function = function
+
+    def set(self, value: float):
+        """Sets the value of the gauge
+
+        Args:
+            value (float): new value
+        """
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        """Decreases the value of the gauge
+
+        Args:
+            amount (float, optional): amount to subtract, defaults to 1
+        """
+        self.inc(-amount)
+
+    def collect(self) -> float:
+        """Current value of the gauge (calls function if there is one)
+
+        Returns:
+            float: current value
+        """
+        return self.function() if self.function else self.value
+
+
+class Histogram():
+    """Distribution of observations (latencies in seconds by default) kept as
+    cumulative bucket counts plus a running sum and count.
+
+    Attributes:
+        bounds (tuple): upper bounds of the buckets
+        counts (list): number of observations per bucket (not cumulative), the
+            last entry is the +Inf bucket
+        count (int): total number of observations
+        sum (float): sum of all observations
+    """
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """Records an observation
+
+        Args:
+            value (float): observed value
+        """
+        index = 0
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def collect(self) -> dict:
+        """Snapshot of the histogram
+
+        Returns:
+            dict: count, sum and cumulative bucket counts keyed by upper bound
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, summed = self.count, self.sum
+        buckets, running = {}, 0
+        for bound, count in zip(self.bounds + ('+Inf',), counts):
+            running += count
+            buckets[str(bound)] = running
+        return {'count': total, 'sum': summed, 'buckets': buckets}
+
+
+###############################################################################
+#                                  Registry                                   #
+###############################################################################
+
+class MetricsRegistry():
+    """Get-or-create store of labeled metrics.
+
+    Metrics are identified by a name plus keyword labels, e.g.
+    registry.counter('kqml_messages_received_total', performative='ask-one')
+    always returns the same Counter for the same name and labels.
+
+    Attributes:
+        metrics (dict): (name, labels) -> metric object
+        types (dict): name -> (metric type, help text)
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.types = {}
+        self._lock = Lock()
+
+    def _get(self, kind: str, factory: Callable, name: str, help_text: str,
+             labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    known = self.types.setdefault(name, (kind, help_text))
+                    if known[0] != kind:
+                        raise ValueError(f'{name} is already a {known[0]}')
+                    metric = self.metrics[key] = factory()
+        return metric
+
+    def counter(self, name: str, help_text: str = '', **labels) -> Counter:
+        """Gets (or creates) a counter
+
+        Args:
+            name (str): metric name
+            help_text (str, optional): description for the exposition format
+            **labels: label names and values
+
+        Returns:
+            Counter
+        """
+        return self._get('counter', Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = '',
+              function: Callable[[], float] = None, **labels) -> Gauge:
+        """Gets (or creates) a gauge
+
+        Args:
+            name (str): metric name
+            help_text (str, optional): description for the exposition format
+            function (Callable[[], float], optional): read the value from this
+                function when collected instead of setting it, replaces the
+                function of an existing gauge (e.g. one registered again for
+                a queue that was replaced)
+            **labels: label names and values
+
+        Returns:
+            Gauge
+        """
+        gauge = self._get('gauge', lambda: Gauge(function), name, help_text,
+                          labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, help_text: str = '',
+                  bounds: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        """Gets (or creates) a histogram
+
+        Args:
+            name (str): metric name
+            help_text (str, optional): description for the exposition format
+            bounds (tuple, optional): bucket upper bounds
+            **labels: label names and values
+
+        Returns:
+            Histogram
+        """
+        return self._get('histogram', lambda: Histogram(bounds), name,
+                         help_text, labels)
+
+    def _samples(self) -> Dict[str, Dict[Tuple, object]]:
+        grouped = {}
+        with self._lock:
+            items = list(self.metrics.items())
+        for (name, labels), metric in items:
+            value = (metric.collect() if hasattr(metric, 'collect')
+                     else metric.value)
+            grouped.setdefault(name, {})[labels] = value
+        return grouped
+
+    def snapshot(self) -> dict:
+        """Current value of every metric.
+
+        Returns:
+            dict: keys are 'name{label="value",...}' (or just the name when
+                unlabeled), values are numbers for counters and gauges and
+                dicts (count, sum, buckets) for histograms
+        """
+        return {_sample_name(name, labels): value
+                for name, samples in sorted(self._samples().items())
+                for labels, value in samples.items()}
+
+    def to_prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format
+
+        Returns:
+            str: exposition text
+        """
+        lines = []
+        for name, samples in sorted(self._samples().items()):
+            kind, help_text = self.types[name]
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples.items()):
+                if kind != 'histogram':
+                    lines.append(f'{_sample_name(name, labels)} {value}')
+                    continue
+                for bound, count in value['buckets'].items():
+                    bucket = _sample_name(f'{name}_bucket',
+                                          labels + (('le', bound),))
+                    lines.append(f'{bucket} {count}')
+                lines.append(f'{_sample_name(name + "_sum", labels)} '
+                             f'{value["sum"]}')
+                lines.append(f'{_sample_name(name + "_count", labels)} '
+                             f'{value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Writes the exposition text to path (atomically, so a scraper or
+        node exporter textfile collector never sees a partial file)
+
+        Args:
+            path (str): file to write
+        """
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        replace(temp_path, path)
+
+    def export_to_file(self, path: str, interval: float,
+                       stop: Event) -> Thread:
+        """Starts a daemon thread rewriting path every interval seconds until
+        stop is set (with one final write on the way out)
+
+        Args:
+            path (str): file to write
+            interval (float): seconds between writes
+            stop (Event): event ending the export
+
+        Returns:
+            Thread: the running export thread
+        """
+        def export():
+            while not stop.wait(interval):
+                self.write_prometheus(path)
+            self.write_prometheus(path)
+        thread = Thread(target=export, daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self, port: int, stop: Event, host: str = 'localhost') -> int:
+        """Serves the exposition text to anyone connecting to host:port (with
+        a minimal HTTP response, so Prometheus can scrape it directly) from a
+        daemon thread until stop is set
+
+        Args:
+            port (int): port to listen on, 0 picks a free port
+            stop (Event): event ending the server
+            host (str, optional): interface to bind, defaults to localhost
+
+        Returns:
+            int: the port actually bound
+        """
+        server = socket()
+        server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(5)
+        server.settimeout(0.5)
+
+        def respond():
+            with server:
+                while not stop.is_set():
+                    try:
+                        connection, _ = server.accept()
+                    except OSError:  # timeout, check stop again
+                        continue
+                    try:
+                        with connection:
+                            # not the listener's short timeout, a slow
+                            # scraper gets the whole response
+                            connection.settimeout(_SCRAPE_TIMEOUT)
+                            _read_request(connection)
+                            body = self.to_prometheus().encode()
+                            connection.sendall(
+                                b'HTTP/1.0 200 OK\r\nContent-Type: '
+                                b'text/plain; version=0.0.4\r\n'
+                                b'Content-Length: ' + str(len(body)).encode()
+                                + b'\r\n\r\n' + body)
+                    except OSError as error:
+                        LOGGER.debug('Metrics scrape failed: %s', error)
+        Thread(target=respond, daemon=True).start()
+        LOGGER.info('Serving metrics on %s:%s', host, server.getsockname()[1])
+        return server.getsockname()[1]
+
+
+def _read_request(connection: socket):
+    """Reads the request headers (ignored, every request gets the metrics) so
+    closing after the reply doesn't reset the connection and cut the reply
+    short (a client that sends nothing is answered after the timeout)"""
+    request = b''
+    while b'\r\n\r\n' not in request and len(request) < _REQUEST_LIMIT:
+        try:
+            chunk = connection.recv(4096)
+        except socket_timeout:
+            return
+        if not chunk:
+            return
+        request += chunk
+
+
+def _sample_name(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{name}{{{label_text}}}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    outbound.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-08 09:47:52
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-08 09:47:52
+
+"""Asynchronous outbound queue for CompanionsKQMLModule. With the queue enabled
+send only appends the message to a bounded queue and returns, a background
+writer thread takes messages off the queue (several at a time if batching is
+allowed) and hands them to the module to be sent on one connection. Callers
+(handlers, the subscription poller, user code inserting facts) are no longer
+held up by a slow or unreachable facilitator.
+
+Attributes:
+    BACKPRESSURE_POLICIES (tuple): what put does when the queue is full -
+        'block' waits for room (up to block_timeout, then raises),
+        'drop_newest' discards the message being put, 'drop_oldest' discards
+        the oldest queued message, 'raise' raises SendQueueFull immediately
+    LOGGER (logging): The logger (from logging) to handle debugging
+"""
+
+from collections import deque
+from logging import getLogger
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, List
+from kqml import KQMLPerformative
+from .metrics import MetricsRegistry
+
+BACKPRESSURE_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'raise')
+
+LOGGER = getLogger(__name__)
+
+
+class SendQueueFull(Exception):
+    """Raised by OutboundQueue.put when the queue is full (policy 'raise', or
+    'block' after block_timeout)"""
+
+
+# pylint: disable=too-many-instance-attributes
+#   Queue, condition, counters and the writer thread all need to be kept
+class OutboundQueue():
+    """Bounded queue of outgoing messages drained by a writer thread
+
+    Attributes:
+        block_timeout (float): seconds put waits for room under 'block',
+            None waits forever
+        max_batch (int): most messages handed to send_batch at once (i.e. sent
+            on one connection)
+        max_size (int): most messages that can be waiting in the queue
+        metrics (MetricsRegistry): registry for queue length, drops, errors
+            and time spent queued
+        policy (str): one of BACKPRESSURE_POLICIES
+        send_batch (Callable[[List[KQMLPerformative]], None]): sends a list of
+            messages, called from the writer thread
+        writer (Thread): thread draining the queue
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, send_batch: Callable[[List[KQMLPerformative]], None],
+                 metrics: MetricsRegistry, max_size: int = 10000,
+                 max_batch: int = 1, policy: str = 'block',
+                 block_timeout: float = None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f'policy must be one of {BACKPRESSURE_POLICIES}')
+        if max_size < 1 or max_batch < 1:
+            raise ValueError('max_size and max_batch must be at least 1')
+        self.send_batch = send_batch
+        self.metrics = metrics
+        self.max_size = max_size
+        self.max_batch = max_batch
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = deque()
+        self._condition = Condition()
+        self._enqueued = 0  # sequence number of the last message put
+        self._completed = 0  # messages sent, failed or dropped
+        self._closed = False
+        metrics.gauge('kqml_send_queue_length', 'messages waiting to be sent',
+                      lambda: len(self._queue))
+        self._waited = metrics.histogram('kqml_send_queue_wait_seconds',
+                                         'time messages spent queued')
+        self.writer = Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, msg: KQMLPerformative):
+        """Queues msg to be sent, applying the backpressure policy if the
+        queue is full
+
+        Args:
+            msg (KQMLPerformative): message to send
+
+        Raises:
+            SendQueueFull: queue is full under the 'raise' policy, or stayed
+                full for block_timeout under the 'block' policy
+            RuntimeError: the queue has been closed
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('send queue is closed')
+            if len(self._queue) >= self.max_size:
+                if not self._make_room():
+                    return
+            self._enqueued += 1
+            self._queue.append((msg, monotonic()))
+            self._condition.notify_all()
+
+    def _make_room(self) -> bool:
+        """Applies the policy to a full queue (condition held), returns
+        whether the new message should still be queued"""
+        if self.policy == 'block':
+            if not self._condition.wait_for(
+                    lambda: len(self._queue) < self.max_size or self._closed,
+                    self.block_timeout):
+                raise SendQueueFull('send queue stayed full')
+            if self._closed:
+                raise RuntimeError('send queue is closed')
+            return True
+        if self.policy == 'raise':
+            raise SendQueueFull(f'{self.max_size} messages already queued')
+        self.metrics.counter('kqml_send_queue_dropped_total',
+                             'messages dropped because the queue was full',
+                             policy=self.policy).inc()
+        if self.policy == 'drop_newest':
+            return False
+        self._queue.popleft()  # drop_oldest
+        self._completed += 1
+        return True
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits until every message queued before this call has been sent
+        (or has failed to send)
+
+        Args:
+            timeout (float, optional): most seconds to wait, None waits forever
+
+        Returns:
+            bool: True if everything was flushed, False on timeout
+        """
+        with self._condition:
+            target = self._enqueued
+            return self._condition.wait_for(
+                lambda: self._completed >= target, timeout)
+
+    def close(self, timeout: float = None) -> bool:
+        """Flushes for up to timeout seconds, then stops the writer. Anything
+        still queued after that is dropped.
+
+        Args:
+            timeout (float, optional): most seconds to wait for the flush
+
+        Returns:
+            bool: True if everything was sent before closing
+        """
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            if self._queue:
+                LOGGER.warning('Dropping %s unsent message(s)',
+                               len(self._queue))
+                self._queue.clear()
+            self._condition.notify_all()
+        self.writer.join(timeout)
+        return flushed
+
+    def _write(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in
+                         range(min(self.max_batch, len(self._queue)))]
+                self._condition.notify_all()  # room for blocked producers
+            now = monotonic()
+            for _, queued_at in batch:
+                self._waited.observe(now - queued_at)
+            try:
+                self.send_batch([msg for msg, _ in batch])
+            except Exception as error_msg:  # pylint: disable=broad-except
+                # the writer must survive whatever a failed send raises
+                LOGGER.error('Failed to send %s message(s): %s', len(batch),
+                             error_msg)
+                self.metrics.counter('kqml_send_errors_total',
+                                     'messages that failed to send'
+                                     ).inc(len(batch))
+            with self._condition:
+                self._completed += len(batch)
+                self._condition.notify_all()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    prefork.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-23 11:42:07
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-23 11:42:07
+
+"""Prefork mode for CompanionsKQMLModule, runs asks and achieves in worker
+processes so CPU heavy handlers aren't limited to the one core the GIL gives
+a single process. The agent (the parent) keeps the listener, registration and
+everything else (pings, tells, subscriptions), it reads and parses each
+message and hands asks and achieves, together with the connection they were
+read from, to the workers in turn. Each worker runs its own copy of the
+agent, built by a factory, without a listener and without registering, and
+replies to Companions under the same name. Subscriptions stay with the
+agent too, so update_subscription calls made by a worker's handlers are
+relayed to the agent over a pipe and applied there (the data has to be
+picklable).
+
+Connections are handed to a worker as file descriptors (SCM_RIGHTS) on
+POSIX, and with socket.share/socket.fromshare on Windows, where the handle
+duplication multiprocessing does for other handles doesn't cover sockets.
+Workers are started with the spawn method (the same on every platform), so
+the factory has to be picklable - a class or function defined at the top
+level of a module - and a script enabling prefork needs the usual
+if __name__ == '__main__' guard.
+
+Attributes:
+    FORWARDED_PERFORMATIVES (frozenset): performatives handled by the workers
+    LOGGER (logging): The logger (from logging) to handle debugging
+"""
+
+from io import BufferedReader, BytesIO
+from itertools import count
+from logging import getLogger
+from multiprocessing import get_context
+from multiprocessing.reduction import send_handle, recv_handle
+from socket import socket
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable, Hashable
+from kqml import KQMLPerformative, KQMLReader
+from .companionsKQMLModule import CompanionsKQMLModule, \
+     CompanionsKQMLDispatcher
+from .metrics import MetricsRegistry
+from .scheduling import PriorityScheduler, DEFAULT_SHARED
+
+FORWARDED_PERFORMATIVES = frozenset(('ask-one', 'ask-all', 'stream-all',
+                                     'achieve'))
+
+LOGGER = getLogger(__name__)
+
+_SHARE_SOCKETS = hasattr(socket, 'share')  # Windows
+
+
+class PreforkPool():
+    """Worker processes each running a copy of an agent, fed messages (and
+    their connections) by the parent in turn
+
+    Attributes:
+        metrics (MetricsRegistry): the parent's metrics, counting forwarded
+            messages and live workers
+        processes (List[Process]): the worker processes
+        update (Callable[..., None]): applies a subscription update relayed
+            from a worker, None drops them
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, factory: Callable[..., CompanionsKQMLModule],
+                 workers: int, kwargs: dict, metrics: MetricsRegistry,
+                 update: Callable[..., None] = None):
+        """Starts the workers
+
+        Args:
+            factory (Callable[..., CompanionsKQMLModule]): picklable callable
+                building a worker's agent (with its asks and achieves added)
+                from keyword arguments, e.g. the agent's class
+            workers (int): number of worker processes
+            kwargs (dict): keyword arguments for factory, listener_port,
+                reserved_workers and shared_workers are used for the worker's
+                scheduler instead
+            metrics (MetricsRegistry): the parent's metrics
+            update (Callable[..., None], optional): called here like
+                update_subscription with every update a worker's handler
+                makes, e.g. the agent's update_subscription
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        context = get_context('spawn')
+        self.update = update
+        self.metrics = metrics
+        self.processes = []
+        self._channels = []
+        self._locks = []
+        self._relays = []
+        for index in range(workers):
+            channel, worker_channel = context.Pipe()
+            updates, worker_updates = context.Pipe(duplex=False)
+            process = context.Process(target=_serve_worker,
+                                      args=(factory, worker_channel,
+                                            worker_updates, kwargs),
+                                      name=f'prefork-worker-{index}',
+                                      daemon=True)
+            process.start()
+            worker_channel.close()
+            worker_updates.close()
+            relay = Thread(target=self._relay_updates, args=(updates,),
+                           name=f'prefork-updates-{index}', daemon=True)
+            relay.start()
+            self.processes.append(process)
+            self._channels.append(channel)
+            self._locks.append(Lock())
+            self._relays.append(relay)
+        self._turn = count()
+        metrics.gauge('kqml_prefork_workers_alive',
+                      'prefork worker processes running',
+                      lambda: sum(process.is_alive()
+                                  for process in self.processes))
+
+    def forward(self, msg: KQMLPerformative, verb: str,
+                connection: socket) -> bool:
+        """Hands an ask or achieve to the next worker, which closes its copy
+        of the connection once the message has been handled
+
+        Args:
+            msg (KQMLPerformative): message read from connection
+            verb (str): its performative, lower case
+            connection (socket): connection the message was read from
+
+        Returns:
+            bool: False if the message should be handled by the parent (it
+                isn't an ask or achieve, or no worker could take it)
+        """
+        if verb not in FORWARDED_PERFORMATIVES or connection is None:
+            return False
+        data = msg.to_string().encode()
+        for _ in range(len(self.processes)):
+            index = next(self._turn) % len(self.processes)
+            process, channel = self.processes[index], self._channels[index]
+            if channel.closed or not process.is_alive():
+                continue
+            try:
+                with self._locks[index]:
+                    channel.send_bytes(data)
+                    _send_connection(channel, connection, process.pid)
+            except (OSError, ValueError) as error:
+                LOGGER.error('Prefork worker %s is gone (%s)', index, error)
+                channel.close()  # a half sent message would desync it
+                continue
+            self.metrics.counter('kqml_prefork_forwarded_total',
+                                 'messages handed to prefork workers',
+                                 worker=str(index)).inc()
+            return True
+        LOGGER.warning('No prefork worker left, handling %s here', verb)
+        return False
+
+    def close(self, timeout: float = None):
+        """Stops handing out messages and waits (for up to timeout seconds)
+        for the workers to handle what they have and exit, terminating any
+        still running after that
+
+        Args:
+            timeout (float, optional): most seconds to wait
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        for index, channel in enumerate(self._channels):
+            with self._locks[index]:
+                channel.close()  # the worker sees eof, drains and exits
+        for process in self.processes:
+            process.join(None if deadline is None
+                         else max(deadline - monotonic(), 0))
+            if process.is_alive():
+                LOGGER.warning('Terminating prefork worker %s', process.name)
+                process.terminate()
+                process.join()
+        for relay in self._relays:
+            relay.join()  # the worker is gone, its updates pipe is at eof
+
+    def _relay_updates(self, updates):
+        """Applies the subscription updates a worker sends until it exits"""
+        with updates:
+            while True:
+                try:
+                    pattern, args, version, unchanged = updates.recv()
+                except (EOFError, OSError):
+                    return
+                except Exception as error:  # pylint: disable=broad-except
+                    LOGGER.error('Unreadable subscription update from a '
+                                 'prefork worker: %s', error)
+                    continue
+                self.metrics.counter('kqml_prefork_updates_total',
+                                     'subscription updates relayed from '
+                                     'prefork workers').inc()
+                if self.update is None:
+                    LOGGER.warning('Dropping subscription update for %s, '
+                                   'this agent has no subscriptions', pattern)
+                    continue
+                try:
+                    self.update(pattern, *args, version=version,
+                                unchanged=unchanged)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception('Relayed subscription update for %s '
+                                     'failed', pattern)
+
+
+class PreforkWorker():
+    """Host of the agent in a worker process (see AgentHost): no listener,
+    messages come from the parent over a channel, and the agent doesn't
+    register since the parent already has
+
+    Attributes:
+        agent (CompanionsKQMLModule): the worker's agent
+        executor (ThreadPoolExecutor): always None, messages are read from
+            the channel on the worker's main thread
+        listener_port (int): the parent's listener port
+        register_agents (bool): False, the parent owns registration
+        scheduler (PriorityScheduler): workers running the agent's handlers
+        updates (Connection): pipe relaying subscription updates to the
+            parent, None to keep them in this process
+    """
+
+    register_agents = False
+
+    def __init__(self, listener_port: int, reserved_workers: dict = None,
+                 shared_workers: int = DEFAULT_SHARED, updates=None):
+        self.listener_port = listener_port
+        self.executor = None
+        self.scheduler = PriorityScheduler(reserved_workers, shared_workers)
+        self.updates = updates
+        self.agent = None
+        self._updates_lock = Lock()
+
+    def attach(self, agent: CompanionsKQMLModule):
+        """Takes on the worker's agent, called by the agent's init
+
+        Args:
+            agent (CompanionsKQMLModule): agent created with this worker
+        """
+        self.agent = agent
+
+    def detach(self, agent: CompanionsKQMLModule):
+        """Lets go of the agent, called by the agent's exit
+
+        Args:
+            agent (CompanionsKQMLModule): the worker's agent
+        """
+        if self.agent is agent:
+            self.agent = None
+
+    def forward_update(self, pattern: str, args: tuple,
+                       version: Hashable = None, unchanged: bool = False) -> \
+            bool:
+        """Relays a subscription update made by one of the agent's handlers
+        to the parent, which owns the subscriptions (called by Pythonian's
+        update_subscription)
+
+        Args:
+            pattern (str): the subscription pattern
+            args (tuple): the new data
+            version (Hashable, optional): version of the data
+            unchanged (bool, optional): the producer knows nothing changed
+
+        Returns:
+            bool: False if there is no parent to relay to, the update should
+                be kept here
+        """
+        if self.updates is None:
+            return False
+        with self._updates_lock:
+            self.updates.send((pattern, args, version, unchanged))
+        return True
+
+    def serve(self, channel):
+        """Dispatches each message the parent hands over (on this thread,
+        handlers run on the scheduler) until the parent closes the channel,
+        then exits the agent
+
+        Args:
+            channel (Connection): this worker's end of the parent's pipe
+        """
+        agent = self.agent
+        while True:
+            try:
+                data = channel.recv_bytes()
+                connection = _recv_connection(channel)
+            except (EOFError, OSError):
+                break
+            reader = KQMLReader(BufferedReader(BytesIO(data)))
+            dispatcher = CompanionsKQMLDispatcher(agent, reader, agent.name,
+                                                  connection)
+            dispatcher.hold()  # released once read, like a tracked read
+            try:
+                dispatcher.start()
+            finally:
+                dispatcher.release()
+        agent.exit()
+        self.scheduler.shutdown()
+        if self.updates is not None:
+            self.updates.close()
+
+
+def _send_connection(channel, connection: socket, pid: int):
+    """Hands a duplicate of connection to process pid over channel"""
+    if _SHARE_SOCKETS:
+        channel.send_bytes(connection.share(pid))
+    else:
+        send_handle(channel, connection.fileno(), pid)
+
+
+def _recv_connection(channel) -> socket:
+    """The connection _send_connection handed over channel"""
+    if _SHARE_SOCKETS:
+        return socket.fromshare(channel.recv_bytes())
+    return socket(fileno=recv_handle(channel))
+
+
+def _serve_worker(factory: Callable[..., CompanionsKQMLModule], channel,
+                  updates, kwargs: dict):
+    """Entry point of a worker process"""
+    kwargs = dict(kwargs)
+    worker = PreforkWorker(kwargs.pop('listener_port'),
+                           kwargs.pop('reserved_workers', None),
+                           kwargs.pop('shared_workers', DEFAULT_SHARED),
+                           updates)
+    factory(agent_host=worker, **kwargs)
+    worker.serve(channel)
+
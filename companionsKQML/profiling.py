@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    profiling.py
+# @Author:      Samuel Hill
+# @Date:        2021-04-01 10:12:45
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-04-01 10:12:45
+
+"""Profiling for Pythonian ask and achieve functions, to find which handler
+makes an agent slow and where inside it the time goes. A HandlerProfiler
+wraps each handler call (and each answer a generator handler produces) and
+aggregates what it sees by predicate, in one of two modes:
+
+    deterministic - every call runs under cProfile, exact call counts and
+        times, dumped in the pstats format (python -m pstats, snakeviz, ...)
+    sampling - a thread looks at the stacks of the threads running handlers
+        every interval seconds, much cheaper on hot handlers, dumped as
+        collapsed stacks (flamegraph.pl, speedscope, ...) rooted at the
+        predicate
+
+Coroutine functions run on the shared event loop between other coroutines,
+so they are left unprofiled. From Python 3.12 cProfile sees every thread
+rather than just its own, so deterministic mode profiles one call at a time
+(overlapping calls run unprofiled) and includes whatever other threads do
+meanwhile; use sampling for busy agents there.
+
+Attributes:
+    DEFAULT_INTERVAL (float): default seconds between stack samples
+    DETERMINISTIC (str): mode profiling every call with cProfile
+    LOGGER (logging): The logger (from logging) to handle debugging
+    PROFILING_MODES (tuple): the modes a HandlerProfiler can run in
+    SAMPLING (str): mode sampling the stacks of running handlers
+"""
+
+from collections import Counter
+from logging import getLogger
+from os.path import basename
+from sys import _current_frames, _getframe
+from threading import Event, Lock, Thread, get_ident
+from types import GeneratorType
+from typing import Any, Callable, Iterator, List, Sequence, Tuple
+
+DETERMINISTIC = 'deterministic'
+SAMPLING = 'sampling'
+PROFILING_MODES = (DETERMINISTIC, SAMPLING)
+DEFAULT_INTERVAL = 0.005
+
+LOGGER = getLogger(__name__)
+
+
+class HandlerProfiler():
+    """Profiles ask and achieve functions, aggregating by predicate
+
+    Attributes:
+        interval (float): seconds between stack samples (sampling mode)
+        mode (str): one of PROFILING_MODES
+        running (bool): whether calls are still being profiled, a closed
+            profiler keeps its results to be dumped
+    """
+
+    def __init__(self, mode: str = DETERMINISTIC,
+                 interval: float = DEFAULT_INTERVAL):
+        if mode not in PROFILING_MODES:
+            raise ValueError(f'mode must be one of {PROFILING_MODES}, got '
+                             f'{mode}')
+        self.mode = mode
+        self.interval = interval
+        self.running = True
+        self._lock = Lock()
+        self._calls = Counter()
+        self._stats = {}    # predicate -> pstats.Stats, deterministic
+        self._stacks = {}   # predicate -> Counter of stacks, sampling
+        self._active = {}   # thread id -> (predicate, frame calling it)
+        self._sampler = None
+        self._stopped = Event()
+        if mode == SAMPLING:
+            self._sampler = Thread(target=self._sample, daemon=True,
+                                   name='handler-profiler')
+            self._sampler.start()
+
+    def wrap(self, predicate: str, function: Callable[..., Any]) -> \
+            Callable[..., Any]:
+        """The function to call in place of a handler, profiling it under
+        predicate (the handler itself once the profiler is closed, or for a
+        coroutine function)
+
+        Args:
+            predicate (str): name the handler was registered under
+            function (Callable[..., Any]): the ask or achieve function
+
+        Returns:
+            Callable[..., Any]: function, profiled
+        """
+        from inspect import iscoroutinefunction
+        if not self.running or iscoroutinefunction(function):
+            return function
+
+        def profiled(*args):
+            return self.call(predicate, function, args)
+        return profiled
+
+    def call(self, predicate: str, function: Callable[..., Any],
+             args: Sequence) -> Any:
+        """Calls function(*args) profiled under predicate, a generator it
+        returns is profiled as each answer is taken from it
+
+        Args:
+            predicate (str): name the handler was registered under
+            function (Callable[..., Any]): the ask or achieve function
+            args (Sequence): arguments for function
+
+        Returns:
+            Any: what function returned
+        """
+        with self._lock:
+            self._calls[predicate] += 1
+        result = self._run(predicate, function, args)
+        if isinstance(result, GeneratorType):
+            return self._iterate(predicate, result)
+        return result
+
+    def report(self) -> List[Tuple[str, int, float]]:
+        """Calls and time profiled per predicate, most time first (the time
+        is estimated from the samples taken in sampling mode)
+
+        Returns:
+            List[Tuple[str, int, float]]: (predicate, calls, seconds) each
+        """
+        with self._lock:
+            if self.mode == DETERMINISTIC:
+                seconds = {predicate: stats.total_tt
+                           for predicate, stats in self._stats.items()}
+            else:
+                seconds = {predicate: sum(stacks.values()) * self.interval
+                           for predicate, stacks in self._stacks.items()}
+            rows = [(predicate, calls, seconds.get(predicate, 0.0))
+                    for predicate, calls in self._calls.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def stats(self, predicate: str = None):
+        """The deterministic profile of one predicate, or of all of them,
+        e.g. stats('slow').sort_stats('cumulative').print_stats(10)
+
+        Args:
+            predicate (str, optional): name of a handler, None for every one
+
+        Returns:
+            pstats.Stats: a copy of the profile
+
+        Raises:
+            ValueError: not profiling deterministically, or nothing was
+                profiled for predicate
+        """
+        if self.mode != DETERMINISTIC:
+            raise ValueError('stats are only kept in deterministic mode')
+        from pstats import Stats
+        with self._lock:
+            profiles = list(self._stats.values()) if predicate is None \
+                else [self._stats[predicate]] if predicate in self._stats \
+                else []
+            if not profiles:
+                raise ValueError(f'nothing profiled for {predicate or "any"}'
+                                 f' handler')
+            merged = Stats()
+            merged.add(*profiles)
+        return merged
+
+    def collapsed(self, predicate: str = None) -> List[str]:
+        """The sampled stacks of one predicate, or of all of them, in the
+        collapsed format: frames from the predicate down separated by
+        semicolons, then the number of samples
+
+        Args:
+            predicate (str, optional): name of a handler, None for every one
+
+        Returns:
+            List[str]: a line per distinct stack
+
+        Raises:
+            ValueError: not sampling
+        """
+        if self.mode != SAMPLING:
+            raise ValueError('stacks are only kept in sampling mode')
+        with self._lock:
+            stacks = [(name, dict(counts))
+                      for name, counts in self._stacks.items()
+                      if predicate is None or name == predicate]
+        return [f'{";".join((name,) + stack)} {samples}'
+                for name, counts in sorted(stacks)
+                for stack, samples in sorted(counts.items())]
+
+    def dump(self, path: str, predicate: str = None):
+        """Writes the profile of one predicate, or of all of them, to path:
+        a pstats file in deterministic mode, collapsed stacks in sampling
+        mode
+
+        Args:
+            path (str): file to write
+            predicate (str, optional): name of a handler, None for every one
+        """
+        if self.mode == DETERMINISTIC:
+            self.stats(predicate).dump_stats(path)
+            return
+        with open(path, 'w', encoding='utf-8') as file:
+            for line in self.collapsed(predicate):
+                file.write(f'{line}\n')
+
+    def close(self):
+        """Stops profiling, the results so far can still be read and
+        dumped"""
+        self.running = False
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _run(self, predicate: str, function: Callable[..., Any],
+             args: Sequence) -> Any:
+        if self.mode == SAMPLING:
+            thread = get_ident()
+            with self._lock:
+                self._active[thread] = (predicate, _getframe())
+            try:
+                return function(*args)
+            finally:
+                with self._lock:
+                    del self._active[thread]
+        from cProfile import Profile
+        profile = Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active (Python 3.12+)
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self._merge(predicate, profile)
+
+    def _iterate(self, predicate: str, generator: GeneratorType) -> Iterator:
+        """Profiles each answer as it is taken from a generator handler"""
+        try:
+            while True:
+                try:
+                    answer = self._run(predicate, next, (generator,))
+                except StopIteration:
+                    return
+                yield answer
+        finally:
+            generator.close()
+
+    def _merge(self, predicate: str, profile):
+        from pstats import Stats
+        try:
+            stats = Stats(profile)
+        except TypeError:  # nothing was recorded
+            return
+        with self._lock:
+            if predicate in self._stats:
+                self._stats[predicate].add(stats)
+            else:
+                self._stats[predicate] = stats
+
+    def _sample(self):
+        """Sampling thread, counts the stack of every running handler from
+        the frame it was called from down"""
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                if not self._active:
+                    continue
+                active = list(self._active.items())
+            frames = _current_frames()
+            samples = []
+            for thread, (predicate, caller) in active:
+                frame, stack = frames.get(thread), []
+                while frame is not None and frame is not caller:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if frame is caller and stack:
+                    samples.append((predicate, tuple(reversed(stack))))
+            with self._lock:
+                for predicate, stack in samples:
+                    self._stacks.setdefault(predicate, Counter())[stack] += 1
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({basename(code.co_filename)}:' \
+        f'{code.co_firstlineno})'
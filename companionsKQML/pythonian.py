@@ -15,14 +15,25 @@ Attributes:
     LOGGER (logging): The logger (from logging) to handle debugging
 """
 
-from inspect import getfullargspec
+from functools import partial
 from logging import getLogger, DEBUG, INFO
-from threading import Thread
-from time import sleep
+from string import Formatter
+from threading import Lock, Thread
+from time import perf_counter
 from traceback import print_exc
-from typing import Any, Callable
-from kqml import KQMLPerformative, KQMLList
-from .companionsKQMLModule import CompanionsKQMLModule, listify, performative
+from typing import Any, Callable, Hashable, Iterable, Iterator, List, \
+     Optional, Sequence, Tuple, TYPE_CHECKING
+from kqml import KQMLPerformative, KQMLList, KQMLString
+from .companionsKQMLModule import CompanionsKQMLModule, EncodedPerformative, \
+     listify, performative
+from .deadlines import abandoned_handlers, call_with_deadline, \
+     HandlerRefused, HandlerTimeout
+from .scheduling import PRIORITY_CLASSES
+from .sharedmem import SharedPayloads, DEFAULT_THRESHOLD, DEFAULT_TTL
+from .tracing import current_trace
+
+if TYPE_CHECKING:
+    from .profiling import HandlerProfiler
 
 LOGGER = getLogger(__name__)
 
@@ -36,39 +47,103 @@ class Pythonian(CompanionsKQMLModule):
     queries, subscribable
 
     Attributes:
+        achieve_priorities (dict): priority class of achieves that were
+            registered with one, by name
+        achieve_timeouts (dict): seconds achieves registered with a timeout
+            may run for, by name
         achieves (dict): dictionary of functions to call on achieve of a given
             name. Usually the function name is the name used in the achieve
             queries but the name can be anything that you specify when adding
             the achieve.
+        ask_answer_limits (dict): most answers sent back to an ask-all or
+            stream-all, for asks registered with a limit, by name
+        ask_priorities (dict): priority class of asks that were registered
+            with one, by name
+        ask_timeouts (dict): seconds asks registered with a timeout may run
+            for, by name
+        handler_timeout (float): seconds any ask or achieve without a timeout
+            of its own may run for before an error is sent back, None for no
+            limit
         asks (dict): dictionary of functions to call on ask of a given
             name. Usually the function name is the name used in the ask
             queries but the name can be anything that you specify when adding
             the ask.
         name (str): This is the name your agent will register with
         poller (Thread): thread that controls polling for updates to the
-            subscriptions and dispatches those updates accordingly
+            subscriptions and dispatches those updates accordingly, None when
+            hosted (the AgentHost polls every agent it hosts)
         polling_interval (int): the interval at which the polling thread will
             check for new data
+        profile_directory (str): directory the dump_handler_profile
+            achieve writes to, None unless remote profiling is enabled
+        profiler (HandlerProfiler): profiler of the ask and achieve
+            functions, kept once disabled so its results can still be
+            dumped, None if profiling was never enabled
+        shared (SharedPayloads): side channel passing large buffers between
+            agents on this host through shared memory, None when disabled
         subscriptions (SubscriptionManager): customized dictionary of patterns
             with the associated data and subscribers.
     """
 
     name = "Pythonian"
 
-    def __init__(self, **kwargs):
+    def __init__(self, handler_timeout: float = None, profile: str = None,
+                 profile_directory: str = None, **kwargs):
         self.achieves = {}
         self.asks = {}
+        self.achieve_priorities = {}
+        self.ask_priorities = {}
+        self.achieve_timeouts = {}
+        self.ask_timeouts = {}
+        self.ask_answer_limits = {}
+        self.handler_timeout = handler_timeout
         self.subscriptions = SubscriptionManager()
         self.polling_interval = 1
-        self.poller = Thread(target=self.poll_for_subscription_updates,
-                             args=[])
-        LOGGER.info('Starting subcription poller...')
-        self.poller.start()
+        self.poller = None
+        self.shared = None
+        self.profiler = None
+        self.profile_directory = None
+        self._profiling_controls = ()
+        if profile_directory is not None:
+            self.enable_remote_profiling(profile_directory)
+        if kwargs.get('agent_host') is None:
+            self.poller = Thread(target=self.poll_for_subscription_updates,
+                                 args=[])
         super().__init__(**kwargs)
         if self.debug:
             LOGGER.setLevel(DEBUG)
         else:
             LOGGER.setLevel(INFO)
+        self.metrics.gauge('pythonian_abandoned_handlers',
+                           'timed out ask/achieve functions still running',
+                           abandoned_handlers)
+        if profile is not None:
+            self.enable_profiling(profile)
+        if self.poller is not None:
+            LOGGER.info('Starting subcription poller...')
+            self.poller.start()
+
+    def priority_of(self, msg: KQMLPerformative) -> str:
+        """Override of CompanionsKQMLModule priority_of, asks and achieves
+        registered with a priority class are handled under that class
+
+        Args:
+            msg (KQMLPerformative): message read from Companions
+
+        Returns:
+            str: one of scheduling.PRIORITY_CLASSES
+        """
+        verb = str(msg.head()).lower()
+        content = msg.get('content')
+        priority = None
+        if verb in ('ask-one', 'ask-all', 'stream-all') and \
+                isinstance(content, KQMLList):
+            priority = self.ask_priorities.get(content.head())
+        elif verb == 'achieve' and isinstance(content, KQMLList):
+            action = content.get('action')
+            if isinstance(action, KQMLList):
+                priority = self.achieve_priorities.get(action.head())
+        return priority or super().priority_of(msg)
 
     ###########################################################################
     #                              Tell Function                              #
@@ -104,7 +179,9 @@ class Pythonian(CompanionsKQMLModule):
     #                            Ask-one Functions                            #
     ###########################################################################
 
-    def add_ask(self, func: Callable[..., Any], name: str = None):
+    def add_ask(self, func: Callable[..., Any], name: str = None,
+                priority: str = None, timeout: float = None,
+                max_answers: int = None):
         """Adds the given function (func) to the dictionary of asks under the
         key of the given name. If subscribable is true then we also add the
         pattern to our subscription dictionary and advertise it.
@@ -112,6 +189,14 @@ class Pythonian(CompanionsKQMLModule):
         Arguments:
             func (Callable[..., Any]): function to be called on ask query
             name (str, optional): name to pair to this function for query calls
+            priority (str, optional): priority class to handle this ask under
+                (see scheduling.PRIORITY_CLASSES), defaults to 'ask'
+            timeout (float, optional): seconds the function may run before
+                an error is sent back and it is cancelled (see deadlines.py),
+                defaults to handler_timeout
+            max_answers (int, optional): most answers to send back to an
+                ask-all or stream-all, the rest are never produced if func is
+                a generator, defaults to no limit
 
         Raises:
             ValueError: func must be a callable function
@@ -121,9 +206,12 @@ class Pythonian(CompanionsKQMLModule):
         if name is not None:
             if not isinstance(name, str):
                 raise ValueError('name must be a string')
-            self.asks[name] = func
         else:
-            self.asks[func.__name__] = func
+            name = func.__name__
+        _set_priority(self.ask_priorities, name, priority)
+        _set_timeout(self.ask_timeouts, name, timeout)
+        _set_limit(self.ask_answer_limits, name, max_answers)
+        self.asks[name] = func
 
     def receive_ask_one(self, msg: KQMLPerformative, content: KQMLList):
         """Override of default ask one, creates Companions style responses.
@@ -142,34 +230,159 @@ class Pythonian(CompanionsKQMLModule):
         Returns:
             None: returns only to exit function early if conditions aren't met
         """
+        bounded = self._ask_arguments(msg, content)
+        if bounded is None:
+            return
+        LOGGER.info('received ask-one %s', content.head())
+        try:
+            results = self.call_handler('ask', content.head(), bounded)
+        except Exception as error:  # pylint: disable=broad-except
+            self._handler_error_reply(msg, content.head(), error)
+            return
+        LOGGER.debug('Ask-one returned results: %s', results)
+        self.response_to_query(msg, content, results, msg.get('response'))
+
+    def receive_ask_all(self, msg: KQMLPerformative, content: KQMLList):
+        """Override of default ask all, the ask function is called as for an
+        ask-one but what it returns is taken as a sequence of answers (a list,
+        or any iterable such as a generator yielding them one at a time),
+        each handled like the results of an ask-one. All of the answers are
+        sent back together in a single tell, encoded as they are produced.
+
+        Arguments:
+            msg (KQMLPerformative): reply mechanism
+            content (KQMLList): predicate to look up in asks dict, arguments of
+                the ask call - to be passed in to the call.
+        """
+        self._answer_all(msg, content, 'ask-all', self.answers_to_query)
+
+    def receive_stream_all(self, msg: KQMLPerformative, content: KQMLList):
+        """Override of default stream all, answers are found as for an ask-all
+        but each one is sent back in its own tell as soon as it is produced,
+        followed by an eos once there are no more.
+
+        Arguments:
+            msg (KQMLPerformative): reply mechanism
+            content (KQMLList): predicate to look up in asks dict, arguments of
+                the ask call - to be passed in to the call.
+        """
+        self._answer_all(msg, content, 'stream-all',
+                         self.stream_answers_to_query)
+
+    def _answer_all(self, msg: KQMLPerformative, content: KQMLList, verb: str,
+                    respond: Callable[..., None]):
+        bounded = self._ask_arguments(msg, content)
+        if bounded is None:
+            return
+        LOGGER.info('received %s %s', verb, content.head())
+        predicate = content.head()
+        timeout = self.ask_timeouts.get(predicate, self.handler_timeout)
+        deadline = None if timeout is None else perf_counter() + timeout
+        try:
+            answers = self.call_handler('ask', predicate, bounded)
+            if answers is None:
+                answers = ()
+            elif isinstance(answers, str) or \
+                    not isinstance(answers, Iterable):
+                answers = (answers,)
+            respond(msg, content,
+                    _take_answers(answers, self.ask_answer_limits.get(
+                        predicate), deadline, timeout),
+                    msg.get('response'))
+        except Exception as error:  # pylint: disable=broad-except
+            self._handler_error_reply(msg, predicate, error)
+
+    def _ask_arguments(self, msg: KQMLPerformative,
+                       content: KQMLList) -> Optional[list]:
+        """Finds the bound arguments of an ask, replying with an error (and
+        returning None) if the ask isn't known or takes other arguments"""
         if content.head() not in self.asks:
             error_msg = f'No ask query predicate named {content.head()} known'
             LOGGER.warning(error_msg)
             self.error_reply(msg, error_msg)
-            return
+            return None
         bounded = []
         for each in content.data[1:]:
             if str(each[0]) != '?':
                 bounded.append(each)
+        from inspect import getfullargspec
+        trace = current_trace()
+        trace.annotate(predicate=str(content.head()))
         ask_question = self.asks[content.head()]
         # TODO - same argument structure issue as achieve, won't work with self
-        expected_args = len(getfullargspec(ask_question).args)
+        with trace.span('argspec'):
+            expected_args = len(getfullargspec(ask_question).args)
         if expected_args != len(bounded):
             error_msg = (f'Expected {expected_args} input arguments to query '
                          f'predicate {content.head()}, got {len(bounded)}')
             LOGGER.warning(error_msg)
             self.error_reply(msg, error_msg)
+            return None
+        return bounded
+
+    def _handler_error_reply(self, msg: KQMLPerformative, predicate: Any,
+                             error: Exception):
+        """Replies with an error for an ask or achieve function that timed
+        out or raised"""
+        if isinstance(error, HandlerTimeout):
+            self.error_reply(msg, f'{predicate} {error}')
             return
-        LOGGER.info('received ask-one %s', content.head())
+        LOGGER.warning('Failed execution: %s, %s', error, print_exc())
+        self.error_reply(msg,
+                         f'An error occurred while executing: {predicate}')
+
+    def call_handler(self, kind: str, predicate: Any, args: list) -> Any:
+        """Calls the ask or achieve function registered for predicate within
+        its timeout, recording its latency, failures and timeouts (labeled
+        by predicate so hot handlers stand out)
+
+        Args:
+            kind (str): 'ask' or 'achieve'
+            predicate (Any): name the function was registered under
+            args (list): arguments for the function
+
+        Returns:
+            Any: what the function returned
+
+        Raises:
+            HandlerRefused: too many timed out functions are still running
+            HandlerTimeout: the function ran past its timeout
+            Exception: whatever the function raised
+        """
+        handlers, timeouts = ((self.asks, self.ask_timeouts) if kind == 'ask'
+                              else (self.achieves, self.achieve_timeouts))
+        timeout = timeouts.get(predicate, self.handler_timeout)
+        labels = {'kind': kind, 'predicate': str(predicate)}
+        handler = handlers[predicate]
+        profiler = self.profiler
+        if profiler is not None and handler not in self._profiling_controls:
+            handler = profiler.wrap(labels['predicate'], handler)
+        start = perf_counter()
         try:
-            results = self.asks[content.head()](*bounded)
-        except (TypeError, ValueError) as except_msg:
-            LOGGER.warning('Failed execution: %s, %s', except_msg, print_exc())
-            error_msg = f'An error occurred while executing: {content.head()}'
-            self.error_reply(msg, error_msg)
-            return
-        LOGGER.debug('Ask-one returned results: %s', results)
-        self.response_to_query(msg, content, results, msg.get('response'))
+            with current_trace().span('handler'):
+                return call_with_deadline(handler, args, timeout)
+        except HandlerRefused:
+            self.metrics.counter('pythonian_handler_refusals_total',
+                                 'ask/achieve functions not started while '
+                                 'too many timed out ones were running',
+                                 **labels).inc()
+            raise
+        except HandlerTimeout:
+            LOGGER.warning('%s %s timed out after %ss', kind, predicate,
+                           timeout)
+            self.metrics.counter('pythonian_handler_timeouts_total',
+                                 'ask/achieve functions that ran past their '
+                                 'timeout', **labels).inc()
+            raise
+        except Exception:
+            self.metrics.counter('pythonian_handler_errors_total',
+                                 'ask/achieve functions that raised',
+                                 **labels).inc()
+            raise
+        finally:
+            self.metrics.histogram('pythonian_handler_seconds',
+                                   'time spent in ask/achieve functions',
+                                   **labels).observe(perf_counter() - start)
 
     ###########################################################################
     #                            Achieve Functions                            #
@@ -181,17 +394,22 @@ class Pythonian(CompanionsKQMLModule):
     def achieve_on_agent(self, receiver: str, data: Any):
         """Sends a KQML achieve to the receiver with the data input as a list.
         The data is passed through listify to assign it to the proper KQML
-        types so keep this in mind when passing alond the achieve.
+        types so keep this in mind when passing alond the achieve. With
+        shared memory enabled, large buffers in data are passed through it
+        (see enable_shared_memory).
 
         Arguments:
             receiver (str): name of the receiving agent
             data (Any): content to send along with achieve
         """
+        if self.shared is not None:
+            data = self.shared.encode(data)
         msg = performative(f'(achieve :sender {self.name} :receiver {receiver}'
                            f' :content {listify(data)})')
         self.send(msg)
 
-    def add_achieve(self, func: Callable[..., Any], name: str = None):
+    def add_achieve(self, func: Callable[..., Any], name: str = None,
+                    priority: str = None, timeout: float = None):
         """Adds the given function (func) to the dictionary of achieves under
         the key of the given name. If no name is given (which is the default)
         the function name is used.
@@ -201,15 +419,24 @@ class Pythonian(CompanionsKQMLModule):
                 function (with given name or - if not given - function name)
             name (str, optional): name of function to look for on achieve,
                 defaults to function.__name__ (key in achieves dictionary)
+            priority (str, optional): priority class to handle this achieve
+                under (see scheduling.PRIORITY_CLASSES), e.g. 'ask' for a
+                quick achieve that shouldn't wait behind long ones, defaults
+                to 'achieve'
+            timeout (float, optional): seconds the function may run before
+                an error is sent back and it is cancelled (see deadlines.py),
+                defaults to handler_timeout
         """
         if not callable(func):
             raise ValueError('func must be a callable function')
         if name is not None:
             if not isinstance(name, str):
                 raise ValueError('name must be a string')
-            self.achieves[name] = func
         else:
-            self.achieves[func.__name__] = func
+            name = func.__name__
+        _set_priority(self.achieve_priorities, name, priority)
+        _set_timeout(self.achieve_timeouts, name, timeout)
+        self.achieves[name] = func
 
     def receive_achieve(self, msg: KQMLPerformative, content: KQMLList):
         """Overrides the default KQMLModule receive for achieves and instead
@@ -242,13 +469,17 @@ class Pythonian(CompanionsKQMLModule):
             LOGGER.warning(error_msg)
             self.error_reply(msg, error_msg)
             return
+        from inspect import getfullargspec
+        trace = current_trace()
+        trace.annotate(predicate=str(action.head()))
         achieve_question = self.achieves[action.head()]
         # TODO - argument structure and call won't work if the self argument
         # is needed. Easy enough to filter out the arguments but it will be
         # harder to use self if that self argument doesn't correlate to a
         # pythonian object... ie if someone passes in a function that is from
         # inside another class.
-        question_args = getfullargspec(achieve_question).args
+        with trace.span('argspec'):
+            question_args = getfullargspec(achieve_question).args
         # call_needs_self = False
         # if question_args[0] is 'self':
         #     question_args = question_args[1:]
@@ -261,31 +492,154 @@ class Pythonian(CompanionsKQMLModule):
             LOGGER.warning(error_msg)
             self.error_reply(msg, error_msg)
             return
+        if self.shared is not None:
+            try:
+                actual_args = [self.shared.resolve(each)
+                               for each in actual_args]
+            except ValueError as error:
+                LOGGER.warning('%s', error)
+                self.error_reply(msg, str(error))
+                return
         LOGGER.info('received achieve %s', action.head())
         try:
-            results = self.achieves[action.head()](*actual_args)
-        except (TypeError, ValueError) as except_msg:
+            results = self.call_handler('achieve', action.head(), actual_args)
+        except HandlerTimeout as timeout:
+            self.error_reply(msg, f'{action.head()} {timeout}')
+            return
+        except Exception as except_msg:  # pylint: disable=broad-except
             LOGGER.warning('Failed execution: %s, %s', except_msg, print_exc())
             error_msg = f'An error occurred while executing {action.head()}'
             self.error_reply(msg, error_msg)
             return
         LOGGER.debug('Acheive returned results: %s', results)
-        reply = performative(f'(tell :sender {self.name} :content '
-                             f'{listify(results)})')
+        with trace.span('encode'):
+            reply = performative(f'(tell :sender {self.name} :content '
+                                 f'{listify(results)})')
         self.reply(msg, reply)
 
+    def enable_shared_memory(self, threshold: int = DEFAULT_THRESHOLD,
+                             ttl: float = DEFAULT_TTL,
+                             directory: str = None) -> SharedPayloads:
+        """Passes large buffers (bytes, arrays, numpy arrays) between
+        Pythonian agents on this host through shared memory instead of as
+        KQML text. achieve_on_agent sends a small handle in place of each
+        buffer of at least threshold bytes and receive_achieve hands the
+        function a view of the shared payload, with no copy or parse. Both
+        agents have to enable it (see sharedmem.py).
+
+        Args:
+            threshold (int, optional): size in bytes from which buffers are
+                shared
+            ttl (float, optional): seconds a sent handle stays claimable
+                before its payload is deleted
+            directory (str, optional): directory for the shared files,
+                defaults to /dev/shm (the same for every agent on the host)
+
+        Returns:
+            SharedPayloads: the side channel in use
+        """
+        if self.shared is None:
+            self.shared = SharedPayloads(self.metrics, threshold, ttl,
+                                         directory)
+        return self.shared
+
+    def disable_shared_memory(self):
+        """Stops using shared memory, deleting payloads sent and not yet
+        claimed"""
+        shared, self.shared = self.shared, None
+        if shared is not None:
+            shared.close()
+
+    def enable_profiling(self, mode: str = 'deterministic',
+                         interval: float = None) -> 'HandlerProfiler':
+        """Profiles every ask and achieve function call, aggregated by
+        predicate, without restarting the agent: deterministically with
+        cProfile (dumped as pstats) or by sampling the stacks of running
+        handlers (dumped as collapsed stacks, see profiling.py). Companions
+        can do the same once enable_remote_profiling is called. Enabling
+        again starts over.
+
+        Args:
+            mode (str, optional): 'deterministic' or 'sampling'
+            interval (float, optional): seconds between stack samples,
+                defaults to profiling.DEFAULT_INTERVAL
+
+        Returns:
+            HandlerProfiler: the profiler in use
+        """
+        from .profiling import HandlerProfiler, DEFAULT_INTERVAL
+        profiler = HandlerProfiler(mode, interval or DEFAULT_INTERVAL)
+        previous, self.profiler = self.profiler, profiler
+        if previous is not None:
+            previous.close()
+        LOGGER.info('Profiling handlers (%s)', mode)
+        return profiler
+
+    def enable_remote_profiling(self, directory: str):
+        """Lets Companions control profiling with two achieves:
+        (profile_handlers deterministic|sampling|off) and
+        (dump_handler_profile "name"), which writes the profile to a file of
+        that name in directory (nowhere else, names with a path are
+        refused) and replies with the calls and seconds per predicate. The
+        achieves themselves are never profiled.
+
+        Args:
+            directory (str): directory for the dumped profiles, created if
+                it doesn't exist
+        """
+        from os import makedirs
+        from os.path import abspath
+        self.profile_directory = abspath(directory)
+        makedirs(self.profile_directory, exist_ok=True)
+        controls = (partial(_profile_handlers, self),
+                    partial(_dump_handler_profile, self))
+        self.add_achieve(controls[0], name='profile_handlers')
+        self.add_achieve(controls[1], name='dump_handler_profile')
+        self._profiling_controls = controls
+
+    def disable_profiling(self):
+        """Stops profiling handlers, the profiler keeps its results"""
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.close()
+            LOGGER.info('Stopped profiling handlers')
+
+    def dump_profile(self, path: str, predicate: str = None) -> \
+            List[Tuple[str, int, float]]:
+        """Writes the handler profile so far to path, pstats in
+        deterministic mode and collapsed stacks in sampling mode
+
+        Args:
+            path (str): file to write
+            predicate (str, optional): only this ask or achieve, defaults to
+                all of them
+
+        Returns:
+            List[Tuple[str, int, float]]: (predicate, calls, seconds) for
+                each profiled handler, most time first
+
+        Raises:
+            ValueError: profiling was never enabled, or nothing has been
+                profiled yet
+        """
+        if self.profiler is None:
+            raise ValueError('profiling is not enabled')
+        self.profiler.dump(path, predicate)
+        return self.profiler.report()
+
     ###########################################################################
     #                          Subscription Functions                         #
     ###########################################################################
 
-    # CURRENTLY UNUSED... Can we even receive plain old ask-alls?
     def advertise(self, pattern: str):
         """Sends an advertise message for an ask-all command with the content
-        set to the input pattern
+        set to the input pattern, answered by receive_ask_all (nothing is
+        sent from a prefork worker, the parent advertises)
 
         Arguments:
             pattern (str): content to be advertised as an ask-all
         """
+        if not self._advertises():
+            return
         reply_id = f'id{self.reply_id_counter}'
         self.reply_id_counter += 1
         msg = performative(f'(advertise :sender {self.name} :receiver '
@@ -296,12 +650,15 @@ class Pythonian(CompanionsKQMLModule):
 
     def advertise_subscribe(self, pattern: str):
         """Sends an advertise message for an subscribe to an ask-all command
-        with the content set to the input pattern
+        with the content set to the input pattern (nothing is sent from a
+        prefork worker, the parent advertises)
 
         Arguments:
             pattern (str): content to be advertised as a subscription to an
                 ask-all
         """
+        if not self._advertises():
+            return
         reply_id = f'id{self.reply_id_counter}'
         self.reply_id_counter += 1
         msg = performative(f'(advertise :sender {self.name} :receiver '
@@ -312,6 +669,11 @@ class Pythonian(CompanionsKQMLModule):
                            f'{pattern})))')
         self.send(msg)
 
+    def _advertises(self) -> bool:
+        """Whether this agent sends its own advertises, not when its host
+        (a prefork worker) leaves that to a parent that already has"""
+        return self.agent_host is None or self.agent_host.register_agents
+
     def add_subscription(self, pattern: str):
         """Parses pattern for a function and (unless one is given) uses that
         as the underlying ask function (stored by add_ask). Advertises the
@@ -335,7 +697,9 @@ class Pythonian(CompanionsKQMLModule):
         self.advertise_subscribe(pattern)
         self.num_subs += 1
 
-    def update_subscription(self, pattern: str, *args: Any):
+    def update_subscription(self, pattern: str, *args: Any,
+                            version: Hashable = None,
+                            unchanged: bool = False):
         """Looks to see if the arguments to pattern have changes since last
         time, if so it will update those arguments in the subscription manager.
 
@@ -345,8 +709,17 @@ class Pythonian(CompanionsKQMLModule):
                 or, by default used in a substitution pattern). For conveneince
                 you can enter each variable to be bound as a positional
                 argument and this will gather them up.
+            version (Hashable, optional): version number (or fingerprint) of
+                the data, if given the data only counts as changed when the
+                version differs from the last one - a constant time check
+                instead of comparing the data itself
+            unchanged (bool, optional): the producer knows nothing changed,
+                skips the check altogether
         """
-        self.subscriptions.update(pattern, args)
+        forward = getattr(self.agent_host, 'forward_update', None)
+        if forward is not None and forward(pattern, args, version, unchanged):
+            return  # a prefork worker, the parent owns the subscriptions
+        self.subscriptions.update(pattern, args, version, unchanged)
 
     def receive_subscribe(self, msg: KQMLPerformative, content: KQMLList):
         """Override of KQMLModule default, expects a performative of ask-all.
@@ -384,7 +757,9 @@ class Pythonian(CompanionsKQMLModule):
             self.error_reply(msg, error_msg)
             return
         LOGGER.info('received subscription %s to %s', msg, pattern)
-        self.subscriptions.subscribe(pattern, msg)
+        current_trace().annotate(predicate=str(query.head()))
+        with current_trace().span('subscribe'):
+            self.subscriptions.subscribe(pattern, msg)
         reply_msg = f'(tell :sender {self.name} :content :ok)'
         self.reply(msg, performative(reply_msg))
 
@@ -392,27 +767,56 @@ class Pythonian(CompanionsKQMLModule):
         """Goes through the subscription updates as they come in and properly
         respond to the query."""
         while self.ready:
-            for _, subscription in self.subscriptions.items():
-                if subscription.new_data is not None:
-                    LOGGER.debug('updating subscriptions for %s', subscription)
-                    for subscriber in subscription:
-                        ask = subscriber.get('content')
-                        query = ask.get('content')
-                        self.response_to_query(subscriber, query,
-                                               subscription.new_data,
-                                               ask.get('response'))
-                    subscription.retire_data()
-            sleep(self.polling_interval)
-
-    def exit(self, n: int = 0):
+            self.push_subscription_updates()
+            self.shutdown_event.wait(self.polling_interval)
+
+    def push_subscription_updates(self):
+        """Pushes the new data of every subscription that has some to its
+        subscribers (one polling pass)"""
+        for pattern, subscription in self.subscriptions.snapshot():
+            data = subscription.take_data()
+            if data is not None:
+                LOGGER.debug('updating subscriptions for %s', subscription)
+                self.push_update(subscription, data)
+                self.metrics.counter(
+                    'pythonian_subscription_pushes_total',
+                    'subscription updates sent to subscribers',
+                    pattern=pattern).inc(len(subscription))
+
+    def push_update(self, subscription: 'Subscription', data: Any):
+        """Sends data to every subscriber of a subscription. Subscribers are
+        grouped by their query and :response type, the reply is built and
+        serialized once per group and only the receiver and in-reply-to
+        differ between the subscribers of a group.
+
+        Args:
+            subscription (Subscription): subscription to push to
+            data (Any): the subscription's new data
+        """
+        groups = {}
+        for subscriber in subscription:
+            ask = subscriber.get('content')
+            query, response = ask.get('content'), ask.get('response')
+            key = (query.to_string(), str(response).lower())
+            groups.setdefault(key, (query, response, []))[2].append(subscriber)
+        for query, response, subscribers in groups.values():
+            self.reply_to_all(subscribers,
+                              self._query_reply(query, data, response))
+
+    def exit(self, n: int = 0, timeout: float = None):
         """Override of companionsKQMLModule exit, calls super().exit(n) and
-        then joins the polling Thread.
+        then joins the polling Thread. The poller waits on the shutdown event
+        rather than sleeping so the join returns without a polling delay.
 
         Args:
             n (int, optional): the value to pass along to sys.exit
+            timeout (float, optional): seconds to wait for in-flight messages
         """
-        super().exit(n)
-        self.poller.join()
+        super().exit(n, timeout)
+        self.disable_shared_memory()
+        self.disable_profiling()
+        if self.poller is not None:
+            self.poller.join()
 
     ###########################################################################
     #                             Insert Functions                            #
@@ -462,13 +866,232 @@ class Pythonian(CompanionsKQMLModule):
         for data in data_list:
             self.insert_to_microtheory(receiver, data, mt_name, wm_only)
 
+    # pylint: disable=too-many-arguments
+    def load_facts(self, receiver: str, predicate: str,
+                   rows: Iterable[Sequence] = None,
+                   columns: Sequence[Sequence] = None, mt_name: str = None,
+                   wm_only: bool = False, batch_size: int = 10000) -> int:
+        """Inserts a fact for every row of tabular data, e.g. a csv reader,
+        a list of tuples or NumPy column arrays. Values are encoded by the
+        listify rules (tokens, quoted strings, t/nil, numbers) a column at a
+        time, batch_size rows at a time, and each fact is sent as a ready
+        encoded insert - there is no per fact performative to build or parse.
+        Numeric and boolean NumPy columns are converted in one go.
+
+        Arguments:
+            receiver (str): name of the receiver (agent with a kb to insert to)
+            predicate (str): predicate name, e.g. 'population' makes facts
+                (population <col 1> <col 2> ...), or a template with a {}
+                slot per column, e.g. '(isa {} City)'
+            rows (Iterable[Sequence], optional): the rows, empty ones are
+                skipped and so are (with a warning) rows with another number
+                of values than the first row or the template's slots
+            columns (Sequence[Sequence], optional): the columns instead, all
+                the same length
+            mt_name (str, optional): microtheory to insert the facts into
+                (with ist-Information), None inserts them as they are
+            wm_only (bool, optional): whether or not this should only be
+                inserted into the working memory (default: False)
+            batch_size (int, optional): rows encoded at a time
+
+        Returns:
+            int: number of facts sent
+
+        Raises:
+            ValueError: not exactly one of rows and columns was given, the
+                columns aren't all the same length or don't fit the template
+        """
+        if (rows is None) == (columns is None):
+            raise ValueError('pass exactly one of rows and columns')
+        head = (f'(insert :sender {self.name} :receiver {receiver} '
+                f':wm-only? {"t" if wm_only else "nil"} :content ')
+        tail = ')'
+        if mt_name is not None:
+            head, tail = f'{head}(ist-Information {mt_name} ', '))'
+        sent = 0
+        for facts in _fact_batches(predicate, rows, columns, batch_size):
+            for fact in facts:
+                self.send(EncodedPerformative(
+                    'insert', f'{head}{fact}{tail}'.encode()))
+            sent += len(facts)
+        return sent
+
+
+def _fact_batches(predicate: str, rows: Optional[Iterable[Sequence]],
+                  columns: Optional[Sequence[Sequence]],
+                  batch_size: int) -> Iterator[List[str]]:
+    """Yields the facts (see Pythonian.load_facts) batch_size at a time"""
+    width = None
+    if '{' in predicate:
+        make = predicate.format
+        width = sum(field is not None
+                    for _, field, _, _ in Formatter().parse(predicate))
+    else:
+        prefix = f'({predicate} '
+
+        def make(*values):
+            return f'{prefix}{" ".join(values)})'
+    if columns is not None:
+        lengths = {len(column) for column in columns}
+        if len(lengths) > 1:
+            raise ValueError('columns must all be the same length')
+        if width is not None and len(columns) != width:
+            raise ValueError(f'{len(columns)} columns for a template with '
+                             f'{width} slots')
+        length = lengths.pop() if lengths else 0
+        batches = ([column[start:start + batch_size] for column in columns]
+                   for start in range(0, length, batch_size))
+    else:
+        batches = _row_batches(rows, width, batch_size)
+    for batch in batches:
+        yield [make(*values)
+               for values in zip(*(_encode_column(column)
+                                   for column in batch))]
+
+
+def _row_batches(rows: Iterable[Sequence], width: Optional[int],
+                 batch_size: int) -> Iterator[List[tuple]]:
+    """Yields the columns of batch_size rows at a time, skipping empty rows
+    and (with a warning) rows that aren't width values long, width is taken
+    from the first row unless given"""
+    batch = []
+    for number, row in enumerate(rows, 1):
+        if not len(row):  # pylint: disable=len-as-condition
+            continue
+        if width is None:
+            width = len(row)
+        if len(row) != width:
+            LOGGER.warning('Skipping row %s, it has %s values instead of %s',
+                           number, len(row), width)
+            continue
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield list(zip(*batch))
+            batch = []
+    if batch:
+        yield list(zip(*batch))
+
+
+def _encode_column(values: Sequence) -> List[str]:
+    """Encodes values by the listify rules, NumPy numbers and booleans in one
+    call, anything else once per distinct value"""
+    dtype = getattr(values, 'dtype', None)  # NumPy, without importing it
+    if dtype is not None:
+        if dtype.kind in 'iuf':
+            return values.astype(str).tolist()
+        if dtype.kind == 'b':
+            return ['t' if value else 'nil' for value in values.tolist()]
+        values = values.tolist()
+    encoded, seen = [], {}
+    for value in values:
+        key = (value.__class__, value)  # keeps 1, 1.0 and True apart
+        try:
+            text = seen.get(key)
+        except TypeError:  # unhashable, e.g. a list
+            encoded.append(listify(value).to_string())
+            continue
+        if text is None:
+            text = seen[key] = listify(value).to_string()
+        encoded.append(text)
+    return encoded
+
+
+def _profile_handlers(agent: Pythonian, mode: Any) -> str:
+    """The profile_handlers achieve, mode is deterministic, sampling or off
+    (nil)"""
+    mode = _text(mode).lower()
+    if mode in ('off', 'nil'):
+        agent.disable_profiling()
+        return 'off'
+    return agent.enable_profiling(mode).mode
+
+
+def _dump_handler_profile(agent: Pythonian,
+                          name: Any) -> List[Tuple[str, int, float]]:
+    """The dump_handler_profile achieve, name is a file name in the
+    agent's profile_directory"""
+    from os.path import basename, join
+    name = _text(name)
+    if not name or name in ('.', '..') or basename(name) != name or \
+            '/' in name or '\\' in name:
+        raise ValueError(f'{name} is not a file name')
+    path = join(agent.profile_directory, name)
+    return [(predicate, calls, round(seconds, 6)) for predicate, calls, seconds
+            in agent.dump_profile(path)]
+
+
+def _text(kqml: Any) -> str:
+    if isinstance(kqml, KQMLString):
+        return kqml.string_value()
+    return str(kqml)
+
+
+def _set_timeout(timeouts: dict, name: str, timeout: float):
+    if timeout is None:
+        timeouts.pop(name, None)
+    elif timeout <= 0:
+        raise ValueError('timeout must be a positive number of seconds')
+    else:
+        timeouts[name] = timeout
+
+
+def _set_limit(limits: dict, name: str, limit: int):
+    if limit is None:
+        limits.pop(name, None)
+    elif not isinstance(limit, int) or limit < 1:
+        raise ValueError('max_answers must be a positive integer')
+    else:
+        limits[name] = limit
+
+
+def _take_answers(answers: Iterable, limit: Optional[int],
+                  deadline: Optional[float],
+                  timeout: Optional[float]) -> Iterator:
+    """Yields answers one at a time, stopping after limit of them and raising
+    HandlerTimeout once past deadline (a perf_counter time). A generator is
+    closed when we stop early so it can release what it holds."""
+    iterator = iter(answers)
+    try:
+        count = 0
+        while limit is None or count < limit:
+            if deadline is not None and perf_counter() > deadline:
+                raise HandlerTimeout(f'timed out after {timeout}s')
+            try:
+                answer = next(iterator)
+            except StopIteration:
+                return
+            yield answer
+            count += 1
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def _set_priority(priorities: dict, name: str, priority: str):
+    if priority is None:
+        priorities.pop(name, None)
+    elif priority not in PRIORITY_CLASSES:
+        raise ValueError(f'priority must be one of {PRIORITY_CLASSES}')
+    else:
+        priorities[name] = priority
+
 
 ###############################################################################
 #                         Subscription Management                             #
 ###############################################################################
 
 class SubscriptionManager(dict):
-    """Extention of dict for handling regular subscription operations"""
+    """Extention of dict for handling regular subscription operations. Safe
+    to use from several threads at once: subscriptions are only added under a
+    lock, and the poller iterates over a snapshot that is replaced (never
+    modified) whenever one is added.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = Lock()
+        self._snapshot = ()
 
     def add_new_subscription(self, pattern: str):
         """Adds a new Subscription object as the value to a key of pattern
@@ -476,7 +1099,18 @@ class SubscriptionManager(dict):
         Args:
             pattern (str): query pattern associated with this subscription
         """
-        self[pattern] = Subscription()
+        with self._lock:
+            self[pattern] = Subscription()
+            self._snapshot = tuple(self.items())
+
+    def snapshot(self) -> Tuple[Tuple[str, 'Subscription'], ...]:
+        """The (pattern, subscription) pairs as of the last subscription
+        added, safe to iterate while other threads add more
+
+        Returns:
+            tuple: (pattern, Subscription) pairs
+        """
+        return self._snapshot
 
     def subscribe(self, pattern: str, subscriber: KQMLPerformative):
         """Add a subscriber to the specified subscription
@@ -489,14 +1123,17 @@ class SubscriptionManager(dict):
         """
         self[pattern].subscribe(subscriber)
 
-    def update(self, pattern: str, data: Any):
+    def update(self, pattern: str, data: Any, version: Hashable = None,
+               unchanged: bool = False):
         """Updates the data associated with a subscription
 
         Args:
             pattern (str): query pattern associated with a subscription
             data (Any): data to update the pattern with
+            version (Hashable, optional): version or fingerprint of the data
+            unchanged (bool, optional): the producer knows nothing changed
         """
-        self[pattern].update(data)
+        self[pattern].update(data, version, unchanged)
 
     def retire_data(self, pattern: str):
         """Retires the data associated with a subscription
@@ -509,21 +1146,28 @@ class SubscriptionManager(dict):
 
 class Subscription():
     """A simple class to handle subscriptions to a pattern, and updating the
-    data associated with it.
+    data associated with it. Updates, subscribes and taking the data are each
+    atomic, so producers, the listener and the poller can share it.
 
     Attributes:
         new_data (Any): new data to be used in updating the subscription query
             pattern (passed along to response_to_query).
         old_data (Any): copy of the new data after it has been retired, used
             for only updating new if it differs from the last value.
-        subscribers (list): list of subscription messages to reply to when
-            there is new data
+        subscribers (tuple): subscription messages to reply to when there is
+            new data, replaced with a longer tuple on subscribe so iterating
+            over it is always safe
+        version (Hashable): version of the latest data, if it was updated
+            with one
     """
 
     def __init__(self):
-        self.subscribers = []
+        self.subscribers = ()
         self.new_data = None
         self.old_data = None
+        self.version = None
+        self._updates = 0
+        self._lock = Lock()
 
     def __len__(self):
         return len(self.subscribers)
@@ -543,23 +1187,64 @@ class Subscription():
                 so that when new data is polled the subscribers can simply
                 be replied to
         """
-        self.subscribers.append(subscriber)
+        with self._lock:
+            self.subscribers += (subscriber,)
 
-    def update(self, data: Any):
+    def update(self, data: Any, version: Hashable = None,
+               unchanged: bool = False):
         """Checks that this is indeed an update (not the same as the previous
-        data), and if so set the new_data to the input data
+        data), and if so set the new_data to the input data. With a version
+        only the versions are compared (constant time however large the data
+        is), without one the data is compared to the last data sent.
+        Concurrent updates are applied in the order they were made, an update
+        still comparing when a later one arrives is dropped.
 
         Args:
             data (Any): new data to be used in updating the subscription query
                 pattern (passed along to response_to_query)
+            version (Hashable, optional): version number or fingerprint of
+                data, e.g. a counter the producer bumps on every change
+            unchanged (bool, optional): the producer knows nothing changed,
+                nothing is compared or stored
         """
-        if self.old_data != data:
-            self.new_data = data
+        if unchanged:
+            return
+        with self._lock:
+            self._updates += 1
+            update = self._updates
+            if version is not None:
+                if version != self.version:
+                    self.version = version
+                    self.new_data = data
+                return
+            self.version = None
+            old_data = self.old_data
+        # compared outside the lock, it can take a while for large data
+        changed = data is not old_data and old_data != data
+        with self._lock:
+            if update != self._updates:
+                return  # a later update has been made, it wins
+            if changed:
+                self.new_data = data
+            elif self.old_data is old_data:
+                self.new_data = None  # back to the data last sent
 
     def retire_data(self):
         """Cycles new_data to old_data and resets new_data"""
-        self.old_data = self.new_data
-        self.new_data = None
+        self.take_data()
+
+    def take_data(self) -> Any:
+        """Retires new_data (as retire_data does) and returns it, in one step
+        so an update arriving in between is never lost
+
+        Returns:
+            Any: the new data, None if there was none
+        """
+        with self._lock:
+            data, self.new_data = self.new_data, None
+            if data is not None:
+                self.old_data = data
+            return data
 
 
 ###############################################################################
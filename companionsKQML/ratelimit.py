@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    ratelimit.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-16 15:47:09
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-16 15:47:09
+
+"""Token bucket rate limiting of incoming messages by sender, used by
+CompanionsKQMLModule to reject a flood from one sender (e.g. a runaway plan
+sending ask-ones in a loop) before it is queued, so everyone else's messages
+keep being handled promptly.
+
+Attributes:
+    Limit (Tuple[float, float]): a (rate, burst) pair - rate messages per
+        second on average, with up to burst messages at once
+    SENDER_LABELS (int): default number of senders a RateLimiter names in
+        metric labels, the rest are counted together as other
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+Limit = Tuple[float, float]
+SENDER_LABELS = 50
+
+
+class TokenBucket():
+    """Holds up to burst tokens, refilled at rate tokens per second
+
+    Attributes:
+        burst (float): most tokens held
+        rate (float): tokens added per second
+        tokens (float): tokens available as of the last update
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', '_updated')
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst at least 1')
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = monotonic()
+
+    def take(self) -> bool:
+        """Takes a token if one is available
+
+        Returns:
+            bool: True if a token was taken
+        """
+        now = monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self):
+        """Returns a token taken for a message that ended up rejected"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self, now: float) -> bool:
+        """Whether the bucket has refilled to burst by now, when it is no
+        different from a new one
+
+        Args:
+            now (float): time.monotonic() to check at
+
+        Returns:
+            bool: True if the bucket is full
+        """
+        return self.tokens + (now - self._updated) * self.rate >= self.burst
+
+
+class RateLimiter():
+    """Per sender token buckets, optionally per performative as well. A
+    message is allowed only if its sender's bucket and its sender's bucket
+    for that performative (if the performative is limited) both have a token.
+    Buckets are kept least recently used first and dropped once they have
+    refilled, so senders that come and go don't pile up.
+
+    Attributes:
+        default (Limit): limit for senders without one of their own, None
+            leaves them unlimited (apart from performatives)
+        max_sender_labels (int): senders named by sender_label, the limited
+            senders plus the first ones labelled
+        performatives (Dict[str, Limit]): limits per performative, applied to
+            each sender separately
+        senders (Dict[str, Limit]): limits for particular senders
+    """
+
+    def __init__(self, default: Limit = None,
+                 senders: Dict[str, Limit] = None,
+                 performatives: Dict[str, Limit] = None,
+                 max_sender_labels: int = SENDER_LABELS):
+        self.default = default
+        self.senders = {str(sender).lower(): limit for sender, limit
+                        in (senders or {}).items()}
+        self.performatives = {verb.lower(): limit for verb, limit
+                              in (performatives or {}).items()}
+        self.max_sender_labels = max_sender_labels
+        self._buckets = OrderedDict()
+        self._labels = set()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        """Number of buckets held"""
+        return len(self._buckets)
+
+    def sender_label(self, sender: str) -> str:
+        """The sender label to count a message from sender under, other once
+        max_sender_labels senders have been named, so a stream of new sender
+        names doesn't grow the metrics without bound
+
+        Args:
+            sender (str): the message's :sender
+
+        Returns:
+            str: sender, or other
+        """
+        if sender.lower() in self.senders:
+            return sender
+        with self._lock:
+            if sender in self._labels:
+                return sender
+            if len(self._labels) < self.max_sender_labels:
+                self._labels.add(sender)
+                return sender
+        return 'other'
+
+    def _bucket(self, key: tuple, limit: Limit) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*limit)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self):
+        """Drops the least recently used buckets that have refilled (a new
+        bucket would be full too)"""
+        now = monotonic()
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if not bucket.full(now):
+                return
+            del self._buckets[key]
+
+    def allow(self, sender: str, performative: str) -> bool:
+        """Whether a message from sender may be handled now (taking its
+        tokens if so)
+
+        Args:
+            sender (str): the message's :sender
+            performative (str): the message's performative, lower case
+
+        Returns:
+            bool: True if the message is within its limits
+        """
+        sender = sender.lower()
+        sender_limit = self.senders.get(sender, self.default)
+        verb_limit = self.performatives.get(performative)
+        with self._lock:
+            self._evict()
+            sender_bucket = (None if sender_limit is None else
+                             self._bucket((sender,), sender_limit))
+            if sender_bucket is not None and not sender_bucket.take():
+                return False
+            if verb_limit is not None and \
+                    not self._bucket((sender, performative),
+                                     verb_limit).take():
+                if sender_bucket is not None:
+                    sender_bucket.give_back()
+                return False
+            return True
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    replay.py
+# @Author:      Samuel Hill
+# @Date:        2021-04-01 10:26:44
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-04-01 10:26:44
+
+"""Traffic recording and replay, for load testing an agent offline with the
+traffic it saw in production. CompanionsKQMLModule.enable_recording writes
+every message the agent receives and sends, with its wall clock time, to a
+recording (gzip compressed when the file name ends in .gz). replay then plays
+the incoming side of a recording back at an agent, at the recorded pace or
+sped up, through a stand-in facilitator that also collects the agent's
+replies, and reports reply latencies and errors by predicate.
+
+Recordings start with RECORDING_MAGIC followed by one record per message: a
+little endian header (float64 epoch seconds, 'i' for received or 'o' for
+sent, uint32 length) and the message's KQML text.
+
+From the command line, replaying against an agent class built in-process:
+
+    python -m companionsKQML.replay traffic.kqmlrec.gz \\
+        --agent my_agents:MyAgent --speed 10
+
+or, without --agent, against an agent started separately with -p set to the
+port printed by the stand-in facilitator.
+
+Attributes:
+    EXPECTS_REPLY (frozenset): performatives the agent answers, these are
+        sent with a reply id of their own so the reply can be timed
+    INCOMING (str): direction of a message the agent received
+    LOGGER (logging): The logger (from logging) to handle debugging
+    OUTGOING (str): direction of a message the agent sent
+    RECORDING_MAGIC (bytes): first bytes of every recording
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from io import BufferedReader
+from logging import getLogger
+from socket import socket, SocketIO, create_connection, SHUT_WR, \
+     SOL_SOCKET, SO_REUSEADDR
+from struct import Struct
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from kqml import KQMLList, KQMLPerformative, KQMLReader
+from .companionsKQMLModule import CompanionsKQMLModule, EPHEMERAL_PORT, \
+     LOCALHOST, performative, remove_packaging
+from .metrics import MetricsRegistry
+
+EXPECTS_REPLY = frozenset(('ask-one', 'ask-all', 'stream-all', 'achieve',
+                           'subscribe', 'ping'))
+INCOMING = 'in'
+OUTGOING = 'out'
+RECORDING_MAGIC = b'KQMLREC\x01'
+_RECORD = Struct('<dcI')
+_DIRECTIONS = {INCOMING: b'i', OUTGOING: b'o'}
+
+LOGGER = getLogger(__name__)
+
+
+###############################################################################
+#                                 Recording                                   #
+###############################################################################
+
+class TrafficRecorder():
+    """Appends the messages an agent receives and sends to a recording, see
+    CompanionsKQMLModule.enable_recording
+
+    Attributes:
+        path (str): file being written
+        records (int): messages recorded so far
+    """
+
+    def __init__(self, path: str, compress: bool = None,
+                 metrics: MetricsRegistry = None):
+        """Starts a new recording
+
+        Args:
+            path (str): file to write, replaced if it exists
+            compress (bool, optional): gzip the recording, defaults to True
+                for paths ending in .gz
+            metrics (MetricsRegistry, optional): metrics to count records in
+        """
+        self.path = str(path)
+        if compress is None:
+            compress = self.path.endswith('.gz')
+        if compress:
+            from gzip import open as open_gzip
+            self._file = open_gzip(self.path, 'wb', compresslevel=6)
+        else:
+            self._file = open(self.path, 'wb')
+        self._file.write(RECORDING_MAGIC)
+        self._lock = Lock()
+        self._metrics = metrics
+        self.records = 0
+
+    def incoming(self, data: bytes):
+        """Records a message the agent received
+
+        Args:
+            data (bytes): the message as read
+        """
+        self._record(INCOMING, data)
+
+    def outgoing(self, data: bytes):
+        """Records a message the agent sent
+
+        Args:
+            data (bytes): the message as encoded for sending
+        """
+        self._record(OUTGOING, data)
+
+    def close(self):
+        """Finishes the recording"""
+        with self._lock:
+            self._file.close()
+
+    def _record(self, direction: str, data: bytes):
+        data = bytes(data).rstrip(b'\n')
+        header = _RECORD.pack(time(), _DIRECTIONS[direction], len(data))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header)
+            self._file.write(data)
+            self.records += 1
+        if self._metrics is not None:
+            self._metrics.counter('kqml_recorded_total',
+                                  'messages written to the recording',
+                                  direction=direction).inc()
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, str, bytes]]:
+    """Reads back a recording, gzip compressed or not
+
+    Args:
+        path (str): recording written by a TrafficRecorder
+
+    Yields:
+        Tuple[float, str, bytes]: epoch seconds, INCOMING or OUTGOING, and
+            the message of each record
+
+    Raises:
+        ValueError: path isn't a recording
+    """
+    with open(path, 'rb') as file:
+        compressed = file.read(2) == b'\x1f\x8b'
+    if compressed:
+        from gzip import open as open_gzip
+        file = open_gzip(path, 'rb')
+    else:
+        file = open(path, 'rb')
+    directions = {value: key for key, value in _DIRECTIONS.items()}
+    with file:
+        if file.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f'{path} is not a KQML traffic recording')
+        while True:
+            header = file.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return  # end, or a record cut short by a crash
+            stamp, direction, length = _RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield stamp, directions[direction], data
+
+
+###############################################################################
+#                                  Replaying                                  #
+###############################################################################
+
+class ReplayReport():
+    """Reply latencies and errors of a replay, by predicate
+
+    Attributes:
+        errors (Dict[str, int]): error or sorry replies, and messages that
+            couldn't be delivered
+        latencies (Dict[str, List[float]]): seconds from sending each
+            message to its first reply
+        sent (Dict[str, int]): messages sent
+        unanswered (Dict[str, int]): messages expecting a reply that got
+            none before the replay ended
+        unsolicited (Dict[str, int]): messages the agent sent on its own
+            (inserts, achieves, ...), by performative
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.latencies = {}
+        self.errors = {}
+        self.unanswered = {}
+        self.unsolicited = {}
+        self._lock = Lock()
+
+    def count(self, table: Dict[str, int], key: str):
+        """Adds one to key in one of the count tables
+
+        Args:
+            table (Dict[str, int]): sent, errors, unanswered or unsolicited
+            key (str): predicate or performative
+        """
+        with self._lock:
+            table[key] = table.get(key, 0) + 1
+
+    def observe(self, predicate: str, seconds: float, error: bool):
+        """Records the first reply to a message
+
+        Args:
+            predicate (str): predicate of the message replied to
+            seconds (float): time from sending it to the reply
+            error (bool): whether the reply was an error or sorry
+        """
+        with self._lock:
+            self.latencies.setdefault(predicate, []).append(seconds)
+            if error:
+                self.errors[predicate] = self.errors.get(predicate, 0) + 1
+
+    def percentile(self, predicate: str, fraction: float) -> Optional[float]:
+        """A reply latency percentile (nearest rank)
+
+        Args:
+            predicate (str): a predicate
+            fraction (float): 0.5 for the median, 0.99 for p99, etc.
+
+        Returns:
+            Optional[float]: seconds, None if nothing was replied to
+        """
+        with self._lock:
+            ordered = sorted(self.latencies.get(predicate, ()))
+        if not ordered:
+            return None
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def format(self) -> str:
+        """The report as a table, one row per predicate
+
+        Returns:
+            str: the table
+        """
+        columns = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+        lines = [f'{"predicate":<28} {"sent":>7} {"replies":>7} '
+                 f'{"errors":>6} {"lost":>5} ' +
+                 ' '.join(f'{name + " ms":>9}' for name, _ in columns)]
+        for predicate in sorted(self.sent):
+            cells = []
+            for _, fraction in columns:
+                value = self.percentile(predicate, fraction)
+                cells.append(f'{"-":>9}' if value is None
+                             else f'{value * 1000:>9.2f}')
+            lines.append(f'{predicate:<28} {self.sent[predicate]:>7} '
+                         f'{len(self.latencies.get(predicate, ())):>7} '
+                         f'{self.errors.get(predicate, 0):>6} '
+                         f'{self.unanswered.get(predicate, 0):>5} ' +
+                         ' '.join(cells))
+        if self.unsolicited:
+            lines.append('sent by the agent: ' + ', '.join(
+                f'{verb} {count}'
+                for verb, count in sorted(self.unsolicited.items())))
+        return '\n'.join(lines)
+
+
+class StandInFacilitator():
+    """Plays Companions' facilitator for a replay: takes the agent's
+    registration (to learn its listener port) and reads everything it sends,
+    timing replies to the messages sent with expect
+
+    Attributes:
+        agent_port (int): listener port the agent registered, None until it
+            has
+        port (int): port the agent should send to (its port argument)
+        registered (Event): set once the agent has registered
+        report (ReplayReport): where replies are counted
+    """
+
+    def __init__(self, report: ReplayReport, port: int = EPHEMERAL_PORT):
+        self.report = report
+        self.agent_port = None
+        self.registered = Event()
+        self._expected = {}
+        self._lock = Lock()
+        self._socket = socket()
+        self._socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._socket.bind(('', port))
+        self._socket.listen(64)
+        self.port = self._socket.getsockname()[1]
+        self._acceptor = Thread(target=self._accept, daemon=True,
+                                name='stand-in-facilitator')
+        self._acceptor.start()
+
+    def expect(self, reply_id: str, predicate: str):
+        """Starts timing a message about to be sent
+
+        Args:
+            reply_id (str): the message's :reply-with
+            predicate (str): its predicate, for the report
+        """
+        with self._lock:
+            self._expected[reply_id] = (predicate, monotonic())
+
+    def answer(self, msg: KQMLPerformative):
+        """Handles a message from the agent, a reply to a message sent with
+        expect (only the first reply to each is timed) or one it sent on its
+        own
+
+        Args:
+            msg (KQMLPerformative): message from the agent
+        """
+        verb = str(msg.head()).lower()
+        reply_to = msg.get('in-reply-to')
+        if reply_to is None:
+            self.report.count(self.report.unsolicited, verb)
+            return
+        with self._lock:
+            expected = self._expected.pop(str(reply_to), None)
+        if expected is not None:
+            predicate, sent_at = expected
+            self.report.observe(predicate, monotonic() - sent_at,
+                                verb in ('error', 'sorry'))
+
+    def forget(self, reply_id: Optional[str]):
+        """Stops waiting on a reply to a message that couldn't be sent
+
+        Args:
+            reply_id (Optional[str]): the message's :reply-with, if any
+        """
+        if reply_id is not None:
+            with self._lock:
+                self._expected.pop(str(reply_id), None)
+
+    def outstanding(self) -> List[str]:
+        """Predicates of the messages still waiting on a reply
+
+        Returns:
+            List[str]: one per unanswered message
+        """
+        with self._lock:
+            return [predicate for predicate, _ in self._expected.values()]
+
+    def close(self):
+        """Stops accepting connections"""
+        self._socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return  # closed
+            Thread(target=self._read, args=[connection], daemon=True).start()
+
+    def _read(self, connection: socket):
+        with connection:
+            reader = KQMLReader(BufferedReader(SocketIO(connection, 'r')))
+            while True:
+                try:
+                    msg = reader.read_performative()
+                except EOFError:
+                    return
+                except Exception as error:  # pylint: disable=broad-except
+                    LOGGER.warning('Unreadable message from the agent: %s',
+                                   error)
+                    return
+                if str(msg.head()).lower() == 'register':
+                    self._register(msg)
+                else:
+                    self.answer(msg)
+
+    def _register(self, msg: KQMLPerformative):
+        content = msg.get('content')
+        try:
+            self.agent_port = int(str(content.data[-1]))
+        except (AttributeError, IndexError, ValueError):
+            LOGGER.warning('Unexpected registration: %s', msg)
+            return
+        LOGGER.info('%s registered, listening on port %s', msg.get('sender'),
+                    self.agent_port)
+        self.registered.set()
+
+
+def predicate_of(msg: KQMLPerformative) -> str:
+    """The predicate a message is about, for grouping the report: the head
+    of an ask's query, the action of an achieve, the query of a subscribe,
+    the performative for anything else
+
+    Args:
+        msg (KQMLPerformative): incoming message
+
+    Returns:
+        str: e.g. 'ask-one population'
+    """
+    verb = str(msg.head()).lower()
+    content = msg.get('content')
+    if not isinstance(content, KQMLList) or not content.data:
+        return verb
+    if verb == 'achieve':
+        action = content.get('action')
+        content = action if isinstance(action, KQMLList) else content
+    elif verb == 'subscribe':
+        query = content.get('content')
+        content = query if isinstance(query, KQMLList) else content
+    head = content.head() if content.data else None
+    return verb if head is None else \
+        f'{verb} {remove_packaging(str(head)).lower()}'
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+#   Replay options, and the bookkeeping of one run
+def replay(path: str,
+           factory: Callable[..., CompanionsKQMLModule] = None,
+           speed: float = 1.0, drain: float = 5.0,
+           register_timeout: float = 60.0, agent_host: str = LOCALHOST,
+           port: int = EPHEMERAL_PORT) -> ReplayReport:
+    """Replays the messages an agent received in a recording against an
+    agent, each one on its own connection (like Companions), and reports
+    how quickly and how well it replied
+
+    Args:
+        path (str): recording written with enable_recording
+        factory (Callable[..., CompanionsKQMLModule], optional): builds the
+            agent to replay against from port and listener_port keyword
+            arguments (e.g. its class), it is exited afterwards. Without one
+            the replay waits for an agent started separately to register
+            with the stand-in facilitator
+        speed (float, optional): multiple of the recorded pace, 0 sends
+            everything as fast as possible
+        drain (float, optional): most seconds to wait for replies after the
+            last message is sent
+        register_timeout (float, optional): most seconds to wait for the
+            agent to register
+        agent_host (str, optional): host the agent listens on
+        port (int, optional): port for the stand-in facilitator, picked by
+            the operating system by default
+
+    Returns:
+        ReplayReport: latencies and errors by predicate
+
+    Raises:
+        TimeoutError: the agent didn't register in time
+    """
+    report = ReplayReport()
+    facilitator = StandInFacilitator(report, port)
+    agent = None
+    try:
+        if factory is not None:
+            agent = factory(port=facilitator.port,
+                            listener_port=EPHEMERAL_PORT)
+        else:
+            print(f'Waiting for an agent to register on port '
+                  f'{facilitator.port}...')
+        if not facilitator.registered.wait(register_timeout):
+            raise TimeoutError('no agent registered with the stand-in '
+                               'facilitator')
+        messages = [(stamp, data) for stamp, direction, data
+                    in read_recording(path) if direction == INCOMING]
+        _send_all(messages, facilitator, report, speed,
+                  (agent_host, facilitator.agent_port))
+        deadline = monotonic() + drain
+        while facilitator.outstanding() and monotonic() < deadline:
+            sleep(0.01)
+        for predicate in facilitator.outstanding():
+            report.count(report.unanswered, predicate)
+    finally:
+        if agent is not None:
+            agent.exit()
+        facilitator.close()
+    return report
+
+
+def _send_all(messages: List[Tuple[float, bytes]],
+              facilitator: StandInFacilitator, report: ReplayReport,
+              speed: float, address: Tuple[str, int]):
+    """Sends the recorded messages at their (scaled) recorded times, the
+    connections are made on a pool so a slow agent doesn't hold the pace
+    back"""
+    if not messages:
+        return
+    first, start = messages[0][0], monotonic()
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        for number, (stamp, data) in enumerate(messages):
+            if speed > 0:
+                wait = start + (stamp - first) / speed - monotonic()
+                if wait > 0:
+                    sleep(wait)
+            try:
+                msg = performative(data.decode())
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.warning('Skipping unreadable recorded message: %r',
+                               data[:200])
+                continue
+            verb, predicate = str(msg.head()).lower(), predicate_of(msg)
+            report.count(report.sent, predicate)
+            if verb in EXPECTS_REPLY:
+                reply_id = f'replay-{number}'
+                msg.set('reply-with', reply_id)
+                facilitator.expect(reply_id, predicate)
+            pool.submit(_deliver, msg, predicate, address, facilitator,
+                        report)
+
+
+def _deliver(msg: KQMLPerformative, predicate: str,
+             address: Tuple[str, int], facilitator: StandInFacilitator,
+             report: ReplayReport):
+    """Sends one message on a new connection and reads the connection until
+    the agent closes it, anything written back on it (replies to pings, on
+    whichever connection the agent last read from) counts as a reply"""
+    try:
+        with create_connection(address) as connection:
+            connection.sendall(msg.to_string().encode() + b'\n')
+            connection.shutdown(SHUT_WR)
+            reader = KQMLReader(BufferedReader(SocketIO(connection, 'r')))
+            while True:
+                facilitator.answer(reader.read_performative())
+    except EOFError:
+        return  # closed, whatever wasn't answered stays unanswered
+    except OSError as error:
+        LOGGER.warning('Could not deliver %s: %s', predicate, error)
+        facilitator.forget(msg.get('reply-with'))
+        report.count(report.errors, predicate)
+
+
+def main(argv: list = None):
+    """Command line replay, prints the report"""
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Replay recorded KQML traffic '
+                                        'against an agent.')
+    parser.add_argument('recording', help='file written by enable_recording')
+    parser.add_argument('-a', '--agent',
+                        help='module:Class of the agent to build and replay '
+                             'against, otherwise wait for one to register')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='multiple of the recorded pace, 0 for as fast '
+                             'as possible')
+    parser.add_argument('-d', '--drain', type=float, default=5.0,
+                        help='seconds to wait for replies at the end')
+    parser.add_argument('-p', '--port', type=int, default=EPHEMERAL_PORT,
+                        help='port for the stand-in facilitator')
+    args = parser.parse_args(argv)
+    factory = None
+    if args.agent:
+        module, _, name = args.agent.partition(':')
+        factory = getattr(import_module(module), name)
+    report = replay(args.recording, factory, args.speed, args.drain,
+                    port=args.port)
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    scheduling.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-12 13:05:44
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-12 13:05:44
+
+"""Priority scheduling of incoming messages for CompanionsKQMLModule. Handlers
+are queued by priority class and run by a fixed set of worker threads: some
+workers are reserved for a single class (so a burst of long achieves can never
+take every worker away from asks) and the shared workers always take the most
+urgent queued work first.
+
+Attributes:
+    DEFAULT_RESERVED (dict): workers reserved for each priority class
+    DEFAULT_SHARED (int): workers that take work of any class
+    LOGGER (logging): The logger (from logging) to handle debugging
+    PRIORITY_CLASSES (tuple): priority classes, most urgent first - 'control'
+        (pings and replies, CompanionsKQMLModule handles these on the reading
+        thread without queueing them), 'ask' (queries, tells, subscriptions)
+        and 'achieve' (tasks)
+"""
+
+from collections import deque
+from concurrent.futures import Future
+from logging import getLogger
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Dict
+from .metrics import MetricsRegistry
+
+PRIORITY_CLASSES = ('control', 'ask', 'achieve')
+DEFAULT_RESERVED = {'control': 0, 'ask': 2, 'achieve': 0}
+DEFAULT_SHARED = 3
+
+LOGGER = getLogger(__name__)
+
+
+class PriorityScheduler():
+    """Runs submitted functions on worker threads, most urgent class first
+
+    Attributes:
+        metrics (MetricsRegistry): registry for queue depths and waits
+        reserved (Dict[str, int]): workers only running the given class
+        shared (int): workers running any class, in priority order
+        workers (list): the worker threads
+    """
+
+    def __init__(self, reserved: Dict[str, int] = None,
+                 shared: int = DEFAULT_SHARED,
+                 metrics: MetricsRegistry = None):
+        reserved = dict(DEFAULT_RESERVED if reserved is None else reserved)
+        unknown = set(reserved) - set(PRIORITY_CLASSES)
+        if unknown:
+            raise ValueError(f'unknown priority classes: {sorted(unknown)}, '
+                             f'expected some of {PRIORITY_CLASSES}')
+        if shared < 0 or min(reserved.values(), default=0) < 0:
+            raise ValueError('worker counts must not be negative')
+        for priority in PRIORITY_CLASSES:
+            if not shared and not reserved.get(priority):
+                raise ValueError(f'no worker would run {priority} work')
+        self.reserved = reserved
+        self.shared = shared
+        self.metrics = MetricsRegistry() if metrics is None else metrics
+        self._queues = {priority: deque() for priority in PRIORITY_CLASSES}
+        self._condition = Condition()
+        self._closed = False
+        for priority, queue in self._queues.items():
+            self.metrics.gauge('kqml_scheduler_queue_depth',
+                               'messages waiting for a worker',
+                               queue.__len__, priority=priority)
+        self.workers = []
+        for priority, count in reserved.items():
+            self._start_workers(count, (priority,))
+        self._start_workers(shared, PRIORITY_CLASSES)
+
+    def _start_workers(self, count: int, priorities: tuple):
+        for _ in range(count):
+            worker = Thread(target=self._work, args=[priorities], daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, priority: str, function: Callable, *args,
+               **kwargs) -> Future:
+        """Queues function(*args, **kwargs) to run under priority
+
+        Args:
+            priority (str): one of PRIORITY_CLASSES
+            function (Callable): function to run
+            *args: positional arguments for function
+            **kwargs: keyword arguments for function
+
+        Returns:
+            Future: future of the call, can be cancelled until it starts
+
+        Raises:
+            RuntimeError: the scheduler has been shut down
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('cannot schedule after shutdown')
+            self._queues[priority].append((future, function, args, kwargs,
+                                           monotonic()))
+            self._condition.notify_all()
+        return future
+
+    def shutdown(self, wait: bool = True):
+        """Stops the workers once the queues are empty, cancelling anything
+        still queued
+
+        Args:
+            wait (bool, optional): join the workers before returning
+        """
+        with self._condition:
+            self._closed = True
+            for queue in self._queues.values():
+                while queue:
+                    queue.popleft()[0].cancel()
+            self._condition.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def _next(self, priorities: tuple):
+        for priority in priorities:
+            if self._queues[priority]:
+                return priority, self._queues[priority].popleft()
+        return None
+
+    def _work(self, priorities: tuple):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or any(self._queues[priority]
+                                                for priority in priorities))
+                work = self._next(priorities)
+                if work is None:
+                    return
+            priority, (future, function, args, kwargs, queued_at) = work
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.metrics.histogram('kqml_scheduler_wait_seconds',
+                                   'time messages waited for a worker',
+                                   priority=priority
+                                   ).observe(monotonic() - queued_at)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:  # pylint: disable=broad-except
+                # kept on the future, logged so it isn't lost unnoticed
+                LOGGER.error('Uncaught %s in %s work: %s',
+                             type(error).__name__, priority, error)
+                future.set_exception(error)
+            else:
+                future.set_result(result)
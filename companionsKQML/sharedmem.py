@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    sharedmem.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-30 13:48:21
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-30 13:48:21
+
+"""Shared memory side channel for large payloads between Pythonian agents on
+the same host. Instead of listifying a multi-megabyte buffer (bytes, array,
+numpy array) into KQML text for the facilitator to pass along and the
+receiver to parse, the sender writes it once to a file in shared memory
+(/dev/shm where there is one) and sends a small handle in its place:
+
+    (pythonian-shared "pythonian-<pid>-<id>" <bytes> "<dtype>" (<shape>))
+
+The receiver maps the file copy-on-write and unlinks it straight away, its
+handler gets a view of the mapping (a memoryview, or a numpy array with the
+original dtype and shape) without the payload being copied, and the memory
+is freed when the last view of it goes. Handles nobody claims are unlinked
+by the sender once they are older than the time to live, or when it exits.
+
+Attributes:
+    DEFAULT_THRESHOLD (int): default size in bytes from which buffers are
+        shared instead of sent as text
+    DEFAULT_TTL (float): default seconds a handle stays claimable
+    LOGGER (logging): The logger (from logging) to handle debugging
+    SHARED_HEAD (str): head of a handle's KQML list
+"""
+
+from logging import getLogger
+from mmap import mmap, ACCESS_COPY
+from os import O_CREAT, O_EXCL, O_WRONLY, close as close_fd, getpid, \
+     open as open_fd, unlink, urandom, write as write_fd
+from os.path import isdir, join as join_path
+from re import compile as compile_regex
+from threading import Lock
+from time import monotonic
+from typing import Any, Optional
+from kqml import KQMLList, KQMLString, KQMLToken
+from .metrics import MetricsRegistry
+
+DEFAULT_THRESHOLD = 2 ** 20
+DEFAULT_TTL = 60
+SHARED_HEAD = 'pythonian-shared'
+
+LOGGER = getLogger(__name__)
+
+# only names made by share are ever opened (or unlinked) by resolve
+_SEGMENT_NAME = compile_regex(r'pythonian-\d+-[0-9a-f]{32}')
+
+
+class SharedPayloads():
+    """Shares large buffers through files in shared memory, the sending side
+    (share, encode) and the receiving side (resolve) of the side channel
+
+    Attributes:
+        directory (str): directory holding the shared files, the same for
+            every agent on the host
+        metrics (MetricsRegistry): the agent's metrics
+        threshold (int): size in bytes from which buffers are shared
+        ttl (float): seconds a handle stays claimable
+    """
+
+    def __init__(self, metrics: MetricsRegistry,
+                 threshold: int = DEFAULT_THRESHOLD,
+                 ttl: float = DEFAULT_TTL, directory: str = None):
+        self.directory = shared_directory() if directory is None \
+            else directory
+        self.metrics = metrics
+        self.threshold = max(threshold, 1)
+        self.ttl = ttl
+        self._pending = {}
+        self._lock = Lock()
+        metrics.gauge('pythonian_shared_pending',
+                      'shared payloads sent but not expired yet',
+                      lambda: len(self._pending))
+
+    def should_share(self, value: Any) -> bool:
+        """Whether value is a buffer at least threshold bytes long
+
+        Args:
+            value (Any): a value about to be listified
+
+        Returns:
+            bool: True if value should be shared
+        """
+        if isinstance(value, str) or \
+                getattr(getattr(value, 'dtype', None), 'hasobject', False):
+            return False  # object arrays hold pointers, not data
+        size = _payload_size(value)
+        return size is not None and size >= self.threshold
+
+    def encode(self, data: Any) -> Any:
+        """Replaces the buffers in data (searching lists and tuples) that
+        should be shared with handles, ready for listify
+
+        Args:
+            data (Any): data about to be listified
+
+        Returns:
+            Any: data with handles in place of the large buffers
+        """
+        if isinstance(data, (list, tuple)):
+            encoded = [self.encode(each) for each in data]
+            return encoded if isinstance(data, list) else tuple(encoded)
+        return self.share(data) if self.should_share(data) else data
+
+    def share(self, value: Any) -> KQMLList:
+        """Writes a buffer to a new shared file
+
+        Args:
+            value (Any): bytes-like object, e.g. bytes, array or numpy array
+
+        Returns:
+            KQMLList: the handle to send in its place
+        """
+        self.expire()
+        view = memoryview(value)
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        view = view.cast('B')
+        name = f'pythonian-{getpid()}-{urandom(16).hex()}'
+        path = join_path(self.directory, name)
+        descriptor = open_fd(path, O_WRONLY | O_CREAT | O_EXCL, 0o600)
+        try:
+            written = 0
+            while written < view.nbytes:
+                written += write_fd(descriptor, view[written:])
+        except BaseException:
+            unlink(path)
+            raise
+        finally:
+            close_fd(descriptor)
+        with self._lock:
+            self._pending[path] = monotonic() + self.ttl
+        self._count('sent', view.nbytes)
+        dtype = getattr(value, 'dtype', None)
+        if dtype is None:
+            return KQMLList([KQMLToken(SHARED_HEAD), KQMLString(name),
+                             KQMLToken(str(view.nbytes))])
+        return KQMLList([KQMLToken(SHARED_HEAD), KQMLString(name),
+                         KQMLToken(str(view.nbytes)), KQMLString(dtype.str),
+                         KQMLList([KQMLToken(str(each))
+                                   for each in value.shape])])
+
+    def resolve(self, kqml: Any) -> Any:
+        """The payload of a handle, with the handles in lists (searched as
+        encode does) resolved in a copy, anything else is returned as is
+
+        Args:
+            kqml (Any): an argument read from a message
+
+        Returns:
+            Any: a view of the shared payload (a numpy array if it was sent
+                as one), a list with views in place of its handles, or kqml
+                itself
+
+        Raises:
+            ValueError: a handle is malformed or its payload expired
+        """
+        if isinstance(kqml, KQMLList) and not is_handle(kqml):
+            resolved = [self.resolve(each) for each in kqml.data]
+            if all(new is old for new, old in zip(resolved, kqml.data)):
+                return kqml
+            return KQMLList(resolved)
+        if not is_handle(kqml):
+            return kqml
+        name, size = _unquote(kqml.data[1]), int(str(kqml.data[2]))
+        if not _SEGMENT_NAME.fullmatch(name):
+            raise ValueError(f'{name} is not a shared payload')
+        path = join_path(self.directory, name)
+        try:
+            with open(path, 'rb') as file:
+                mapped = mmap(file.fileno(), size, access=ACCESS_COPY)
+        except (OSError, ValueError) as error:
+            raise ValueError(f'shared payload {name} is gone ({error})') \
+                from error
+        try:
+            unlink(path)  # the mapping keeps the memory until it's released
+        except FileNotFoundError:
+            pass
+        self._count('received', size)
+        if len(kqml.data) < 5:
+            return memoryview(mapped)
+        import numpy
+        shape = tuple(int(str(each)) for each in kqml.data[4].data)
+        return numpy.frombuffer(mapped, _unquote(kqml.data[3])).reshape(shape)
+
+    def expire(self, now: float = None):
+        """Unlinks the shared files whose handles are past their time to
+        live (claimed ones are already gone)
+
+        Args:
+            now (float, optional): monotonic time to expire as of, everything
+                is expired with float('inf')
+        """
+        now = monotonic() if now is None else now
+        with self._lock:
+            expired = [path for path, deadline in self._pending.items()
+                       if deadline <= now]
+            for path in expired:
+                del self._pending[path]
+        for path in expired:
+            try:
+                unlink(path)
+            except FileNotFoundError:
+                continue
+            LOGGER.debug('Shared payload %s expired unclaimed', path)
+            self.metrics.counter('pythonian_shared_expired_total',
+                                 'shared payloads nobody claimed').inc()
+
+    def close(self):
+        """Unlinks every shared file not claimed yet"""
+        self.expire(float('inf'))
+
+    def _count(self, direction: str, size: int):
+        self.metrics.counter('pythonian_shared_payloads_total',
+                             'payloads passed through shared memory',
+                             direction=direction).inc()
+        self.metrics.counter('pythonian_shared_bytes_total',
+                             'bytes passed through shared memory',
+                             direction=direction).inc(size)
+
+
+def shared_directory() -> str:
+    """Directory for shared files, /dev/shm (memory backed) where it exists,
+    otherwise the temporary directory (still mapped, but may be disk backed)
+
+    Returns:
+        str: the directory
+    """
+    if isdir('/dev/shm'):
+        return '/dev/shm'
+    from tempfile import gettempdir
+    return gettempdir()
+
+
+def is_handle(kqml: Any) -> bool:
+    """Whether kqml is a shared payload handle
+
+    Args:
+        kqml (Any): an argument read from a message
+
+    Returns:
+        bool: True for a (pythonian-shared ...) list
+    """
+    return isinstance(kqml, KQMLList) and len(kqml.data) >= 3 and \
+        str(kqml.data[0]).lower() == SHARED_HEAD
+
+
+def _unquote(kqml: Any) -> str:
+    if isinstance(kqml, KQMLString):
+        return kqml.string_value()
+    return str(kqml)
+
+
+def _payload_size(value: Any) -> Optional[int]:
+    try:
+        return memoryview(value).nbytes
+    except TypeError:
+        return None
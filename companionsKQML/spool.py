@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    spool.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-10 16:33:05
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-10 16:33:05
+
+"""Append-only, on disk spool of encoded outbound messages. While Companions
+is unreachable CompanionsKQMLModule appends what it would have sent here
+instead of losing it, and a replay thread sends the spooled messages (oldest
+first) once the facilitator accepts connections again.
+
+Messages are stored as length prefixed records in segment files named by
+sequence number. The oldest segment is read through a memory map, the newest
+one is appended to, and a segment is deleted once every record in it has been
+replayed. The replay position is kept in a small cursor file so a restarted
+agent resumes where the last one left off; delivery is at least once (records
+sent but not yet committed when an agent dies are sent again).
+
+Attributes:
+    CURSOR (str): name of the file holding the replay position
+    LOGGER (logging): The logger (from logging) to handle debugging
+    OVERFLOW_POLICIES (tuple): what append does when the spool is full -
+        'drop_newest' discards the records being appended, 'drop_oldest'
+        deletes the oldest segments to make room
+    SEGMENT_SUFFIX (str): file extension of segment files
+"""
+
+from logging import getLogger
+from mmap import mmap, ACCESS_READ
+from os import fsync, replace
+from pathlib import Path
+from struct import Struct
+from threading import Lock
+from typing import List
+
+CURSOR = 'cursor'
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest')
+SEGMENT_SUFFIX = '.spool'
+_LENGTH = Struct('>I')
+
+LOGGER = getLogger(__name__)
+
+
+# pylint: disable=too-many-instance-attributes
+#   Write and read sides each need their file, position and bookkeeping
+class OutboundSpool():
+    """Durable FIFO of encoded messages split over segment files
+
+    Attributes:
+        directory (Path): directory holding the segments and cursor
+        dropped (int): records discarded because the spool was full
+        max_bytes (int): most bytes of segments kept on disk
+        overflow (str): one of OVERFLOW_POLICIES
+        segment_bytes (int): size at which a new segment is started
+        sync (bool): whether appends are fsync'd before returning
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, directory: str, segment_bytes: int = 16 * 2 ** 20,
+                 max_bytes: int = 2 ** 30, overflow: str = 'drop_newest',
+                 sync: bool = False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow must be one of {OVERFLOW_POLICIES}')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.sync = sync
+        self.dropped = 0
+        self._lock = Lock()
+        self._segments = sorted(self.directory.glob('*' + SEGMENT_SUFFIX))
+        self._sizes = {path: path.stat().st_size for path in self._segments}
+        self._writer = None
+        self._map = None
+        self._offset = 0
+        self._records = 0
+        self._load_cursor()
+
+    def __len__(self):
+        return self._records
+
+    def __bool__(self):
+        return self._records > 0
+
+    @property
+    def size(self) -> int:
+        """Bytes of segment files on disk"""
+        return sum(self._sizes.values())
+
+    def append(self, payloads: List[bytes]) -> int:
+        """Appends encoded messages to the newest segment (starting a new
+        segment when it is full)
+
+        Args:
+            payloads (List[bytes]): encoded messages
+
+        Returns:
+            int: number of messages appended (fewer than given when the spool
+                is full and the overflow policy is drop_newest)
+        """
+        with self._lock:
+            appended = 0
+            for payload in payloads:
+                needed = _LENGTH.size + len(payload)
+                if not self._make_room(needed):
+                    self.dropped += len(payloads) - appended
+                    break
+                writer = self._segment_writer(needed)
+                writer.write(_LENGTH.pack(len(payload)) + payload)
+                self._sizes[self._segments[-1]] += needed
+                appended += 1
+            if self._writer is not None:
+                self._writer.flush()
+                if self.sync:
+                    fsync(self._writer.fileno())
+            self._records += appended
+            return appended
+
+    def peek(self, limit: int) -> List[bytes]:
+        """Oldest spooled messages, without removing them
+
+        Args:
+            limit (int): most messages to return
+
+        Returns:
+            List[bytes]: encoded messages, oldest first
+        """
+        with self._lock:
+            records, offset = [], self._offset
+            for index, path in enumerate(self._segments):
+                if index:
+                    offset = 0
+                view = self._view(path)
+                while len(records) < limit and offset < len(view):
+                    length, = _LENGTH.unpack_from(view, offset)
+                    offset += _LENGTH.size
+                    records.append(view[offset:offset + length])
+                    offset += length
+                if len(records) >= limit:
+                    break
+            return records
+
+    def commit(self, count: int):
+        """Removes the oldest count messages (they have been sent), deleting
+        segments that have been fully replayed and saving the new position
+
+        Args:
+            count (int): number of messages sent since the last commit
+        """
+        with self._lock:
+            self._records -= count
+            while count and self._segments:
+                view = self._view(self._segments[0])
+                while count and self._offset < len(view):
+                    length, = _LENGTH.unpack_from(view, self._offset)
+                    self._offset += _LENGTH.size + length
+                    count -= 1
+                if len(self._segments) == 1:
+                    break
+                if self._offset >= self._sizes[self._segments[0]]:
+                    self._remove_oldest()
+            if not self._records and self._segments:
+                # fully replayed, start over with an empty spool
+                while self._segments:
+                    self._remove_oldest()
+            self._save_cursor()
+
+    def close(self):
+        """Closes the open segment files (the spool stays on disk)"""
+        with self._lock:
+            self._close_map()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _make_room(self, needed: int) -> bool:
+        while self.size + needed > self.max_bytes:
+            if self.overflow == 'drop_newest' or len(self._segments) < 2:
+                return False
+            LOGGER.warning('Spool full, dropping segment %s',
+                           self._segments[0].name)
+            lost = self._count_records(self._segments[0], self._offset)
+            self._records -= lost
+            self.dropped += lost
+            self._remove_oldest()
+            self._save_cursor()
+        return True
+
+    def _segment_writer(self, needed: int):
+        if self._segments and self._writer is None:
+            self._writer = self._segments[-1].open('ab')
+        if not self._segments or \
+                self._sizes[self._segments[-1]] + needed > self.segment_bytes \
+                and self._sizes[self._segments[-1]]:
+            if self._writer is not None:
+                self._writer.close()
+            number = int(self._segments[-1].stem) + 1 if self._segments else 0
+            path = self.directory / f'{number:020d}{SEGMENT_SUFFIX}'
+            self._segments.append(path)
+            self._sizes[path] = 0
+            self._writer = path.open('ab')
+        return self._writer
+
+    def _view(self, path: Path):
+        """Memory map of a segment, remapped if it has grown since mapping"""
+        if path == self._segments[0]:
+            if self._map is None or len(self._map) < self._sizes[path]:
+                self._close_map()
+                if self._sizes[path]:
+                    with path.open('rb') as segment:
+                        self._map = mmap(segment.fileno(), 0,
+                                         access=ACCESS_READ)
+            return self._map if self._map is not None else b''
+        with path.open('rb') as segment:
+            return segment.read()
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _remove_oldest(self):
+        path = self._segments.pop(0)
+        self._close_map()
+        if not self._segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        del self._sizes[path]
+        path.unlink()
+        self._offset = 0
+
+    def _count_records(self, path: Path, offset: int = 0) -> int:
+        view, records = self._view(path), 0
+        while offset < len(view):
+            offset += _LENGTH.size + _LENGTH.unpack_from(view, offset)[0]
+            records += 1
+        return records
+
+    def _load_cursor(self):
+        cursor = self.directory / CURSOR
+        if cursor.exists():
+            name, offset = cursor.read_text().split()
+            while self._segments and self._segments[0].name < name:
+                self._remove_oldest()  # replayed but not deleted before exit
+            if self._segments and self._segments[0].name == name:
+                self._offset = int(offset)
+        self._records = sum(self._count_records(path, self._offset if index
+                                                == 0 else 0)
+                            for index, path in enumerate(self._segments))
+
+    def _save_cursor(self):
+        cursor = self.directory / CURSOR
+        if not self._segments:
+            if cursor.exists():
+                cursor.unlink()
+            return
+        temp = self.directory / (CURSOR + '.tmp')
+        temp.write_text(f'{self._segments[0].name} {self._offset}')
+        replace(str(temp), str(cursor))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    tracing.py
+# @Author:      Samuel Hill
+# @Date:        2021-03-05 14:21:37
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-03-05 14:21:37
+
+"""Per-message tracing for CompanionsKQMLModule and Pythonian. Every sampled
+incoming message gets a Trace, and the stages of handling it (parse, dispatch,
+argspec, handler, encode, connect, write) are timed as Spans. When the trace
+finishes its spans are handed to the tracer's hooks, e.g. a RingBufferRecorder
+for inspection from the REPL or a JsonLinesRecorder for offline analysis.
+
+The trace being handled by the current thread is found with current_trace.
+When tracing is off (or outside of handling a message) that is NULL_TRACE,
+and while handling a message that wasn't sampled it is UNSAMPLED_TRACE. The
+spans of both do nothing, so instrumented code never needs to check.
+
+Attributes:
+    NULL_TRACE (_NullTrace): stand-in trace used when nothing is being traced
+    UNSAMPLED_TRACE (_UnsampledTrace): stand-in trace of a message that
+        wasn't sampled, tells its handling apart from no message at all
+"""
+
+from collections import deque
+from itertools import count
+from random import random
+from threading import local, Lock
+from time import perf_counter, time
+from typing import NamedTuple, List
+
+
+class Span(NamedTuple):
+    """A timed stage of handling one message
+
+    Attributes:
+        trace_id (int): id of the trace (message) this span belongs to
+        stage (str): name of the stage, e.g. parse, handler, write
+        start (float): wall clock (epoch seconds) the stage started at
+        duration (float): seconds the stage took
+        attributes (dict): trace attributes (performative, predicate, ...)
+            plus anything recorded on the span itself (error, ...)
+    """
+    trace_id: int
+    stage: str
+    start: float
+    duration: float
+    attributes: dict
+
+
+###############################################################################
+#                                    Hooks                                    #
+###############################################################################
+
+class TraceHook():
+    """Interface for receiving finished traces, override on_spans"""
+
+    def on_spans(self, spans: List[Span]):
+        """Called once per finished trace with all of its spans
+
+        Args:
+            spans (List[Span]): spans of the trace in the order they ended
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the hook"""
+
+
+class RingBufferRecorder(TraceHook):
+    """Keeps the most recent spans in memory
+
+    Attributes:
+        spans (deque): the recorded spans, oldest first
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.spans = deque(maxlen=capacity)
+
+    def on_spans(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+    def clear(self):
+        """Drops every recorded span"""
+        self.spans.clear()
+
+
+class JsonLinesRecorder(TraceHook):
+    """Appends each span as a line of JSON to a file
+
+    Attributes:
+        path (str): file the spans are written to
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = Lock()
+
+    def on_spans(self, spans: List[Span]):
+        from json import dumps
+        lines = ''.join(dumps({'trace': span.trace_id, 'stage': span.stage,
+                               'start': span.start,
+                               'duration_ms': span.duration * 1000,
+                               **span.attributes}, default=str) + '\n'
+                        for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+###############################################################################
+#                               Tracer & traces                               #
+###############################################################################
+
+_ACTIVE = local()
+
+
+class Tracer():
+    """Starts (sampled) traces and hands their spans to the hooks
+
+    Attributes:
+        hooks (list): TraceHooks receiving every finished trace
+        sample_rate (float): fraction of messages traced, 0 to 1
+    """
+
+    def __init__(self, *hooks: TraceHook, sample_rate: float = 1.0):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        self.hooks = list(hooks)
+        self.sample_rate = sample_rate
+        self._ids = count(1)
+
+    def start(self, **attributes):
+        """Starts a new trace, unless this message isn't sampled
+
+        Args:
+            **attributes: attributes to attach to every span of the trace
+
+        Returns:
+            Trace or UNSAMPLED_TRACE
+        """
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            return UNSAMPLED_TRACE
+        return Trace(self, next(self._ids), attributes)
+
+    def emit(self, spans: List[Span]):
+        """Passes the spans of a finished trace along to every hook
+
+        Args:
+            spans (List[Span]): spans of the trace
+        """
+        for hook in self.hooks:
+            hook.on_spans(spans)
+
+    def close(self):
+        """Closes every hook"""
+        for hook in self.hooks:
+            hook.close()
+
+
+class Trace():
+    """Spans recorded while handling one message
+
+    Attributes:
+        attributes (dict): attributes attached to every span
+        spans (list): (stage, start, duration, attributes) recorded so far
+        trace_id (int): id of this trace
+        tracer (Tracer): tracer to emit to when finished
+    """
+
+    def __init__(self, tracer: Tracer, trace_id: int, attributes: dict):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.spans = []
+
+    def __bool__(self):
+        return True
+
+    def annotate(self, **attributes):
+        """Adds attributes to every span of this trace
+
+        Args:
+            **attributes: attribute names and values
+        """
+        self.attributes.update(attributes)
+
+    def span(self, stage: str) -> '_SpanTimer':
+        """Context manager timing a stage of handling the message
+
+        Args:
+            stage (str): name of the stage
+
+        Returns:
+            _SpanTimer
+        """
+        return _SpanTimer(self, stage)
+
+    def active(self) -> '_Activation':
+        """Context manager making this the current_trace of the thread, the
+        trace is finished (emitted) on the way out.
+
+        Returns:
+            _Activation
+        """
+        return _Activation(self)
+
+    def finish(self):
+        """Emits the recorded spans to the tracer's hooks"""
+        self.tracer.emit([Span(self.trace_id, stage, start, duration,
+                               {**self.attributes, **attributes})
+                          for stage, start, duration, attributes
+                          in self.spans])
+
+
+class _SpanTimer():
+    __slots__ = ('trace', 'stage', 'wall', 'start')
+
+    def __init__(self, trace: Trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.wall = time()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = perf_counter() - self.start
+        attributes = {'error': exc_type.__name__} if exc_type else {}
+        self.trace.spans.append((self.stage, self.wall, duration, attributes))
+
+
+class _Activation():
+    __slots__ = ('trace', 'previous')
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(_ACTIVE, 'trace', NULL_TRACE)
+        _ACTIVE.trace = self.trace
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback):
+        _ACTIVE.trace = self.previous
+        self.trace.finish()
+
+
+class _NullContext():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return None
+
+
+class _NullTrace():
+    """Trace that records nothing, used when not tracing"""
+    __slots__ = ()
+    _context = _NullContext()
+
+    def __bool__(self):
+        return False
+
+    def annotate(self, **attributes):
+        """Ignored"""
+
+    def span(self, stage: str) -> _NullContext:
+        """Returns a context manager that does nothing"""
+        return self._context
+
+    def active(self) -> _NullContext:
+        """Returns a context manager that does nothing"""
+        return self._context
+
+    def finish(self):
+        """Ignored"""
+
+
+class _UnsampledTrace(_NullTrace):
+    """Trace of a message that wasn't sampled, records nothing but is the
+    current trace while the message is handled"""
+    __slots__ = ()
+
+    def active(self) -> _Activation:
+        """Context manager making this the thread's current trace"""
+        return _Activation(self)
+
+
+NULL_TRACE = _NullTrace()
+UNSAMPLED_TRACE = _UnsampledTrace()
+
+
+def current_trace():
+    """The trace of the message being handled by this thread
+
+    Returns:
+        Trace or NULL_TRACE
+    """
+    return getattr(_ACTIVE, 'trace', NULL_TRACE)
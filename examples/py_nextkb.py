@@ -19,25 +19,45 @@ simply ask for and access the knowledge within NextKB without learning how to
 use Lisp, KQML, or companions.
 
 Attributes:
+    DEFAULT_CACHED_INSTANCES (int): default number of instances whose direct
+        isas a HierarchyCache keeps
     DEFAULT_ENVIRONMENT (bool): whether or not to make a query local or context
+    DEFAULT_HIERARCHY_BYTES (int): default memory bound of a HierarchyCache's
+        reachability index
     DEFAULT_MICROTHEORY (str): default microtheory to use if none specified
     DEFAULT_NUM_ANSWERS (int): default number of answers if none specified
     DEFAULT_TRANSITIVE (bool): whether or not to make a query transitive
     LOGGER (TYPE): The logger (from logging) to handle debugging
     NOT_USING_MICROTHEORY (str): Flag for not using microtheory context,
         shouldn't be microtheories named like this
+    REPLY_SLOT (str): name of the reply id slot in a PreparedQuery (not a
+        valid name for an argument slot)
+    Term (Union[str, tuple]): a term of a mirrored fact, a token or quoted
+        string, or a tuple for a nested expression
 """
 
+from collections import OrderedDict
+from functools import partial
 from logging import getLogger, DEBUG, INFO
-from time import sleep
+from string import Formatter
+from sys import getsizeof
+from threading import Lock, RLock, Thread
+from time import sleep, monotonic
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, \
+     Tuple, Union
 from kqml import KQMLPerformative, KQMLList
 from companionsKQML import performative, Pythonian
+from companionsKQML.companionsKQMLModule import EncodedPerformative
 
 NOT_USING_MICROTHEORY = '!NOT USING MICROTHEORY!'
 DEFAULT_MICROTHEORY = 'EverythingPSC'
 DEFAULT_TRANSITIVE = True
 DEFAULT_ENVIRONMENT = True
 DEFAULT_NUM_ANSWERS = 10
+DEFAULT_HIERARCHY_BYTES = 64 * 2 ** 20
+DEFAULT_CACHED_INSTANCES = 10000
+REPLY_SLOT = 'reply-with'
+Term = Union[str, tuple]
 LOGGER = getLogger(__name__)
 
 
@@ -52,8 +72,12 @@ class NextKBAgent(Pythonian):
     Attributes:
         answer_cache (dict): stores the responses to queries based on the
             reply_id
+        hierarchies (Dict[str, HierarchyCache]): genls hierarchies cached by
+            microtheory, see cache_hierarchy
         kb_response_interval (int): how often to check for a KB response when
             waiting
+        mirrors (Dict[str, MicrotheoryMirror]): local copies of microtheories
+            by name, see mirror_microtheory
         name (str): This is the name of the agent to register with
         response_id (int): id to keep track of queries and associated answers
     """
@@ -68,6 +92,10 @@ class NextKBAgent(Pythonian):
         self.response_id = 0
         self.answer_cache = {}
         self.kb_response_interval = 1
+        self.mirrors = {}
+        self.hierarchies = {}
+        self._mirrors_lock = Lock()
+        self._mirror_refresher = None
 
     def receive_tell(self, msg: KQMLPerformative, content: KQMLList):
         reply_to = str(msg.get('in-reply-to'))
@@ -96,8 +124,21 @@ class NextKBAgent(Pythonian):
             KQMLList: content of the response query
         """
         reply_with = self._new_response_id()
+        return self._await_response(
+            reply_with, self._kqml_ask_all(reply_with, content, microtheory))
+
+    def _await_response(self, reply_with: str, msg: KQMLPerformative):
+        """Sends an ask-all made with reply_with and waits for its response
+
+        Args:
+            reply_with (str): the ask-all's reply id
+            msg (KQMLPerformative): the ask-all
+
+        Returns:
+            KQMLList: content of the response query
+        """
         self.answer_cache[reply_with] = None
-        self.send(self._kqml_ask_all(reply_with, content, microtheory))
+        self.send(msg)
         LOGGER.debug('Waiting for response to %s...', reply_with)
         while self.answer_cache[reply_with] is None:  # wait for response
             sleep(self.kb_response_interval)
@@ -127,16 +168,36 @@ class NextKBAgent(Pythonian):
                           [:context microtheory] <- optional
                           :content content)'
         """
-        context = microtheory == NOT_USING_MICROTHEORY
-        mt_none = microtheory is None
-        microtheory = DEFAULT_MICROTHEORY if mt_none else microtheory
-        context = f':context {microtheory}' if context else ''
-        message = (f'(ask-all :sender {self.name} :receiver session-reasoner '
-                   f':query-type ask :reply-with {reply_id} {context} :content'
-                   f' {content})')
+        message = _ask_all_text(self.name, reply_id, content, microtheory)
         LOGGER.debug('KQML message %s', message)
         return performative(message)
 
+    # pylint: disable=too-many-arguments
+    def prepare(self, pattern: str, microtheory: str = None,
+                transitive: bool = None, env: bool = None,
+                num_answers: int = None) -> 'PreparedQuery':
+        """Prepares a retrieve_it style query to be run many times with
+        different arguments. The pattern has str.format style slots for the
+        arguments, e.g. '(isa {token} ?x)', and the wrappers and the rest of
+        the ask-all are encoded once here so running the query only splices
+        in the arguments and a reply id.
+
+        Args:
+            pattern (str): pattern to retrieve from the KB, with {slots}
+            microtheory (str, optional): microtheory to limit context by
+            transitive (bool, optional): whether or not to make this transitive
+            env (bool, optional): whether or not to make this local
+            num_answers (int, optional): number of answers to return
+
+        Returns:
+            PreparedQuery: the query, call it with the slot values
+        """
+        content = _transitive_wrapper(pattern, transitive)
+        content = _environment_wrapper(content, env)
+        content = _num_answers_wrapper(content, num_answers)
+        content = f'(kbOnly {content})'
+        return PreparedQuery(self, content, microtheory)
+
     ###########################################################################
     #                                   API                                   #
     ###########################################################################
@@ -341,11 +402,823 @@ class NextKBAgent(Pythonian):
         content = _environment_wrapper(content, env)
         return self._wait_on_response(content, microtheory)
 
+    ###########################################################################
+    #                           Microtheory mirrors                           #
+    ###########################################################################
+
+    def mirror_microtheory(self, microtheory: str,
+                           refresh_interval: float = None
+                           ) -> 'MicrotheoryMirror':
+        """Fetches every fact in a microtheory (get_facts_from_mt) into a
+        local, indexed copy that answers patterns without a round trip to
+        Companions (see query_mirror). Opt in per microtheory, meant for the
+        small ones that are queried over and over.
+
+        Args:
+            microtheory (str): microtheory to mirror
+            refresh_interval (float, optional): seconds between re-fetches,
+                only the facts that changed are re-indexed. None leaves the
+                mirror as fetched (see refresh_mirror)
+
+        Returns:
+            MicrotheoryMirror: the mirror
+        """
+        with self._mirrors_lock:
+            mirror = self.mirrors.get(microtheory)
+            if mirror is None:
+                mirror = self.mirrors[microtheory] = \
+                    MicrotheoryMirror(microtheory)
+                self.metrics.gauge('nextkb_mirror_facts',
+                                   'facts in a mirrored microtheory',
+                                   mirror.__len__, microtheory=microtheory)
+                self.metrics.gauge('nextkb_mirror_bytes',
+                                   'approximate memory used by a mirrored '
+                                   'microtheory', mirror.memory_bytes,
+                                   microtheory=microtheory)
+            mirror.refresh_interval = refresh_interval
+            if refresh_interval is not None and \
+                    self._mirror_refresher is None:
+                self._mirror_refresher = Thread(target=self._refresh_mirrors,
+                                                daemon=True)
+                self._mirror_refresher.start()
+        self.refresh_mirror(microtheory)
+        return mirror
+
+    def refresh_mirror(self, microtheory: str) -> bool:
+        """Re-fetches a mirrored microtheory, updating the mirror with only
+        the facts that were added or removed since the last fetch
+
+        Args:
+            microtheory (str): a mirrored microtheory
+
+        Returns:
+            bool: True if any fact changed
+        """
+        mirror = self.mirrors[microtheory]
+        response = self.get_facts_from_mt(microtheory)
+        changed = mirror.update(_mirror_facts(response))
+        LOGGER.debug('Refreshed mirror of %s (%s facts, changed: %s)',
+                     microtheory, len(mirror), changed)
+        return changed
+
+    def query_mirror(self, microtheory: str,
+                     *patterns: Union[str, tuple]) -> List[Dict[str, Term]]:
+        """Answers a pattern, or a conjunction of patterns, from the local
+        mirror of a microtheory, e.g.
+        query_mirror('CityMt', '(isa ?city City)', '(population ?city ?n)')
+
+        Args:
+            microtheory (str): a mirrored microtheory
+            *patterns (Union[str, tuple]): patterns with ?variables
+
+        Returns:
+            List[Dict[str, Term]]: bindings of the variables for every match
+        """
+        return self.mirrors[microtheory].query(*patterns)
+
+    def mirror_memory(self) -> Dict[str, int]:
+        """Approximate memory used by each mirror
+
+        Returns:
+            Dict[str, int]: bytes by microtheory
+        """
+        return {microtheory: mirror.memory_bytes()
+                for microtheory, mirror in list(self.mirrors.items())}
+
+    def _refresh_mirrors(self):
+        """Re-fetches the mirrors with a refresh interval as they come due"""
+        while self.ready:
+            wait = 1.0
+            for microtheory, mirror in list(self.mirrors.items()):
+                if mirror.refresh_interval is None:
+                    continue
+                due = mirror.refreshed_at + mirror.refresh_interval
+                if due <= monotonic():
+                    try:
+                        self.refresh_mirror(microtheory)
+                    except Exception:  # pylint: disable=broad-except
+                        LOGGER.exception('Refreshing mirror of %s failed',
+                                         microtheory)
+                    due = monotonic() + mirror.refresh_interval
+                wait = min(wait, max(due - monotonic(), 0))
+            self.shutdown_event.wait(wait)
+
+    ###########################################################################
+    #                             Hierarchy caches                            #
+    ###########################################################################
+
+    def cache_hierarchy(self, microtheory: str = None,
+                        max_bytes: int = DEFAULT_HIERARCHY_BYTES,
+                        max_instances: int = DEFAULT_CACHED_INSTANCES
+                        ) -> 'HierarchyCache':
+        """Fetches every genls fact visible from a microtheory once (without
+        transitive inference) and indexes which collections each collection
+        is subsumed by, so is_genls, is_a and ancestors are answered without
+        a round trip to Companions. The instances is_a is asked about have
+        their direct isas fetched on first use.
+
+        Args:
+            microtheory (str, optional): microtheory to use as context,
+                defaults to DEFAULT_MICROTHEORY
+            max_bytes (int, optional): most memory for the reachability
+                index, past it queries walk the genls graph instead
+            max_instances (int, optional): most instances to keep the direct
+                isas of, the least recently used are dropped
+
+        Returns:
+            HierarchyCache: the cache
+        """
+        microtheory = DEFAULT_MICROTHEORY if microtheory is None \
+            else microtheory
+        with self._mirrors_lock:
+            cache = self.hierarchies.get(microtheory)
+            if cache is None:
+                cache = self.hierarchies[microtheory] = HierarchyCache(
+                    microtheory, partial(self._direct_isas, microtheory),
+                    max_bytes, max_instances)
+                self.metrics.gauge('nextkb_hierarchy_collections',
+                                   'collections in a cached genls hierarchy',
+                                   cache.__len__, microtheory=microtheory)
+                self.metrics.gauge('nextkb_hierarchy_bytes',
+                                   'approximate memory used by a cached '
+                                   'genls hierarchy', cache.memory_bytes,
+                                   microtheory=microtheory)
+            cache.max_bytes, cache.max_instances = max_bytes, max_instances
+        self.refresh_hierarchy(microtheory)
+        return cache
+
+    def refresh_hierarchy(self, microtheory: str = None) -> int:
+        """Re-fetches the genls facts of a cached hierarchy and rebuilds its
+        index, forgetting the isas fetched for instances
+
+        Args:
+            microtheory (str, optional): microtheory of a cached hierarchy,
+                defaults to DEFAULT_MICROTHEORY
+
+        Returns:
+            int: number of collections in the hierarchy
+        """
+        microtheory = DEFAULT_MICROTHEORY if microtheory is None \
+            else microtheory
+        cache = self.hierarchies[microtheory]
+        content = _environment_wrapper(
+            _transitive_wrapper('(genls ?x ?y)', False))
+        response = self._wait_on_response(content, microtheory)
+        cache.load((fact[1], fact[2])
+                   for fact in _predicate_facts(response, 'genls'))
+        LOGGER.debug('Cached genls hierarchy of %s (%s collections, '
+                     'indexed: %s)', microtheory, len(cache), cache.indexed)
+        return len(cache)
+
+    def is_genls(self, spec: str, collection: str,
+                 microtheory: str = None) -> bool:
+        """Whether spec is subsumed by collection, (genls spec collection)
+        with transitive inference, answered from the cached hierarchy of the
+        microtheory (cached on first use, see cache_hierarchy)
+
+        Args:
+            spec (str): the more specific collection
+            collection (str): the more general collection
+            microtheory (str, optional): microtheory to use as context
+
+        Returns:
+            bool: True if spec is collection or one of its specializations
+        """
+        return self._hierarchy(microtheory).is_genls(spec, collection)
+
+    def is_a(self, token: str, collection: str,
+             microtheory: str = None) -> bool:
+        """Whether token is an instance of collection, (isa token collection)
+        with transitive inference, answered from the cached hierarchy of the
+        microtheory (cached on first use, see cache_hierarchy)
+
+        Args:
+            token (str): item in the KB
+            collection (str): collection to check
+            microtheory (str, optional): microtheory to use as context
+
+        Returns:
+            bool: True if token is an instance of collection
+        """
+        return self._hierarchy(microtheory).is_a(token, collection)
+
+    def ancestors(self, collection: str,
+                  microtheory: str = None) -> List[str]:
+        """Every collection subsuming collection, the answers of get_genls
+        with transitive inference, from the cached hierarchy of the
+        microtheory (cached on first use, see cache_hierarchy)
+
+        Args:
+            collection (str): collection in the KB
+            microtheory (str, optional): microtheory to use as context
+
+        Returns:
+            List[str]: the more general collections
+        """
+        return self._hierarchy(microtheory).ancestors(collection)
+
+    def _hierarchy(self, microtheory: str = None) -> 'HierarchyCache':
+        """The cached hierarchy of a microtheory, caching it if need be"""
+        microtheory = DEFAULT_MICROTHEORY if microtheory is None \
+            else microtheory
+        cache = self.hierarchies.get(microtheory)
+        return self.cache_hierarchy(microtheory) if cache is None else cache
+
+    def _direct_isas(self, microtheory: str, token: str) -> List[str]:
+        """The collections token is asserted to be an instance of"""
+        response = self.get_isas(token, microtheory, transitive=False)
+        return [fact[2] for fact in _predicate_facts(response, 'isa')]
+
+
+###############################################################################
+#                           Microtheory mirrors                               #
+###############################################################################
+
+class MicrotheoryMirror():
+    """Local copy of a microtheory's facts, indexed by predicate and by the
+    value at each argument position. Facts are tuples of terms (a term is a
+    token or quoted string, or a tuple for a nested expression).
+
+    Attributes:
+        facts (set): every fact in the microtheory
+        microtheory (str): name of the microtheory
+        refresh_interval (float): seconds between re-fetches, None if the
+            mirror isn't refreshed automatically
+        refreshed_at (float): monotonic time of the last update
+    """
+
+    def __init__(self, microtheory: str):
+        self.microtheory = microtheory
+        self.facts = set()
+        self.refresh_interval = None
+        self.refreshed_at = 0.0
+        self._by_predicate = {}
+        self._by_argument = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self.facts)
+
+    def update(self, facts: Iterable[tuple]) -> bool:
+        """Replaces the facts, re-indexing only those added or removed
+
+        Args:
+            facts (Iterable[tuple]): every fact now in the microtheory
+
+        Returns:
+            bool: True if any fact changed
+        """
+        facts = set(facts)
+        with self._lock:
+            added, removed = facts - self.facts, self.facts - facts
+            for fact in removed:
+                for key in _index_keys(fact):
+                    index = self._by_argument if len(key) == 3 \
+                        else self._by_predicate
+                    bucket = index[key]
+                    bucket.discard(fact)
+                    if not bucket:
+                        del index[key]
+            for fact in added:
+                for key in _index_keys(fact):
+                    index = self._by_argument if len(key) == 3 \
+                        else self._by_predicate
+                    index.setdefault(key, set()).add(fact)
+            self.facts = facts
+            self.refreshed_at = monotonic()
+        return bool(added or removed)
+
+    def match(self, pattern: tuple,
+              bindings: Dict[str, Term] = None) -> List[Dict[str, Term]]:
+        """Matches one pattern, looking candidates up by its most selective
+        bound argument
+
+        Args:
+            pattern (tuple): fact pattern, ?variables match anything
+            bindings (Dict[str, Term], optional): variables already bound
+
+        Returns:
+            List[Dict[str, Term]]: bindings extended for every match
+        """
+        bindings = {} if bindings is None else bindings
+        pattern = _substitute(pattern, bindings)
+        with self._lock:
+            candidates = self._by_predicate.get((pattern[0],), set())
+            for position, term in enumerate(pattern[1:], 1):
+                if not _is_ground(term):
+                    continue
+                bucket = self._by_argument.get((pattern[0], position, term),
+                                               set())
+                if len(bucket) < len(candidates):
+                    candidates = bucket
+            candidates = list(candidates)
+        matches = []
+        for fact in candidates:
+            extended = _unify(pattern, fact, dict(bindings))
+            if extended is not None:
+                matches.append(extended)
+        return matches
+
+    def query(self, *patterns: Union[str, tuple]) -> List[Dict[str, Term]]:
+        """Answers a conjunction of patterns
+
+        Args:
+            *patterns (Union[str, tuple]): patterns, as KQML text or tuples
+
+        Returns:
+            List[Dict[str, Term]]: bindings of the variables for every
+                answer
+        """
+        results = [{}]
+        for pattern in patterns:
+            if isinstance(pattern, str):
+                pattern = _to_term(KQMLList.from_string(pattern))
+            results = [extended for bindings in results
+                       for extended in self.match(pattern, bindings)]
+            if not results:
+                break
+        return results
+
+    def memory_bytes(self) -> int:
+        """Approximate memory used by the facts and the indexes, objects
+        shared between them are counted once
+
+        Returns:
+            int: bytes
+        """
+        with self._lock:
+            return _deep_sizeof(self.facts, self._by_predicate,
+                                self._by_argument)
+
+
+def _to_term(kqml) -> Term:
+    """A KQML object as a term, lists become tuples"""
+    if isinstance(kqml, KQMLList):
+        return tuple(_to_term(each) for each in kqml.data)
+    return str(kqml)
+
+
+def _mirror_facts(response: KQMLList) -> Iterable[tuple]:
+    """The facts in the response to get_facts_from_mt"""
+    for each in response or ():
+        term = _to_term(each)
+        # answers come back as the query pattern, (ist-Information mt fact)
+        if len(term) == 3 and str(term[0]).lower() == 'ist-information':
+            term = term[2]
+        if isinstance(term, tuple) and term:
+            yield term
+
+
+def _deep_sizeof(*roots) -> int:
+    """Approximate memory used by roots and the containers, keys and values
+    they hold, objects reachable more than once are counted once"""
+    seen, total = set(), 0
+    stack = list(roots)
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (set, tuple, list)):
+            stack.extend(item)
+    return total
+
+
+def _index_keys(fact: tuple) -> Iterable[tuple]:
+    yield (fact[0],)
+    for position, term in enumerate(fact[1:], 1):
+        yield (fact[0], position, term)
+
+
+def _is_variable(term: Term) -> bool:
+    return isinstance(term, str) and term.startswith('?')
+
+
+def _is_ground(term: Term) -> bool:
+    if isinstance(term, tuple):
+        return all(_is_ground(each) for each in term)
+    return not _is_variable(term)
+
+
+def _substitute(pattern: Term, bindings: Dict[str, Term]) -> Term:
+    if isinstance(pattern, tuple):
+        return tuple(_substitute(each, bindings) for each in pattern)
+    return bindings.get(pattern, pattern) if _is_variable(pattern) \
+        else pattern
+
+
+def _unify(pattern: Term, fact: Term,
+           bindings: Dict[str, Term]) -> Optional[Dict[str, Term]]:
+    """Extends bindings so pattern matches fact, None if it can't"""
+    if _is_variable(pattern):
+        bound = bindings.get(pattern)
+        if bound is None:
+            bindings[pattern] = fact
+            return bindings
+        return bindings if bound == fact else None
+    if isinstance(pattern, tuple):
+        if not isinstance(fact, tuple) or len(pattern) != len(fact):
+            return None
+        for each_pattern, each_fact in zip(pattern, fact):
+            if _unify(each_pattern, each_fact, bindings) is None:
+                return None
+        return bindings
+    return bindings if pattern == fact else None
+
+
+###############################################################################
+#                             Hierarchy caches                                #
+###############################################################################
+
+class HierarchyCache():
+    """A microtheory's genls graph with a reachability index. Collections
+    that subsume something get a bit each, numbered so the most general come
+    first, and every collection gets a bitset (an int) of the collections
+    subsuming it, so a subsumption check is a bit test and an ancestor list
+    is read off the bits. Collections in a genls cycle are equivalent and
+    share a bitset. The isas of instances are fetched when first asked about
+    and kept for the most recently used max_instances.
+
+    Attributes:
+        isa_loader (Callable[[str], List[str]]): fetches the collections a
+            token is asserted to be an instance of
+        loaded_at (float): monotonic time of the last load
+        max_bytes (int): most memory for the bitsets, past it the index isn't
+            built and queries walk the graph
+        max_instances (int): most instances to keep the direct isas of
+        microtheory (str): name of the microtheory
+    """
+
+    def __init__(self, microtheory: str,
+                 isa_loader: Callable[[str], List[str]],
+                 max_bytes: int = DEFAULT_HIERARCHY_BYTES,
+                 max_instances: int = DEFAULT_CACHED_INSTANCES):
+        self.microtheory = microtheory
+        self.isa_loader = isa_loader
+        self.max_bytes = max_bytes
+        self.max_instances = max_instances
+        self.loaded_at = 0.0
+        self._graph = _Hierarchy({}, [], [], [], [], None)
+        self._isas = OrderedDict()
+        self._isas_lock = Lock()
+
+    def __len__(self):
+        return len(self._graph.names)
+
+    @property
+    def indexed(self) -> bool:
+        """bool: False if the index was over max_bytes and queries walk the
+        graph"""
+        return self._graph.bitsets is not None
+
+    def load(self, edges: Iterable[Tuple[str, str]]):
+        """Replaces the hierarchy and rebuilds the index, queries running
+        meanwhile use the old one
+
+        Args:
+            edges (Iterable[Tuple[str, str]]): (spec, collection) pairs, one
+                per genls fact
+        """
+        numbers, names, parents = {}, [], []
+        for spec, collection in edges:
+            for name in (spec, collection):
+                if name not in numbers:
+                    numbers[name] = len(names)
+                    names.append(name)
+                    parents.append([])
+            if spec != collection:
+                parents[numbers[spec]].append(numbers[collection])
+        components = _components(parents)
+        subsuming = {parent for each in parents for parent in each}
+        holders = [node for component in components for node in component
+                   if node in subsuming]
+        bits = [-1] * len(names)
+        for bit, node in enumerate(holders):
+            bits[node] = bit
+        bitsets = _reachability(parents, components, bits, self.max_bytes)
+        if bitsets is None:
+            LOGGER.warning('Index of the genls hierarchy of %s is over %s '
+                           'bytes, walking the graph instead',
+                           self.microtheory, self.max_bytes)
+        with self._isas_lock:
+            self._graph = _Hierarchy(numbers, names, parents, bits, holders,
+                                     bitsets)
+            self._isas.clear()
+        self.loaded_at = monotonic()
+
+    def is_genls(self, spec: str, collection: str) -> bool:
+        """Whether spec is collection or is subsumed by it
+
+        Args:
+            spec (str): the more specific collection
+            collection (str): the more general collection
+
+        Returns:
+            bool: True if (genls spec collection) holds transitively
+        """
+        if spec == collection:
+            return True
+        graph = self._graph
+        number, target = graph.numbers.get(spec), \
+            graph.numbers.get(collection)
+        if number is None or target is None or graph.bits[target] == -1:
+            return False  # nothing is subsumed by collection
+        if graph.bitsets is not None:
+            return graph.bitsets[number] >> graph.bits[target] & 1 == 1
+        return target in _walk(graph.parents, [number])
+
+    def ancestors(self, collection: str) -> List[str]:
+        """Every collection subsuming collection, not including itself
+
+        Args:
+            collection (str): a collection
+
+        Returns:
+            List[str]: the more general collections
+        """
+        number = self._graph.numbers.get(collection)
+        if number is None:
+            return []
+        return [name for name in self._subsuming([number])
+                if name != collection]
+
+    def isas(self, token: str) -> List[str]:
+        """Every collection token is an instance of
+
+        Args:
+            token (str): item in the KB
+
+        Returns:
+            List[str]: the collections
+        """
+        direct = self._direct_isas(token)
+        numbers = self._graph.numbers
+        found = self._subsuming([numbers[each] for each in direct
+                                 if each in numbers])
+        return found + [each for each in direct if each not in numbers]
+
+    def is_a(self, token: str, collection: str) -> bool:
+        """Whether token is an instance of collection
+
+        Args:
+            token (str): item in the KB
+            collection (str): collection to check
+
+        Returns:
+            bool: True if (isa token collection) holds transitively
+        """
+        return any(self.is_genls(each, collection)
+                   for each in self._direct_isas(token))
+
+    def memory_bytes(self) -> int:
+        """Approximate memory used by the graph, the index and the cached
+        isas
+
+        Returns:
+            int: bytes
+        """
+        with self._isas_lock:
+            return _deep_sizeof(tuple(self._graph), self._isas)
+
+    def _subsuming(self, starts: List[int]) -> List[str]:
+        """Names of the collections subsuming starts (starts included)"""
+        graph = self._graph
+        if graph.bitsets is None:
+            return [graph.names[each] for each in _walk(graph.parents, starts)]
+        bits, found = 0, [graph.names[each] for each in starts
+                          if graph.bits[each] == -1]
+        for each in starts:
+            bits |= graph.bitsets[each]
+        while bits:
+            lowest = bits & -bits
+            found.append(graph.names[graph.holders[lowest.bit_length() - 1]])
+            bits ^= lowest
+        return found
+
+    def _direct_isas(self, token: str) -> List[str]:
+        """The collections token is asserted to be an instance of, fetched
+        once and kept while it's among the most recently used"""
+        with self._isas_lock:
+            direct = self._isas.get(token)
+            if direct is not None:
+                self._isas.move_to_end(token)
+                return direct
+        direct = self.isa_loader(token)
+        with self._isas_lock:
+            self._isas[token] = direct
+            while len(self._isas) > self.max_instances:
+                self._isas.popitem(last=False)
+        return direct
+
+
+class _Hierarchy(NamedTuple):
+    """A loaded genls graph and its index, replaced whole on load so queries
+    never see half of one. Nodes are numbered in the order they were read.
+
+    Attributes:
+        numbers (Dict[str, int]): node of each collection
+        names (List[str]): collection of each node
+        parents (List[List[int]]): nodes each node is directly subsumed by
+        bits (List[int]): bit of each node, -1 if it subsumes nothing
+        holders (List[int]): node of each bit
+        bitsets (Optional[List[int]]): bits of the nodes subsuming (and
+            including) each node, None if over the memory bound
+    """
+    numbers: Dict[str, int]
+    names: List[str]
+    parents: List[List[int]]
+    bits: List[int]
+    holders: List[int]
+    bitsets: Optional[List[int]]
+
+
+def _predicate_facts(response: KQMLList, predicate: str) -> Iterable[tuple]:
+    """The facts with predicate in a response to an ask-all, unwrapping
+    answers that come back as the whole query, e.g.
+    (contextEnvAllowed (nonTransitiveInference (genls Dog Mammal)))"""
+    for each in response or ():
+        term = _to_term(each)
+        while isinstance(term, tuple) and len(term) > 1 and \
+                str(term[0]).lower() != predicate:
+            term = term[-1]
+        if isinstance(term, tuple) and len(term) == 3:
+            yield term
+
+
+def _walk(parents: List[List[int]], starts: List[int]) -> List[int]:
+    """Every node reachable from starts (starts included), in the order they
+    were reached"""
+    seen, stack = set(starts), list(starts)
+    order = list(starts)
+    while stack:
+        for parent in parents[stack.pop()]:
+            if parent not in seen:
+                seen.add(parent)
+                order.append(parent)
+                stack.append(parent)
+    return order
+
+
+def _reachability(parents: List[List[int]], components: List[List[int]],
+                  bits: List[int], max_bytes: int) -> Optional[List[int]]:
+    """Bitset of the nodes reachable from each node (itself included, if it
+    has a bit), None if the bitsets would take more than max_bytes. Nodes in
+    a component share one bitset."""
+    bitsets, total = [0] * len(parents), 0
+    for component in components:
+        bitset = 0
+        for node in component:
+            if bits[node] != -1:
+                bitset |= 1 << bits[node]
+            for parent in parents[node]:
+                bitset |= bitsets[parent]
+        total += getsizeof(bitset)
+        if total > max_bytes:
+            return None
+        for node in component:
+            bitsets[node] = bitset
+    return bitsets
+
+
+def _components(parents: List[List[int]]) -> List[List[int]]:
+    """Strongly connected components of the graph, each one listed after
+    every component it reaches (Tarjan's algorithm, without recursion so
+    deep hierarchies don't hit the recursion limit)"""
+    numbering, lowest = [-1] * len(parents), [0] * len(parents)
+    on_stack, stack, components, counter = set(), [], [], 0
+    for root in range(len(parents)):
+        if numbering[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, position = work.pop()
+            if position == 0:
+                numbering[node] = lowest[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack.add(node)
+            edges = parents[node]
+            while position < len(edges):
+                parent = edges[position]
+                position += 1
+                if numbering[parent] == -1:
+                    work.append((node, position))
+                    work.append((parent, 0))
+                    break
+                if parent in on_stack:
+                    lowest[node] = min(lowest[node], numbering[parent])
+            else:
+                if lowest[node] == numbering[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+                if work:
+                    caller = work[-1][0]
+                    lowest[caller] = min(lowest[caller], lowest[node])
+    return components
+
+
+###############################################################################
+#                              Prepared queries                               #
+###############################################################################
+
+class PreparedQuery():
+    """An ask-all to the session-reasoner, encoded once with slots for its
+    arguments and reply id (see NextKBAgent.prepare)
+
+    Attributes:
+        agent (NextKBAgent): agent sending the query and receiving replies
+        slots (tuple): names of the argument slots, in order ('' for a
+            positional {} slot)
+    """
+
+    __slots__ = ('agent', 'slots', '_parts')
+
+    def __init__(self, agent: NextKBAgent, content: str,
+                 microtheory: str = None):
+        self.agent = agent
+        text = _ask_all_text(agent.name, f'{{{REPLY_SLOT}}}', content,
+                             microtheory)
+        parts, slots = [], []
+        for literal, slot, spec, conversion in Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(f'slot {{{slot}}} can only be a name')
+            parts.append(literal.encode())
+            if slot is not None:
+                parts.append(slot)
+                if slot != REPLY_SLOT:
+                    slots.append(slot)
+        self._parts = tuple(parts)
+        self.slots = tuple(slots)
+
+    def encode(self, reply_with: str, *args, **kwargs) -> bytes:
+        """The ask-all with the arguments and reply id spliced in
+
+        Args:
+            reply_with (str): reply id of the ask-all
+            *args: values of the positional {} (or {0}, {1}...) slots
+            **kwargs: values of the named slots
+
+        Returns:
+            bytes: the serialized ask-all
+        """
+        positional = iter(args)
+        encoded = []
+        for part in self._parts:
+            if isinstance(part, bytes):
+                encoded.append(part)
+            elif part == REPLY_SLOT:
+                encoded.append(reply_with.encode())
+            elif not part:
+                encoded.append(str(next(positional)).encode())
+            elif part.isdigit():
+                encoded.append(str(args[int(part)]).encode())
+            else:
+                encoded.append(str(kwargs[part]).encode())
+        return b''.join(encoded)
+
+    def __call__(self, *args, **kwargs) -> KQMLList:
+        """Runs the query, waiting for the response
+
+        Args:
+            *args: values of the positional slots
+            **kwargs: values of the named slots
+
+        Returns:
+            KQMLList: content of the response query
+        """
+        # pylint: disable=protected-access
+        reply_with = self.agent._new_response_id()
+        msg = EncodedPerformative('ask-all',
+                                  self.encode(reply_with, *args, **kwargs))
+        return self.agent._await_response(reply_with, msg)
+
 
 ###############################################################################
 #                              Content wrappers                               #
 ###############################################################################
 
+def _ask_all_text(sender: str, reply_id: str, content: str,
+                  microtheory: str = None) -> str:
+    """Text of an ask-all to the session-reasoner (see
+    NextKBAgent._kqml_ask_all)"""
+    microtheory = DEFAULT_MICROTHEORY if microtheory is None else microtheory
+    context = ('' if microtheory == NOT_USING_MICROTHEORY
+               else f':context {microtheory}')
+    return (f'(ask-all :sender {sender} :receiver session-reasoner '
+            f':query-type ask :reply-with {reply_id} {context} :content'
+            f' {content})')
+
+
 def _environment_wrapper(content: str, env: bool = None) -> str:
     """Wraps the query (content) with the appropriate environment (local or
     contextEnv only).
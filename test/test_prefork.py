@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 3.6
+# @Filename:    test_prefork.py
+# @Author:      Samuel Hill
+# @Date:        2021-04-06 10:21:37
+# @Last Modified by:    Samuel Hill
+# @Last Modified time:  2021-04-06 10:21:37
+
+"""Checks that an agent in prefork mode registers and advertises once, from
+the parent, however many workers run copies of it. A stand-in facilitator
+records every message the agent sends, each worker is made to answer an ask
+(so its agent has been built) and the registers and advertises are counted.
+Needs no Companion, exits with status 1 if a count is off.
+
+Attributes:
+    PACKAGE_ROOT (Path): directory containing the companionsKQML package
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from socket import create_connection, socket, SHUT_WR
+from sys import exit as sys_exit, path as system_path
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+system_path.insert(0, str(PACKAGE_ROOT))
+
+# pylint: disable=wrong-import-position
+from companionsKQML import Pythonian  # noqa: E402
+
+
+class CountingAgent(Pythonian):
+    """Agent with an ask and a subscription, built again in every worker"""
+
+    name = 'CountingAgent'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.add_ask(echo)
+        self.add_subscription('(counter ?x)')
+
+
+def echo(value):
+    """The ask, answers with what it is given"""
+    return value
+
+
+class Facilitator():
+    """Listens on a free port and keeps every message sent to it
+
+    Attributes:
+        messages (List[str]): the messages received, one per line
+        port (int): port listened on
+    """
+
+    def __init__(self):
+        self.messages = []
+        self._lock = Lock()
+        self._listener = socket()
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(64)
+        self.port = self._listener.getsockname()[1]
+        Thread(target=self._accept, daemon=True).start()
+
+    def count(self, text: str) -> int:
+        """Number of messages received containing text"""
+        with self._lock:
+            return sum(text in message for message in self.messages)
+
+    def close(self):
+        """Stops listening"""
+        self._listener.close()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection: socket):
+        chunks = []
+        with connection:
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        with self._lock:
+            self.messages.extend(line for line in
+                                 b''.join(chunks).decode().splitlines()
+                                 if line)
+
+
+def ask(port: int, reply_id: str):
+    """Sends an echo ask to the agent listening on port"""
+    with create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall(f'(ask-one :sender tester :reply-with {reply_id} '
+                           f':content (echo {reply_id} ?x))\n'.encode())
+        connection.shutdown(SHUT_WR)
+
+
+def test_prefork_advertises_once(workers: int = 2, timeout: float = 30.0):
+    """Registers and advertises reach the facilitator once, from the
+    parent, with workers running copies of the agent"""
+    facilitator = Facilitator()
+    agent = CountingAgent(port=facilitator.port)
+    try:
+        agent.enable_prefork(CountingAgent, workers)
+        asks = 4 * workers  # forwarded in turn, so every worker gets some
+        for number in range(asks):
+            ask(agent.listener_port, f'r{number}')
+        deadline = monotonic() + timeout
+        while facilitator.count(':in-reply-to r') < asks:
+            assert monotonic() < deadline, 'the workers did not answer'
+            sleep(0.05)
+        forwarded = agent.metrics.snapshot()
+        assert all(any(key.startswith('kqml_prefork_forwarded_total') and
+                       f'worker="{index}"' in key for key in forwarded)
+                   for index in range(workers)), 'a worker got no ask'
+        assert facilitator.count('(register ') == 1, \
+            f'{facilitator.count("(register ")} registers, expected 1'
+        assert facilitator.count('(advertise ') == 1, \
+            f'{facilitator.count("(advertise ")} advertises, expected 1'
+    finally:
+        agent.exit(timeout=5)
+        facilitator.close()
+
+
+def main():
+    """Parses arguments, runs the check and reports"""
+    parser = ArgumentParser(description='Prefork advertise check.')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='prefork worker processes')
+    args = parser.parse_args()
+    try:
+        test_prefork_advertises_once(args.workers)
+    except AssertionError as error:
+        print(f'FAIL: {error}')
+        sys_exit(1)
+    print(f'ok: one register and one advertise with {args.workers} workers')
+
+
+if __name__ == '__main__':
+    main()